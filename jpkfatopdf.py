@@ -1,230 +1,252 @@
-import os
-import sys
-import argparse
-import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import textwrap
-
-# --- Konfiguracja argumentów wiersza poleceń ---
-parser = argparse.ArgumentParser(description='Generowanie PDF faktur z pliku JPK-29-AN XML')
-parser.add_argument('xml_path', help='Ścieżka do pliku XML (JPK-29-AN)')
-parser.add_argument('--output_mode', choices=['separate', 'single'], default='separate',
-                    help="Tryb generowania PDF: 'separate' - osobne pliki, 'single' - wszystkie faktury w jednym pliku")
-args = parser.parse_args()
-xml_path = args.xml_path
-
-output_dir = "faktury"
-seller_bank_account = "Santander (SWIFT: WBKPPLPP), 84 1090 1098 0000 0001 5295 9691"  # Numer rachunku bankowego sprzedawcy
-
-# Parsowanie XML z uwzględnieniem przestrzeni nazw
-tree = ET.parse(xml_path)
-root = tree.getroot()
-ns = {
-    "jp": "http://jpk.mf.gov.pl/wzor/2022/02/17/02171/",
-    "etd": "http://crd.gov.pl/xml/schematy/dziedzinowe/mf/2018/08/24/eD/DefinicjeTypy/"
-}
-
-# Ekstrakcja danych sprzedawcy z sekcji Podmiot1
-seller_name = None
-seller_address = None
-seller_nip = None
-
-podmiot = root.find("jp:Podmiot1", ns)
-if podmiot is not None:
-    nip_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:NIP", ns)
-    name_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:PelnaNazwa", ns)
-    addr_elem = podmiot.find("jp:AdresPodmiotu", ns)
-    if nip_elem is not None:
-        seller_nip = nip_elem.text
-    if name_elem is not None:
-        seller_name = name_elem.text
-    if addr_elem is not None:
-        country = addr_elem.find("etd:KodKraju", ns)
-        street = addr_elem.find("etd:Ulica", ns)
-        bld = addr_elem.find("etd:NrDomu", ns)
-        unit = addr_elem.find("etd:NrLokalu", ns)
-        city = addr_elem.find("etd:Miejscowosc", ns)
-        postcode = addr_elem.find("etd:KodPocztowy", ns)
-        addr_parts = []
-        if street is not None:
-            addr_parts.append(street.text + (" " + bld.text if bld is not None else "") + ("/" + unit.text if unit is not None else ""))
-        if postcode is not None and city is not None:
-            addr_parts.append(postcode.text + " " + city.text)
-        seller_address = ", ".join(addr_parts)
-        if country is not None and country.text and country.text.upper() != "PL":
-            seller_address += ", " + country.text
-
-# Jeśli Podmiot1 nie jest dostępny, pobieramy dane ze pierwszej faktury
-invoices = []
-for faktura in root.findall("jp:Faktura", ns):
-    inv_number = faktura.find("jp:P_2A", ns).text
-    issue_date = faktura.find("jp:P_1", ns).text
-    sell_date = faktura.find("jp:P_6", ns).text
-    buyer_name = faktura.find("jp:P_3A", ns).text
-    buyer_addr = faktura.find("jp:P_3B", ns).text
-    if seller_name is None:
-        seller_name = faktura.find("jp:P_3C", ns).text
-    if seller_address is None:
-        seller_address = faktura.find("jp:P_3D", ns).text
-    if seller_nip is None:
-        seller_nip = faktura.find("jp:P_4B", ns).text
-    buyer_nip_elem = faktura.find("jp:P_5B", ns)
-    buyer_nip = buyer_nip_elem.text if buyer_nip_elem is not None else ""
-    net_total = faktura.find("jp:P_13_1", ns).text
-    vat_total = faktura.find("jp:P_14_1", ns).text
-    gross_total = faktura.find("jp:P_15", ns).text
-    try:
-        issue_dt = datetime.strptime(issue_date, "%Y-%m-%d")
-        due_date = (issue_dt + timedelta(days=7)).strftime("%Y-%m-%d")
-    except Exception as e:
-        due_date = ""
-
-    invoices.append({
-        "number": inv_number,
-        "date": issue_date,
-        "date_sell": sell_date,
-        "due_date": due_date,
-        "buyer_name": buyer_name,
-        "buyer_addr": buyer_addr,
-        "buyer_nip": buyer_nip,
-        "net_total": net_total,
-        "vat_total": vat_total,
-        "gross_total": gross_total,
-        "lines": []
-    })
-
-for line in root.findall("jp:FakturaWiersz", ns):
-    inv_num = line.find("jp:P_2B", ns).text
-    desc = line.find("jp:P_7", ns).text
-    unit = line.find("jp:P_8A", ns).text
-    qty = line.find("jp:P_8B", ns).text
-    net_price = line.find("jp:P_9A", ns).text
-    gross_price = line.find("jp:P_9B", ns).text
-    net_line = line.find("jp:P_11", ns).text
-    gross_line = line.find("jp:P_11A", ns).text
-    try:
-        vat_line = f"{(float(gross_line) - float(net_line)):.2f}"
-    except:
-        vat_line = ""
-    for inv in invoices:
-        if inv["number"] == inv_num:
-            inv["lines"].append({
-                "desc": desc,
-                "qty": qty,
-                "unit": unit,
-                "net_line": net_line,
-                "vat_line": vat_line,
-                "gross_line": gross_line
-            })
-            break
-
-os.makedirs(output_dir, exist_ok=True)
-
-# Rejestracja czcionek (robimy to raz, niezależnie od trybu)
-pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
-pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', 'DejaVuSans-Bold.ttf'))
-
-def draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account):
-    width, height = A4
-    c.setFont("DejaVuSans", 10)
-    # Sekcja górna lewa: Dane sprzedawcy
-    y_start = height - 50
-    c.drawString(50, y_start, "Sprzedawca:")
-    seller_info_lines = [
-        seller_name,
-        seller_address,
-        f"NIP: {seller_nip}",
-        "",
-        "Numer rachunku bankowego:",
-        seller_bank_account
-    ]
-    y = y_start - 15
-    for line in seller_info_lines:
-        c.drawString(60, y, line)
-        y -= 12
-
-    # Sekcja górna prawa: Dane nabywcy
-    c.drawString(320, y_start, "Nabywca:")
-    buyer_name_lines = textwrap.wrap(inv["buyer_name"], width=36) if inv["buyer_name"] else [""]
-    if len(buyer_name_lines) < 2:
-        buyer_name_lines.append("")
-    buyer_addr_lines = textwrap.wrap(inv["buyer_addr"], width=36) if inv["buyer_addr"] else [""]
-    if len(buyer_addr_lines) < 2:
-        buyer_addr_lines.append("")
-    buyer_info_lines = buyer_name_lines[:2] + buyer_addr_lines[:2]
-    if inv["buyer_nip"]:
-        buyer_info_lines.append(f"NIP: {inv['buyer_nip']}")
-    y_b = y_start - 15
-    for line in buyer_info_lines:
-        c.drawString(330, y_b, line)
-        y_b -= 12
-
-    # Nagłówek faktury (numer i daty)
-    header_y = min(y, y_b) - 20
-    c.setFont("DejaVuSans-Bold", 12)
-    c.drawString(50, header_y, f"Faktura VAT {inv['number']}")
-    c.setFont("DejaVuSans", 10)
-    c.drawString(50, header_y - 15, f"Data wystawienia: {inv['date']}")
-    c.drawString(50, header_y - 30, f"Data dostawy towarów/wykonania usługi: {inv['date_sell']}")
-    if inv["due_date"]:
-        c.drawString(50, header_y - 45, f"Termin płatności: {inv['due_date']}")
-        c.drawString(50, header_y - 60, "Forma płatności: przelew")
-
-    # Nagłówek tabeli pozycji
-    table_y = header_y - 105
-    c.setFont("DejaVuSans-Bold", 10)
-    c.drawString(50, table_y, "Opis towaru/usługi")
-    c.drawString(250, table_y, "Ilość")
-    c.drawString(300, table_y, "Jedn.")
-    c.drawString(350, table_y, "Netto")
-    c.drawString(420, table_y, "VAT 23%")
-    c.drawString(480, table_y, "Brutto")
-    c.setFont("DejaVuSans", 10)
-    line_y = table_y - 15
-    for item in inv["lines"]:
-        c.drawString(50, line_y, item["desc"])
-        c.drawString(250, line_y, item["qty"])
-        c.drawString(300, line_y, item["unit"])
-        net_str = f"{float(item['net_line']):.2f}"
-        vat_str = f"{float(item['vat_line']):.2f}" if item["vat_line"] else ""
-        gross_str = f"{float(item['gross_line']):.2f}"
-        c.drawRightString(400, line_y, net_str)
-        c.drawRightString(450, line_y, vat_str)
-        c.drawRightString(540, line_y, gross_str)
-        line_y -= 15
-
-    totals_y = line_y - 10
-    c.setFont("DejaVuSans-Bold", 10)
-    c.drawString(300, totals_y, "Suma netto PLN:")
-    c.drawString(300, totals_y - 15, "Suma VAT 23% PLN:")
-    c.drawString(300, totals_y - 30, "Suma brutto PLN:")
-    c.setFont("DejaVuSans", 10)
-    c.drawRightString(540, totals_y, f"{float(inv['net_total']):.2f}")
-    c.drawRightString(540, totals_y - 15, f"{float(inv['vat_total']):.2f}")
-    c.drawRightString(540, totals_y - 30, f"{float(inv['gross_total']):.2f}")
-
-# Generowanie plików PDF w zależności od wybranego trybu
-if args.output_mode == 'separate':
-    for inv in invoices:
-        inv_num = inv["number"]
-        pdf_filename = f"Faktura_{inv_num.replace('/', '_')}.pdf"
-        pdf_path = os.path.join(output_dir, pdf_filename)
-
-        c = canvas.Canvas(pdf_path, pagesize=A4)
-        draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
-        c.showPage()
-        c.save()
-    print(f"Wygenerowano {len(invoices)} faktur w osobnych plikach PDF w folderze '{output_dir}'.")
-else:  # tryb single
-    pdf_filename = "Faktury.pdf"
-    pdf_path = os.path.join(output_dir, pdf_filename)
-    c = canvas.Canvas(pdf_path, pagesize=A4)
-    for inv in invoices:
-        draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
-        c.showPage()
-    c.save()
-    print(f"Wygenerowano 1 plik PDF zawierający {len(invoices)} faktur w folderze '{output_dir}'.")
+import os
+import sys
+import glob
+import time
+import argparse
+
+from jpkfatopdfcore import (parse_jpk_xml, set_reproducible, set_backend, BACKENDS, render_invoice_file,
+                            render_single_file, render_separate_parallel, render_single_parallel, render_incremental,
+                            stage_times, format_stage_report)
+from jpkfatopdfcache import InvoiceCache, OutputManifest, DEFAULT_MAX_BYTES
+from jpkfatopdfindex import parse_jpk_invoices
+
+# --- Konfiguracja argumentów wiersza poleceń ---
+parser = argparse.ArgumentParser(description='Generowanie PDF faktur z plików JPK-29-AN XML')
+parser.add_argument('xml_path', nargs='+',
+                    help="Ścieżki do plików XML (JPK-29-AN), katalogów z plikami *.xml lub wzorców (np. 'jpk/*.xml'). "
+                         "Przy wielu plikach faktury każdego z nich trafiają do osobnego podfolderu")
+parser.add_argument('--output_mode', choices=['separate', 'single'], default='separate',
+                    help="Tryb generowania PDF: 'separate' - osobne pliki, 'single' - wszystkie faktury w jednym pliku")
+parser.add_argument('--jobs', type=int, default=1,
+                    help="Liczba procesów renderujących (0 - wszystkie rdzenie, domyślnie 1). Przy wielu plikach "
+                         "wejściowych pliki są przetwarzane równolegle; dla jednego pliku w trybie 'single' "
+                         "części pliku są renderowane równolegle i łączone w jeden dokument")
+parser.add_argument('--reproducible', action='store_true',
+                    help="Powtarzalny wynik: identyczne dane wejściowe dają identyczne bajty PDF "
+                         "(bez bieżącej daty i losowego identyfikatora dokumentu)")
+parser.add_argument('--backend', choices=BACKENDS, default='reportlab',
+                    help="Sposób zapisu PDF: 'reportlab' (domyślnie) lub 'direct' - bezpośredni zapis strumieni "
+                         "treści, wielokrotnie szybszy przy dużej liczbie faktur")
+parser.add_argument('--cache-dir',
+                    help="Katalog pamięci podręcznej wyrenderowanych faktur (tryb 'separate'); "
+                         "niezmienione faktury nie są renderowane ponownie")
+parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                    help="Limit rozmiaru pamięci podręcznej w MB (domyślnie %(default)s)")
+parser.add_argument('--incremental', action='store_true',
+                    help="Tryb przyrostowy (tylko 'separate'): manifest w folderze wyników zapamiętuje skróty "
+                         "faktur, więc renderowane są tylko faktury nowe lub zmienione, a pliki faktur usuniętych "
+                         "z JPK są kasowane")
+parser.add_argument('--invoice', action='append', metavar='NUMER',
+                    help="Tylko faktura o podanym numerze (P_2A); można podać wielokrotnie. Plik jest indeksowany "
+                         "bez pełnego parsowania, a wczytywane są tylko fragmenty wybranych faktur")
+parser.add_argument('--profile', action='store_true',
+                    help="Po zakończeniu wypisz czas poszczególnych etapów (parsowanie, łączenie pozycji, "
+                         "rysowanie, zapis PDF)")
+parser.add_argument('--profile-output', metavar='PLIK',
+                    help="Zapisz profil cProfile całego przebiegu do pliku (do analizy modułem pstats)")
+
+output_dir = "faktury"
+seller_bank_account = "Santander (SWIFT: WBKPPLPP), 84 1090 1098 0000 0001 5295 9691"  # Numer rachunku bankowego sprzedawcy
+
+# Kody wyjścia: wszystkie pliki przetworzone, żaden plik nie został przetworzony,
+# część plików nie została przetworzona
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_PARTIAL = 3
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    if args.incremental and args.output_mode != 'separate':
+        parser.error("--incremental działa tylko w trybie 'separate'")
+    if args.incremental and args.invoice:
+        parser.error("--incremental nie może być użyte razem z --invoice")
+    profiler = None
+    if args.profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        status = generate(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_output)
+    if args.profile:
+        if args.jobs != 1:
+            print("Czasy etapów procesu głównego (rysowanie i zapis odbywają się w procesach roboczych):",
+                  file=sys.stderr)
+        else:
+            print("Czasy etapów:", file=sys.stderr)
+        for line in format_stage_report(stage_times(), time.perf_counter() - start):
+            print(line, file=sys.stderr)
+    return status
+
+# Rozwinięcie argumentów wejściowych do listy plików XML: katalog oznacza wszystkie
+# pliki *.xml w nim, a wzorzec (*, ?, [...]) jest rozwijany także tam, gdzie nie robi
+# tego powłoka (Windows). Zwraca (pliki bez powtórzeń, argumenty bez żadnego pliku).
+def expand_inputs(paths):
+    files = []
+    unmatched = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if name.lower().endswith(".xml") and os.path.isfile(os.path.join(path, name)))
+        elif any(ch in path for ch in "*?[") and not os.path.exists(path):
+            matches = sorted(glob.glob(path))
+        else:
+            matches = [path]
+        if not matches:
+            unmatched.append(path)
+        for match in matches:
+            key = os.path.normcase(os.path.abspath(match))
+            if key not in seen:
+                seen.add(key)
+                files.append(match)
+    return files, unmatched
+
+# Podfoldery wyników dla wielu plików – nazwa pliku bez rozszerzenia,
+# z przyrostkiem _2, _3... przy powtórzonych nazwach
+def output_subdirs(files):
+    names = []
+    used = set()
+    for path in files:
+        base = os.path.splitext(os.path.basename(path))[0] or "jpk"
+        name = base
+        n = 1
+        while name.lower() in used:
+            n += 1
+            name = f"{base}_{n}"
+        used.add(name.lower())
+        names.append(os.path.join(output_dir, name))
+    return names
+
+def generate(args):
+    files, unmatched = expand_inputs(args.xml_path)
+    for path in unmatched:
+        print(f"Błąd: '{path}' nie wskazuje żadnego pliku XML.", file=sys.stderr)
+    if len(files) == 1 and not unmatched:
+        try:
+            generate_file(args, files[0], output_dir)
+        except LookupError as e:  # brak faktury wskazanej w --invoice
+            print(f"Błąd: {e}", file=sys.stderr)
+            return EXIT_FAILED
+        return EXIT_OK
+    return generate_batch(args, files, len(unmatched))
+
+# Generowanie faktur z jednego pliku do folderu `target_dir`; przy jobs różnym od 1
+# faktury są renderowane w puli procesów. Zwraca liczbę faktur i statystyki pamięci podręcznej.
+def generate_file(args, xml_path, target_dir, jobs=None, verbose=True):
+    jobs = args.jobs if jobs is None else jobs
+
+    # Strumieniowe parsowanie XML (iterparse) – wspólne dla CLI, GUI i usługi;
+    # dla wybranych faktur (--invoice) tylko ich fragmenty wskazane przez indeks pliku
+    issues = []
+    if args.invoice:
+        seller_name, seller_address, seller_nip, invoices = parse_jpk_invoices(xml_path, args.invoice, issues)
+    else:
+        seller_name, seller_address, seller_nip, invoices = parse_jpk_xml(xml_path, issues)
+    for issue in issues:
+        print(f"Uwaga: {issue}" if verbose else f"Uwaga ({xml_path}): {issue}", file=sys.stderr)
+
+    os.makedirs(target_dir, exist_ok=True)
+
+    # Czcionki są rejestrowane przy pierwszym renderowaniu (jpkfatopdfcore.new_canvas)
+    set_reproducible(args.reproducible)
+    set_backend(args.backend)
+
+    cache = InvoiceCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+
+    # Generowanie plików PDF w zależności od wybranego trybu
+    if args.output_mode == 'separate' and args.incremental:
+        rendered, unchanged, removed = render_incremental(invoices, seller_name, seller_address, seller_nip,
+                                                          seller_bank_account, target_dir, OutputManifest(target_dir),
+                                                          jobs, cache)
+        if verbose:
+            print(f"Wygenerowano {rendered} nowych lub zmienionych faktur w folderze '{target_dir}' "
+                  f"(bez zmian: {unchanged}, usunięte: {removed}).")
+            if cache is not None:
+                print(f"Pamięć podręczna: trafienia {cache.hits}, chybienia {cache.misses}, usunięte {cache.evictions}.")
+    elif args.output_mode == 'separate':
+        if jobs != 1:
+            render_separate_parallel(invoices, seller_name, seller_address, seller_nip, seller_bank_account,
+                                     target_dir, jobs, cache)
+        else:
+            for inv in invoices:
+                render_invoice_file(inv, seller_name, seller_address, seller_nip, seller_bank_account, target_dir, cache)
+        if verbose:
+            print(f"Wygenerowano {len(invoices)} faktur w osobnych plikach PDF w folderze '{target_dir}'.")
+            if cache is not None:
+                print(f"Pamięć podręczna: trafienia {cache.hits}, chybienia {cache.misses}, usunięte {cache.evictions}.")
+    else:  # tryb single
+        pdf_filename = "Faktury.pdf"
+        pdf_path = os.path.join(target_dir, pdf_filename)
+        if jobs != 1:
+            render_single_parallel(invoices, seller_name, seller_address, seller_nip, seller_bank_account,
+                                   pdf_path, jobs)
+        else:
+            render_single_file(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path)
+        if verbose:
+            print(f"Wygenerowano 1 plik PDF zawierający {len(invoices)} faktur w folderze '{target_dir}'.")
+    stats = (cache.hits, cache.misses, cache.evictions) if cache is not None else (0, 0, 0)
+    return len(invoices), stats
+
+# Przetworzenie jednego pliku w trybie wsadowym (także w procesie roboczym puli).
+# Błąd nie przerywa pozostałych plików – zwracany jest jego opis.
+def _batch_worker(task):
+    args, xml_path, target_dir = task
+    start = time.perf_counter()
+    try:
+        count, stats = generate_file(args, xml_path, target_dir, jobs=1, verbose=False)
+    except Exception as e:
+        return None, (0, 0, 0), f"{type(e).__name__}: {e}", time.perf_counter() - start
+    return count, stats, None, time.perf_counter() - start
+
+# Tryb wsadowy: każdy plik wejściowy do własnego podfolderu `output_dir`.
+# Przy jobs różnym od 1 pliki są przetwarzane równolegle w puli procesów
+# (każdy plik w całości w jednym procesie). Zwraca kod wyjścia.
+def generate_batch(args, files, failed=0):
+    tasks = [(args, path, target_dir) for path, target_dir in zip(files, output_subdirs(files))]
+    total = len(tasks) + failed
+    invoices = 0
+    hits = misses = evictions = 0
+    start = time.perf_counter()
+
+    if args.jobs != 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+        jobs = min(jobs, len(tasks))
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(_batch_worker, tasks)
+    else:
+        executor = None
+        results = map(_batch_worker, tasks)
+    try:
+        for done, ((_, path, target_dir), (count, stats, error, seconds)) in enumerate(zip(tasks, results), 1):
+            if error is not None:
+                failed += 1
+                print(f"[{done}/{len(tasks)}] {path}: BŁĄD – {error}", file=sys.stderr)
+                continue
+            invoices += count
+            hits, misses, evictions = hits + stats[0], misses + stats[1], evictions + stats[2]
+            print(f"[{done}/{len(tasks)}] {path}: {count} faktur w folderze '{target_dir}' ({seconds:.1f} s)")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print(f"Podsumowanie: przetworzono {total - failed} z {total} plików, wygenerowano faktur: {invoices}, "
+          f"czas {time.perf_counter() - start:.1f} s.")
+    if args.cache_dir:
+        # Limit rozmiaru jest pilnowany osobno w każdym procesie – na koniec sprawdzany dla całości
+        cache = InvoiceCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        cache.evict()
+        evictions += cache.evictions
+        print(f"Pamięć podręczna: trafienia {hits}, chybienia {misses}, usunięte {evictions}.")
+    if failed:
+        print(f"Nie udało się przetworzyć plików: {failed}.", file=sys.stderr)
+        return EXIT_FAILED if failed == total else EXIT_PARTIAL
+    return EXIT_OK
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,245 +1,89 @@
 import os
+import time
+import queue
+import threading
 import xml.etree.ElementTree as ET
-from datetime import datetime, timedelta
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import textwrap
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 
+import jpkfatopdfcore
+from jpkfatopdfcore import render_invoice_file, render_single_file
+from jpkfatopdfcache import InvoiceCache
+
 # Stałe konfiguracyjne
 SELLER_BANK_ACCOUNT = "Santander (SWIFT: WBKPPLPP), 84 1090 1098 0000 0001 5295 9691"
 OUTPUT_DIR = "faktury"
+CACHE_DIR = "faktury_cache"  # pamięć podręczna wyrenderowanych faktur (tryb 'separate')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Rejestracja czcionek – upewnij się, że pliki TTF znajdują się w tym samym folderze
-pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
-pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', 'DejaVuSans-Bold.ttf'))
-
-# Funkcja rysująca fakturę na stronie PDF
-def draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account):
-    width, height = A4
-    c.setFont("DejaVuSans", 10)
-    # Dane sprzedawcy
-    y_start = height - 50
-    c.drawString(50, y_start, "Sprzedawca:")
-    seller_info_lines = [
-        seller_name,
-        seller_address,
-        f"NIP: {seller_nip}",
-        "",
-        "Numer rachunku bankowego:",
-        seller_bank_account
-    ]
-    y = y_start - 15
-    for line in seller_info_lines:
-        c.drawString(60, y, line)
-        y -= 12
-
-    # Dane nabywcy
-    c.drawString(320, y_start, "Nabywca:")
-    buyer_name_lines = textwrap.wrap(inv["buyer_name"], width=36) if inv["buyer_name"] else [""]
-    if len(buyer_name_lines) < 2:
-        buyer_name_lines.append("")
-    buyer_addr_lines = textwrap.wrap(inv["buyer_addr"], width=36) if inv["buyer_addr"] else [""]
-    if len(buyer_addr_lines) < 2:
-        buyer_addr_lines.append("")
-    buyer_info_lines = buyer_name_lines[:2] + buyer_addr_lines[:2]
-    if inv["buyer_nip"]:
-        buyer_info_lines.append(f"NIP: {inv['buyer_nip']}")
-    y_b = y_start - 15
-    for line in buyer_info_lines:
-        c.drawString(330, y_b, line)
-        y_b -= 12
-
-    # Nagłówek faktury (numer i daty)
-    header_y = min(y, y_b) - 20
-    c.setFont("DejaVuSans-Bold", 12)
-    c.drawString(50, header_y, f"Faktura VAT {inv['number']}")
-    c.setFont("DejaVuSans", 10)
-    c.drawString(50, header_y - 15, f"Data wystawienia: {inv['date']}")
-    c.drawString(50, header_y - 30, f"Data dostawy towarów/wykonania usługi: {inv['date_sell']}")
-    if inv["due_date"]:
-        c.drawString(50, header_y - 45, f"Termin płatności: {inv['due_date']}")
-        c.drawString(50, header_y - 60, "Forma płatności: przelew")
-
-    # Tabela pozycji faktury
-    table_y = header_y - 105
-    c.setFont("DejaVuSans-Bold", 10)
-    c.drawString(50, table_y, "Opis towaru/usługi")
-    c.drawString(250, table_y, "Ilość")
-    c.drawString(300, table_y, "Jedn.")
-    c.drawString(350, table_y, "Netto")
-    c.drawString(420, table_y, "VAT 23%")
-    c.drawString(480, table_y, "Brutto")
-    c.setFont("DejaVuSans", 10)
-    line_y = table_y - 15
-    for item in inv["lines"]:
-        c.drawString(50, line_y, item["desc"])
-        c.drawString(250, line_y, item["qty"])
-        c.drawString(300, line_y, item["unit"])
-        net_str = f"{float(item['net_line']):.2f}"
-        vat_str = f"{float(item['vat_line']):.2f}" if item["vat_line"] else ""
-        gross_str = f"{float(item['gross_line']):.2f}"
-        c.drawRightString(400, line_y, net_str)
-        c.drawRightString(450, line_y, vat_str)
-        c.drawRightString(540, line_y, gross_str)
-        line_y -= 15
-
-    totals_y = line_y - 10
-    c.setFont("DejaVuSans-Bold", 10)
-    c.drawString(300, totals_y, "Suma netto PLN:")
-    c.drawString(300, totals_y - 15, "Suma VAT 23% PLN:")
-    c.drawString(300, totals_y - 30, "Suma brutto PLN:")
-    c.setFont("DejaVuSans", 10)
-    c.drawRightString(540, totals_y, f"{float(inv['net_total']):.2f}")
-    c.drawRightString(540, totals_y - 15, f"{float(inv['vat_total']):.2f}")
-    c.drawRightString(540, totals_y - 30, f"{float(inv['gross_total']):.2f}")
-
-# Funkcja parsująca plik XML JPK-29-AN
-def parse_jpk_xml(xml_path):
+# Szybki przegląd pliku XML JPK-29-AN na potrzeby podglądu (patrz jpkfatopdfcore.scan_jpk_header)
+def scan_jpk_xml(xml_path):
     try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-    except Exception as e:
+        return jpkfatopdfcore.scan_jpk_header(xml_path)
+    except (ET.ParseError, OSError) as e:
         messagebox.showerror("Błąd", f"Nie można wczytać pliku XML: {e}")
         return None
 
-    ns = {
-        "jp": "http://jpk.mf.gov.pl/wzor/2022/02/17/02171/",
-        "etd": "http://crd.gov.pl/xml/schematy/dziedzinowe/mf/2018/08/24/eD/DefinicjeTypy/"
-    }
-
-    # Dane sprzedawcy
-    seller_name = None
-    seller_address = None
-    seller_nip = None
-
-    podmiot = root.find("jp:Podmiot1", ns)
-    if podmiot is not None:
-        nip_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:NIP", ns)
-        name_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:PelnaNazwa", ns)
-        addr_elem = podmiot.find("jp:AdresPodmiotu", ns)
-        if nip_elem is not None:
-            seller_nip = nip_elem.text
-        if name_elem is not None:
-            seller_name = name_elem.text
-        if addr_elem is not None:
-            country = addr_elem.find("etd:KodKraju", ns)
-            street = addr_elem.find("etd:Ulica", ns)
-            bld = addr_elem.find("etd:NrDomu", ns)
-            unit = addr_elem.find("etd:NrLokalu", ns)
-            city = addr_elem.find("etd:Miejscowosc", ns)
-            postcode = addr_elem.find("etd:KodPocztowy", ns)
-            addr_parts = []
-            if street is not None:
-                addr_parts.append(street.text + (" " + bld.text if bld is not None else "") + ("/" + unit.text if unit is not None else ""))
-            if postcode is not None and city is not None:
-                addr_parts.append(postcode.text + " " + city.text)
-            seller_address = ", ".join(addr_parts)
-            if country is not None and country.text and country.text.upper() != "PL":
-                seller_address += ", " + country.text
-
-    invoices = []
-    for faktura in root.findall("jp:Faktura", ns):
-        inv_number = faktura.find("jp:P_2A", ns).text
-        issue_date = faktura.find("jp:P_1", ns).text
-        sell_date = faktura.find("jp:P_6", ns).text
-        buyer_name = faktura.find("jp:P_3A", ns).text
-        buyer_addr = faktura.find("jp:P_3B", ns).text
-        if seller_name is None:
-            seller_name = faktura.find("jp:P_3C", ns).text
-        if seller_address is None:
-            seller_address = faktura.find("jp:P_3D", ns).text
-        if seller_nip is None:
-            seller_nip = faktura.find("jp:P_4B", ns).text
-        buyer_nip_elem = faktura.find("jp:P_5B", ns)
-        buyer_nip = buyer_nip_elem.text if buyer_nip_elem is not None else ""
-        net_total = faktura.find("jp:P_13_1", ns).text
-        vat_total = faktura.find("jp:P_14_1", ns).text
-        gross_total = faktura.find("jp:P_15", ns).text
-        try:
-            issue_dt = datetime.strptime(issue_date, "%Y-%m-%d")
-            due_date = (issue_dt + timedelta(days=7)).strftime("%Y-%m-%d")
-        except Exception:
-            due_date = ""
-
-        invoices.append({
-            "number": inv_number,
-            "date": issue_date,
-            "date_sell": sell_date,
-            "due_date": due_date,
-            "buyer_name": buyer_name,
-            "buyer_addr": buyer_addr,
-            "buyer_nip": buyer_nip,
-            "net_total": net_total,
-            "vat_total": vat_total,
-            "gross_total": gross_total,
-            "lines": []
-        })
-
-    for line in root.findall("jp:FakturaWiersz", ns):
-        inv_num = line.find("jp:P_2B", ns).text
-        desc = line.find("jp:P_7", ns).text
-        unit = line.find("jp:P_8A", ns).text
-        qty = line.find("jp:P_8B", ns).text
-        net_line = line.find("jp:P_11", ns).text
-        gross_line = line.find("jp:P_11A", ns).text
-        try:
-            vat_line = f"{(float(gross_line) - float(net_line)):.2f}"
-        except:
-            vat_line = ""
-        for inv in invoices:
-            if inv["number"] == inv_num:
-                inv["lines"].append({
-                    "desc": desc,
-                    "qty": qty,
-                    "unit": unit,
-                    "net_line": net_line,
-                    "vat_line": vat_line,
-                    "gross_line": gross_line
-                })
-                break
-
-    return seller_name, seller_address, seller_nip, invoices
+# Wynik pełnego parsowania ostatnio generowanego pliku – kolejne generowanie
+# (np. w innym trybie) nie parsuje go ponownie, chyba że plik zmienił się
+# w międzyczasie (inny rozmiar lub data modyfikacji).
+# Zgłasza ET.ParseError lub OSError, gdy pliku nie da się wczytać.
+parsed_cache = {"key": None, "result": None, "issues": []}
+
+def file_key(xml_path):
+    st = os.stat(xml_path)
+    return os.path.abspath(xml_path), st.st_size, st.st_mtime_ns
+
+def parse_cached(xml_path, issues=None):
+    key = file_key(xml_path)
+    if parsed_cache["key"] != key:
+        parsed_issues = []
+        parsed_cache["key"] = None
+        parsed_cache["result"] = jpkfatopdfcore.parse_jpk_xml(xml_path, parsed_issues)
+        parsed_cache["issues"] = parsed_issues
+        parsed_cache["key"] = key
+    if issues is not None:
+        issues.extend(parsed_cache["issues"])
+    return parsed_cache["result"]
+
+# Przerwanie generowania przez użytkownika (zgłaszane z wywołania progress)
+class GenerationCancelled(Exception):
+    pass
 
 # Funkcja generująca pliki PDF na podstawie wybranych faktur
-def generate_pdf(seller_name, seller_address, seller_nip, invoices, seller_bank_account, output_mode):
+# W trybie 'separate' niezmienione faktury są pobierane z pamięci podręcznej.
+# progress(done, total) jest wywoływane po każdej fakturze; może przerwać
+# generowanie, zgłaszając GenerationCancelled.
+def generate_pdf(seller_name, seller_address, seller_nip, invoices, seller_bank_account, output_mode, cache=None,
+                 progress=None):
     if output_mode == 'separate':
-        for inv in invoices:
-            inv_num = inv["number"]
-            pdf_filename = f"Faktura_{inv_num.replace('/', '_')}.pdf"
-            pdf_path = os.path.join(OUTPUT_DIR, pdf_filename)
-            c = canvas.Canvas(pdf_path, pagesize=A4)
-            draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
-            c.showPage()
-            c.save()
-        return f"Wygenerowano {len(invoices)} faktur w osobnych plikach PDF w folderze '{OUTPUT_DIR}'."
+        for done, inv in enumerate(invoices, 1):
+            render_invoice_file(inv, seller_name, seller_address, seller_nip, seller_bank_account, OUTPUT_DIR, cache)
+            if progress is not None:
+                progress(done, len(invoices))
+        msg = f"Wygenerowano {len(invoices)} faktur w osobnych plikach PDF w folderze '{OUTPUT_DIR}'."
+        if cache is not None:
+            msg += f"\nPamięć podręczna: trafienia {cache.hits}, chybienia {cache.misses}."
+        return msg
     else:
-        pdf_filename = "Faktury.pdf"
-        pdf_path = os.path.join(OUTPUT_DIR, pdf_filename)
-        c = canvas.Canvas(pdf_path, pagesize=A4)
-        for inv in invoices:
-            draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
-            c.showPage()
-        c.save()
+        pdf_path = os.path.join(OUTPUT_DIR, "Faktury.pdf")
+        render_single_file(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path, progress)
         return f"Wygenerowano 1 plik PDF zawierający {len(invoices)} faktur w folderze '{OUTPUT_DIR}'."
 
-# Aktualizacja podglądu wybranego pliku – wyświetlenie podstawowych informacji
+# Aktualizacja podglądu wybranego pliku – wyświetlenie podstawowych informacji.
+# Podgląd korzysta z szybkiego przeglądu pliku, bez parsowania faktur i pozycji.
 def update_preview(text_widget, xml_path):
-    result = parse_jpk_xml(xml_path)
+    result = scan_jpk_xml(xml_path)
     if result is None:
         text_widget.delete("1.0", tk.END)
         text_widget.insert(tk.END, "Błąd podczas parsowania pliku XML.")
         return None
-    seller_name, seller_address, seller_nip, invoices = result
+    seller_name, seller_address, seller_nip, invoice_count = result
     preview_text = f"Wybrany plik: {xml_path}\n"
     preview_text += f"Sprzedawca: {seller_name}\n"
     preview_text += f"NIP sprzedawcy: {seller_nip}\n"
     preview_text += f"Adres sprzedawcy: {seller_address}\n"
-    preview_text += f"Liczba faktur: {len(invoices)}\n"
+    preview_text += f"Liczba faktur: {invoice_count}\n"
     text_widget.delete("1.0", tk.END)
     text_widget.insert(tk.END, preview_text)
     return result
@@ -258,7 +102,7 @@ def select_file(text_widget, file_var):
 def main_gui():
     root_win = tk.Tk()
     root_win.title("JPKFAK TO PDF Generator")
-    root_win.geometry("600x400")
+    root_win.geometry("600x470")
 
     file_var = tk.StringVar()
 
@@ -282,21 +126,107 @@ def main_gui():
     rb_separate.pack(side=tk.LEFT, padx=10, pady=5)
     rb_single.pack(side=tk.LEFT, padx=10, pady=5)
 
+    # Postęp generowania: pasek, liczba faktur na sekundę i przycisk przerwania
+    progress_frame = ttk.Frame(frm)
+    progress_frame.pack(fill=tk.X, pady=5)
+    progress_bar = ttk.Progressbar(progress_frame, mode="determinate")
+    progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+    progress_var = tk.StringVar()
+    ttk.Label(progress_frame, textvariable=progress_var, width=28).pack(side=tk.LEFT, padx=5)
+
+    # Generowanie odbywa się w wątku roboczym; wątek przekazuje postęp i wynik
+    # przez kolejkę, którą wątek okna odczytuje co POLL_MS (Tk nie jest wielowątkowy)
+    POLL_MS = 100
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    state = {"start": 0.0, "render_start": 0.0}
+
+    def worker(xml_path, mode):
+        # Pełne parsowanie odbywa się również w wątku roboczym (wynik jest zapamiętywany)
+        issues = []
+        try:
+            seller_name, seller_address, seller_nip, invoices = parse_cached(xml_path, issues)
+        except (ET.ParseError, OSError) as e:
+            events.put(("error", f"Nie można wczytać pliku XML: {e}"))
+            return
+        events.put(("progress", 0, len(invoices)))
+
+        def progress(done, total):
+            if cancel_event.is_set():
+                raise GenerationCancelled(done)
+            events.put(("progress", done, total))
+
+        try:
+            msg = generate_pdf(seller_name, seller_address, seller_nip, invoices, SELLER_BANK_ACCOUNT, mode,
+                               InvoiceCache(CACHE_DIR), progress)
+        except GenerationCancelled as e:
+            events.put(("cancelled", e.args[0], len(invoices)))
+        except Exception as e:
+            events.put(("error", f"Błąd podczas generowania PDF: {e}"))
+        else:
+            for issue in issues:
+                msg += f"\nUwaga: {issue}"
+            events.put(("done", msg))
+
+    def set_running(running):
+        btn_generate.config(state=tk.DISABLED if running else tk.NORMAL)
+        btn_select.config(state=tk.DISABLED if running else tk.NORMAL)
+        btn_cancel.config(state=tk.NORMAL if running else tk.DISABLED)
+
+    def poll_events():
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                break
+            kind = event[0]
+            if kind == "progress":
+                _, done, total = event
+                if done == 0:
+                    state["render_start"] = time.perf_counter()  # tempo liczone od końca parsowania
+                elapsed = time.perf_counter() - state["render_start"]
+                progress_bar.config(maximum=max(total, 1), value=done)
+                rate = done / elapsed if elapsed > 0 else 0.0
+                progress_var.set(f"{done}/{total} ({rate:.1f} faktur/s)")
+                continue
+            set_running(False)
+            if kind == "cancelled":
+                _, done, total = event
+                progress_var.set(f"Przerwano ({done}/{total})")
+                messagebox.showinfo("Przerwano", f"Generowanie przerwano po {done} z {total} faktur.")
+            elif kind == "error":
+                progress_var.set("Błąd")
+                messagebox.showerror("Błąd", event[1])
+            else:
+                # Czasy poszczególnych etapów (parsowanie, rysowanie, zapis PDF)
+                report = jpkfatopdfcore.format_stage_report(jpkfatopdfcore.stage_times(),
+                                                            time.perf_counter() - state["start"])
+                messagebox.showinfo("Sukces", event[1] + "\n\nCzasy etapów:\n" +
+                                    "\n".join(line.strip() for line in report))
+            return
+        root_win.after(POLL_MS, poll_events)
+
     # Przycisk generowania PDF
     def on_generate():
         xml_path = file_var.get()
         if not xml_path:
             messagebox.showwarning("Brak pliku", "Najpierw wybierz plik XML.")
             return
-        result = parse_jpk_xml(xml_path)
-        if result is None:
-            return
-        seller_name, seller_address, seller_nip, invoices = result
-        msg = generate_pdf(seller_name, seller_address, seller_nip, invoices, SELLER_BANK_ACCOUNT, mode_var.get())
-        messagebox.showinfo("Sukces", msg)
-
-    btn_generate = ttk.Button(frm, text="Generuj PDF", command=on_generate)
-    btn_generate.pack(pady=10)
+        jpkfatopdfcore.reset_stage_times()
+        state["start"] = time.perf_counter()
+        cancel_event.clear()
+        progress_bar.config(value=0)
+        progress_var.set("Wczytywanie pliku XML...")
+        set_running(True)
+        threading.Thread(target=worker, args=(xml_path, mode_var.get()), daemon=True).start()
+        root_win.after(POLL_MS, poll_events)
+
+    buttons_frame = ttk.Frame(frm)
+    buttons_frame.pack(pady=10)
+    btn_generate = ttk.Button(buttons_frame, text="Generuj PDF", command=on_generate)
+    btn_generate.pack(side=tk.LEFT, padx=5)
+    btn_cancel = ttk.Button(buttons_frame, text="Przerwij", command=cancel_event.set, state=tk.DISABLED)
+    btn_cancel.pack(side=tk.LEFT, padx=5)
 
     root_win.mainloop()
 
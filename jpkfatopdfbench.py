@@ -0,0 +1,500 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tracemalloc
+import platform
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta
+
+import jpkfatopdfcore
+from jpkfatopdfcore import NS, TAG_PODMIOT, TAG_FAKTURA, iter_jpk_elements, parse_podmiot, parse_faktura, parse_wiersz
+from jpkfatopdfmodel import LineStore, format_grosze
+from jpkfatopdfcache import OutputManifest
+
+# Pomiary wydajności jpkfatopdf na syntetycznych plikach JPK-29-AN.
+#
+#   python jpkfatopdfbench.py generate plik.xml --invoices 100000 --lines 5
+#   python jpkfatopdfbench.py run --sizes 10,1000,100000 --lines 3 --output wyniki.json
+#   python jpkfatopdfbench.py startup
+#   python jpkfatopdfbench.py memory --invoices 100000
+#   python jpkfatopdfbench.py incremental --invoices 1000 --changed 10
+#   python jpkfatopdfbench.py compat --invoices 200 --lines 40
+#
+# Etapy są mierzone osobno: parsowanie XML, łączenie pozycji z fakturami,
+# draw_invoice, canvas.save, zip_directory oraz pełne żądanie POST do usługi
+# Flask (klient testowy). Wyniki są zapisywane jako JSON, aby można było
+# porównywać kolejne wersje.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SIZES = "10,1000"
+DEFAULT_LINES = 3
+# Powyżej tej liczby faktur mierzone jest tylko parsowanie (renderowanie trwałoby godzinami)
+DEFAULT_RENDER_LIMIT = 1000
+
+SELLER_BANK_ACCOUNT = "Santander (SWIFT: WBKPPLPP), 84 1090 1098 0000 0001 5295 9691"
+PRODUCTS = ["Usługa programistyczna", "Licencja oprogramowania", "Wsparcie techniczne", "Szkolenie zespołu",
+            "Hosting serwera", "Konsultacje wdrożeniowe", "Abonament miesięczny", "Przegląd kodu źródłowego"]
+UNITS = ["szt.", "godz.", "usł.", "mies."]
+CITIES = [("00-950", "Warszawa"), ("80-001", "Gdańsk"), ("30-001", "Kraków"), ("50-001", "Wrocław"),
+          ("60-001", "Poznań"), ("90-001", "Łódź")]
+
+def _amount(grosze):
+    return f"{grosze // 100}.{grosze % 100:02d}"
+
+def _xml_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+# Zapis syntetycznego pliku JPK-29-AN z `invoices` fakturami po `lines` pozycji.
+# Plik jest pisany strumieniowo (także dla milionów faktur), a przy tym samym
+# `seed` zawartość jest zawsze identyczna. Sumy faktur zgadzają się z pozycjami.
+def generate_jpk(path, invoices, lines=DEFAULT_LINES, seed=0):
+    rng = random.Random(seed)
+    start = date(2024, 1, 1)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<JPK xmlns="{NS["jp"]}" xmlns:etd="{NS["etd"]}">\n')
+        f.write("<Naglowek><KodFormularza>JPK_FA</KodFormularza><WariantFormularza>4</WariantFormularza></Naglowek>\n")
+        f.write("<Podmiot1><IdentyfikatorPodmiotu><NIP>5250000000</NIP>"
+                "<PelnaNazwa>Przykładowa Firma Sp. z o.o.</PelnaNazwa></IdentyfikatorPodmiotu>"
+                "<AdresPodmiotu><etd:KodKraju>PL</etd:KodKraju><etd:Ulica>Długa</etd:Ulica>"
+                "<etd:NrDomu>5</etd:NrDomu><etd:NrLokalu>2</etd:NrLokalu><etd:Miejscowosc>Gdańsk</etd:Miejscowosc>"
+                "<etd:KodPocztowy>80-001</etd:KodPocztowy></AdresPodmiotu></Podmiot1>\n")
+
+        # Pozycje są losowane dwukrotnie z tym samym ziarnem: raz dla sum w nagłówkach,
+        # raz przy zapisie sekcji FakturaWiersz – dzięki temu nie trzeba ich trzymać w pamięci
+        def invoice_lines(line_rng):
+            for _ in range(lines):
+                qty = line_rng.randint(1, 20)
+                price = line_rng.randint(100, 500000)
+                net = qty * price
+                vat = (net * 23 + 50) // 100
+                yield qty, price, net, vat, line_rng.choice(PRODUCTS), line_rng.choice(UNITS)
+
+        line_seed = rng.random()
+        totals_rng = random.Random(line_seed)
+        for i in range(invoices):
+            net_total = vat_total = 0
+            for _, _, net, vat, _, _ in invoice_lines(totals_rng):
+                net_total += net
+                vat_total += vat
+            issue = start + timedelta(days=i % 365)
+            postcode, city = CITIES[i % len(CITIES)]
+            f.write(f"<Faktura><KodWaluty>PLN</KodWaluty><P_1>{issue.isoformat()}</P_1><P_2A>FV/{i + 1}/2024</P_2A>"
+                    f"<P_3A>Klient {i % 997} Sp. z o.o.</P_3A>"
+                    f"<P_3B>ul. Kwiatowa {i % 200 + 1}, {postcode} {city}</P_3B>"
+                    f"<P_3C>Przykładowa Firma Sp. z o.o.</P_3C><P_3D>ul. Długa 5/2, 80-001 Gdańsk</P_3D>"
+                    f"<P_4B>5250000000</P_4B><P_5B>{1000000000 + i % 997}</P_5B><P_6>{issue.isoformat()}</P_6>"
+                    f"<P_13_1>{_amount(net_total)}</P_13_1><P_14_1>{_amount(vat_total)}</P_14_1>"
+                    f"<P_15>{_amount(net_total + vat_total)}</P_15><RodzajFaktury>VAT</RodzajFaktury></Faktura>\n")
+
+        rows_rng = random.Random(line_seed)
+        for i in range(invoices):
+            for qty, price, net, vat, product, unit in invoice_lines(rows_rng):
+                f.write(f"<FakturaWiersz><P_2B>FV/{i + 1}/2024</P_2B><P_7>{_xml_text(product)}</P_7>"
+                        f"<P_8A>{unit}</P_8A><P_8B>{qty}</P_8B><P_9A>{_amount(price)}</P_9A>"
+                        f"<P_11>{_amount(net)}</P_11><P_11A>{_amount(net + vat)}</P_11A><P_12>23</P_12>"
+                        f"</FakturaWiersz>\n")
+        f.write("</JPK>\n")
+
+class Timer:
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed += time.perf_counter() - self._start
+
+# Parsowanie XML bez łączenia pozycji z fakturami – zwraca (sprzedawca, nagłówki, pozycje)
+def bench_parse(xml_path):
+    seller = None
+    headers = []
+    rows = []
+    for tag, elem in iter_jpk_elements(xml_path):
+        if tag == TAG_PODMIOT:
+            seller = parse_podmiot(elem)
+        elif tag == TAG_FAKTURA:
+            headers.append(parse_faktura(elem))
+        else:
+            rows.append(parse_wiersz(elem))
+    return seller, headers, rows
+
+# Łączenie pozycji z fakturami w magazynie kolumnowym, wraz z VAT pozycji
+# i uzgodnieniem sum (jak w jpkfatopdfcore.parse_jpk_xml)
+def bench_join(headers, rows):
+    store = LineStore()
+    by_number = {}
+    for inv in headers:
+        owner = store.new_invoice()
+        by_number.setdefault(inv.number, owner)
+    for inv_num, item in rows:
+        owner = by_number.get(inv_num)
+        if owner is not None:
+            store.add(owner, *item)
+    for inv, lines in zip(headers, store.finish()):
+        inv.lines = lines
+    store.reconcile([(inv.net_total, inv.vat_total, inv.gross_total) for inv in headers])
+    return headers
+
+# Renderowanie faktur do osobnych plików z osobnym pomiarem draw_invoice i canvas.save
+def bench_render(invoices, seller, output_dir):
+    draw = Timer()
+    save = Timer()
+    total_bytes = 0
+    for inv in invoices:
+        path = os.path.join(output_dir, jpkfatopdfcore.invoice_filename(inv))
+        c = jpkfatopdfcore.new_canvas(path)
+        with draw:
+            jpkfatopdfcore.draw_invoice(c, inv, *seller, SELLER_BANK_ACCOUNT)
+        with save:
+            c.save()
+        total_bytes += os.path.getsize(path)
+    return draw.elapsed, save.elapsed, total_bytes
+
+# Pełne żądanie POST przez klienta testowego Flask (łącznie z odczytem odpowiedzi)
+def bench_flask_post(xml_path, mode, work_dir):
+    import jpkfatopdfservice
+    client = jpkfatopdfservice.app.test_client()
+    with open(xml_path, "rb") as f:
+        data = f.read()
+    cwd = os.getcwd()
+    os.chdir(work_dir)  # config.ini i katalog wyjściowy usługi trafiają do katalogu tymczasowego
+    try:
+        with Timer() as timer:
+            response = client.post("/", data={
+                "xml_file": (io.BytesIO(data), "input.xml"),
+                "bank_account": SELLER_BANK_ACCOUNT,
+                "output_folder": "faktury",
+                "mode": mode,
+            }, content_type="multipart/form-data")
+            body = response.get_data()
+    finally:
+        os.chdir(cwd)
+    if response.status_code != 200:
+        raise RuntimeError(f"POST / ({mode}) zwrócił kod {response.status_code}")
+    return timer.elapsed, len(body)
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+# Pomiar wszystkich etapów dla jednego rozmiaru pliku
+def bench_size(invoices, lines, work_dir, render_limit=DEFAULT_RENDER_LIMIT, seed=0):
+    size_dir = os.path.join(work_dir, f"{invoices}x{lines}")
+    os.makedirs(size_dir)
+    xml_path = os.path.join(size_dir, "input.xml")
+    with Timer() as generate:
+        generate_jpk(xml_path, invoices, lines, seed)
+    result = {"invoices": invoices, "lines": lines, "xml_bytes": os.path.getsize(xml_path),
+              "generate": generate.elapsed}
+
+    with Timer() as parse:
+        seller, headers, rows = bench_parse(xml_path)
+    with Timer() as join:
+        parsed = bench_join(headers, rows)
+    del rows
+    result["parse"] = parse.elapsed
+    result["join"] = join.elapsed
+    result["parse_invoices_per_s"] = _rate(invoices, parse.elapsed + join.elapsed)
+
+    if invoices > render_limit:
+        result["skipped"] = f"renderowanie pominięte (więcej niż {render_limit} faktur)"
+        return result
+
+    pdf_dir = os.path.join(size_dir, "pdf")
+    os.makedirs(pdf_dir)
+    draw, save, pdf_bytes = bench_render(parsed, seller, pdf_dir)
+    del parsed
+    result["draw_invoice"] = draw
+    result["canvas_save"] = save
+    result["pdf_bytes"] = pdf_bytes
+    result["render_invoices_per_s"] = _rate(invoices, draw + save)
+
+    from jpkfatopdfservice import zip_directory
+    with Timer() as zipping:
+        zip_bytes = len(zip_directory(pdf_dir).getvalue())
+    result["zip_directory"] = zipping.elapsed
+    result["zip_bytes"] = zip_bytes
+
+    for mode in ("separate", "single"):
+        post_dir = os.path.join(size_dir, f"flask_{mode}")
+        os.makedirs(post_dir)
+        elapsed, response_bytes = bench_flask_post(xml_path, mode, post_dir)
+        result[f"flask_post_{mode}"] = elapsed
+        result[f"flask_post_{mode}_bytes"] = response_bytes
+    shutil.rmtree(size_dir)
+    return result
+
+# Czas wykonania polecenia w osobnym procesie (mediana z `repeat` prób, w sekundach)
+def time_command(args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=SCRIPT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+# Czas startu: `jpkfatopdf.py --help`, import modułu wspólnego (bez reportlab)
+# oraz import modułu wraz z rejestracją czcionek (pierwsze renderowanie)
+def bench_startup(repeat=5):
+    python = sys.executable
+    return {
+        "help": time_command([python, "jpkfatopdf.py", "--help"], repeat),
+        "import_core": time_command([python, "-c", "import jpkfatopdfcore"], repeat),
+        "fonts": time_command([python, "-c", "import jpkfatopdfcore; jpkfatopdfcore.register_fonts()"], repeat),
+    }
+
+# Kopia napisu jako osobny obiekt – tak jak napisy z kolejnych elementów XML,
+# zanim parser zaczął współdzielić powtarzające się wartości
+def _copy(text):
+    return (text + ".")[:-1] if text else text
+
+def _amount_float(grosze):
+    return float(format_grosze(grosze))
+
+# Dawna reprezentacja faktury: słownik napisów z listą słowników pozycji
+# (kwoty pozycji jako float), każdy napis osobnym obiektem
+def legacy_invoices(invoices):
+    result = []
+    for inv in invoices:
+        result.append({
+            "number": _copy(inv.number),
+            "date": _copy(inv.date),
+            "date_sell": _copy(inv.date_sell),
+            "due_date": _copy(inv.due_date),
+            "buyer_name": _copy(inv.buyer_name),
+            "buyer_addr": _copy(inv.buyer_addr),
+            "buyer_nip": _copy(inv.buyer_nip),
+            "net_total": format_grosze(inv.net_total),
+            "vat_total": format_grosze(inv.vat_total),
+            "gross_total": format_grosze(inv.gross_total),
+            "lines": [{"desc": _copy(line.desc), "qty": _copy(line.qty), "unit": _copy(line.unit),
+                       "net_line": _amount_float(line.net), "vat_line": _amount_float(line.vat),
+                       "gross_line": _amount_float(line.gross)} for line in inv.lines],
+        })
+    return result
+
+# Pamięć zajmowana przez sparsowane faktury (tracemalloc): po parse_jpk_xml
+# (pamięć zatrzymana i szczytowa) w porównaniu z dawną reprezentacją słownikową
+def bench_memory(invoices, lines, seed=0):
+    work_dir = tempfile.mkdtemp(prefix="jpkfatopdfbench_")
+    try:
+        xml_path = os.path.join(work_dir, "input.xml")
+        generate_jpk(xml_path, invoices, lines, seed)
+        tracemalloc.start()
+        try:
+            parsed = jpkfatopdfcore.parse_jpk_xml(xml_path)[3]
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            legacy = legacy_invoices(parsed)
+            legacy_retained = tracemalloc.get_traced_memory()[0] - base
+        finally:
+            tracemalloc.stop()
+        del legacy, parsed
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "invoices": invoices,
+        "lines": lines,
+        "retained_bytes": retained,
+        "peak_bytes": peak,
+        "bytes_per_invoice": round(retained / invoices, 1),
+        "legacy_retained_bytes": legacy_retained,
+        "legacy_bytes_per_invoice": round(legacy_retained / invoices, 1),
+        "ratio": round(legacy_retained / retained, 2) if retained else None,
+    }
+
+# Tryb przyrostowy (render_incremental): pierwsze renderowanie do pustego folderu,
+# ponowne uruchomienie bez zmian oraz po zmianie `changed` faktur i usunięciu `removed`
+def bench_incremental(invoices, lines, changed, removed=0, seed=0):
+    work_dir = tempfile.mkdtemp(prefix="jpkfatopdfbench_")
+    try:
+        xml_path = os.path.join(work_dir, "input.xml")
+        generate_jpk(xml_path, invoices, lines, seed)
+        seller_name, seller_address, seller_nip, parsed = jpkfatopdfcore.parse_jpk_xml(xml_path)
+        seller = (seller_name, seller_address, seller_nip, SELLER_BANK_ACCOUNT)
+        pdf_dir = os.path.join(work_dir, "pdf")
+        os.makedirs(pdf_dir)
+
+        def run():
+            with Timer() as timer:
+                counts = jpkfatopdfcore.render_incremental(parsed, *seller, pdf_dir, OutputManifest(pdf_dir))
+            return timer.elapsed, counts
+
+        full, _ = run()
+        unchanged, _ = run()
+        for inv in parsed[:changed]:
+            inv.buyer_name += " (korekta)"
+        if removed:
+            del parsed[-removed:]
+        partial, (rendered, kept, deleted) = run()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "invoices": invoices,
+        "lines": lines,
+        "full": full,
+        "unchanged": unchanged,
+        "changed": partial,
+        "rendered": rendered,
+        "kept": kept,
+        "removed": deleted,
+        "speedup": round(full / partial, 1) if partial > 0 else None,
+    }
+
+# Tekst wyodrębniony z dokumentu PDF (pypdf) jako lista słów – porównanie nie
+# zależy od tego, jak pypdf odtwarza odstępy i podziały wierszy
+def pdf_words(data):
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(data))
+    return len(reader.pages), " ".join(page.extract_text() for page in reader.pages).split()
+
+# Zgodność zapisu bezpośredniego (jpkfatopdfemit) z reportlab: każda faktura jest
+# renderowana oboma sposobami, a tekst wyodrębniony z obu plików musi być taki sam.
+# Przy okazji mierzona jest przepustowość obu sposobów (strony na sekundę).
+def bench_compat(invoices, lines, seed=0, xml_path=None):
+    work_dir = tempfile.mkdtemp(prefix="jpkfatopdfbench_")
+    backend = jpkfatopdfcore.get_backend()
+    try:
+        if xml_path is None:
+            xml_path = os.path.join(work_dir, "input.xml")
+            generate_jpk(xml_path, invoices, lines, seed)
+        seller_name, seller_address, seller_nip, parsed = jpkfatopdfcore.parse_jpk_xml(xml_path)
+        seller = (seller_name, seller_address, seller_nip, SELLER_BANK_ACCOUNT)
+        timers = {name: Timer() for name in jpkfatopdfcore.BACKENDS}
+        sizes = dict.fromkeys(jpkfatopdfcore.BACKENDS, 0)
+        pages = 0
+        mismatches = []
+        for inv in parsed:
+            words = {}
+            for name in jpkfatopdfcore.BACKENDS:
+                jpkfatopdfcore.set_backend(name)
+                with timers[name]:
+                    data = jpkfatopdfcore.render_invoice_bytes(inv, *seller)
+                sizes[name] += len(data)
+                words[name] = pdf_words(data)
+            pages += words["reportlab"][0]
+            if words["direct"] != words["reportlab"]:
+                mismatches.append(inv.number)
+    finally:
+        jpkfatopdfcore.set_backend(backend)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result = {"invoices": len(parsed), "pages": pages, "mismatches": len(mismatches),
+              "mismatched_numbers": mismatches[:20]}
+    for name, timer in timers.items():
+        result[name] = {"seconds": timer.elapsed, "pages_per_s": _rate(pages, timer.elapsed), "pdf_bytes": sizes[name]}
+    direct = timers["direct"].elapsed
+    result["speedup"] = round(timers["reportlab"].elapsed / direct, 1) if direct > 0 else None
+    return result
+
+def environment_info():
+    from reportlab import Version
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "reportlab": Version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def write_results(results, output):
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pomiary wydajności generowania PDF faktur JPK-29-AN')
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Zapis syntetycznego pliku JPK-29-AN")
+    generate.add_argument("xml_path", help="Ścieżka pliku wynikowego")
+    generate.add_argument("--invoices", type=int, default=1000, help="Liczba faktur (domyślnie %(default)s)")
+    generate.add_argument("--lines", type=int, default=DEFAULT_LINES, help="Pozycji na fakturę (domyślnie %(default)s)")
+    generate.add_argument("--seed", type=int, default=0, help="Ziarno generatora (domyślnie %(default)s)")
+
+    run = commands.add_parser("run", help="Pomiar etapów dla kolejnych rozmiarów pliku")
+    run.add_argument("--sizes", default=DEFAULT_SIZES,
+                     help="Liczby faktur oddzielone przecinkami, np. 10,1000,1000000 (domyślnie %(default)s)")
+    run.add_argument("--lines", type=int, default=DEFAULT_LINES, help="Pozycji na fakturę (domyślnie %(default)s)")
+    run.add_argument("--render-limit", type=int, default=DEFAULT_RENDER_LIMIT,
+                     help="Największa liczba faktur, dla której mierzone jest renderowanie (domyślnie %(default)s)")
+    run.add_argument("--reproducible", action="store_true", help="Renderowanie w trybie powtarzalnym")
+    run.add_argument("--startup", action="store_true", help="Dołącz pomiar czasu startu")
+    run.add_argument("--output", help="Plik JSON z wynikami (domyślnie wypisanie na ekran)")
+
+    startup = commands.add_parser("startup", help="Pomiar czasu startu i ładowania czcionek")
+    startup.add_argument("--repeat", type=int, default=5, help="Liczba powtórzeń (domyślnie %(default)s)")
+    startup.add_argument("--output", help="Plik JSON z wynikami (domyślnie wypisanie na ekran)")
+
+    memory = commands.add_parser("memory", help="Pomiar pamięci zajmowanej przez sparsowane faktury")
+    memory.add_argument("--invoices", type=int, default=100000, help="Liczba faktur (domyślnie %(default)s)")
+    memory.add_argument("--lines", type=int, default=DEFAULT_LINES, help="Pozycji na fakturę (domyślnie %(default)s)")
+    memory.add_argument("--output", help="Plik JSON z wynikami (domyślnie wypisanie na ekran)")
+
+    incremental = commands.add_parser("incremental", help="Pomiar trybu przyrostowego (manifest folderu wyników)")
+    incremental.add_argument("--invoices", type=int, default=1000, help="Liczba faktur (domyślnie %(default)s)")
+    incremental.add_argument("--lines", type=int, default=DEFAULT_LINES, help="Pozycji na fakturę (domyślnie %(default)s)")
+    incremental.add_argument("--changed", type=int, default=10,
+                             help="Liczba zmienionych faktur przy ponownym uruchomieniu (domyślnie %(default)s)")
+    incremental.add_argument("--removed", type=int, default=0,
+                             help="Liczba faktur usuniętych przy ponownym uruchomieniu (domyślnie %(default)s)")
+    incremental.add_argument("--output", help="Plik JSON z wynikami (domyślnie wypisanie na ekran)")
+
+    compat = commands.add_parser("compat", help="Zgodność zapisu bezpośredniego (--backend direct) z reportlab "
+                                                "i porównanie przepustowości (wymaga pakietu pypdf)")
+    compat.add_argument("--invoices", type=int, default=200, help="Liczba faktur (domyślnie %(default)s)")
+    compat.add_argument("--lines", type=int, default=DEFAULT_LINES, help="Pozycji na fakturę (domyślnie %(default)s)")
+    compat.add_argument("--xml", help="Plik JPK-29-AN do sprawdzenia zamiast pliku syntetycznego")
+    compat.add_argument("--output", help="Plik JSON z wynikami (domyślnie wypisanie na ekran)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        generate_jpk(args.xml_path, args.invoices, args.lines, args.seed)
+        print(f"Zapisano {args.invoices} faktur po {args.lines} poz. do pliku '{args.xml_path}'.")
+    elif args.command == "startup":
+        write_results({"environment": environment_info(), "startup": bench_startup(args.repeat)}, args.output)
+    elif args.command == "memory":
+        write_results({"environment": environment_info(), "memory": bench_memory(args.invoices, args.lines)}, args.output)
+    elif args.command == "incremental":
+        result = bench_incremental(args.invoices, args.lines, args.changed, args.removed)
+        write_results({"environment": environment_info(), "incremental": result}, args.output)
+    elif args.command == "compat":
+        try:
+            import pypdf
+        except ImportError:
+            parser.error("compat wymaga pakietu pypdf (pip install pypdf)")
+        result = bench_compat(args.invoices, args.lines, xml_path=args.xml)
+        write_results({"environment": environment_info(), "compat": result}, args.output)
+        if result["mismatches"]:
+            sys.exit(1)
+    else:
+        jpkfatopdfcore.set_reproducible(args.reproducible)
+        results = {"environment": environment_info(), "sizes": []}
+        if args.startup:
+            results["startup"] = bench_startup()
+        work_dir = tempfile.mkdtemp(prefix="jpkfatopdfbench_")
+        try:
+            for size in args.sizes.split(","):
+                invoices = int(size)
+                print(f"Pomiar: {invoices} faktur po {args.lines} poz.", file=sys.stderr)
+                results["sizes"].append(bench_size(invoices, args.lines, work_dir, args.render_limit))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        write_results(results, args.output)
+
+if __name__ == '__main__':
+    main()
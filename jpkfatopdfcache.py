@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+import threading
+
+# Dyskowa pamięć podręczna wyrenderowanych faktur (pliki PDF adresowane treścią).
+#
+# Klucz to skrót SHA-256 ze znormalizowanej faktury, danych sprzedawcy,
+# numeru rachunku, wersji układu (LAYOUT_VERSION) i sposobu zapisu PDF
+# (reportlab lub zapis bezpośredni), więc ponowne wgranie
+# tych samych faktur (korekty, pliki miesięczne i kwartalne) nie wymaga
+# ponownego renderowania. Rozmiar jest ograniczony – przy przekroczeniu
+# limitu usuwane są najdawniej używane wpisy (czas modyfikacji pliku jest
+# odświeżany przy każdym trafieniu) aż do zejścia do EVICT_LOW_WATER limitu,
+# więc pełne przejście katalogu nie powtarza się przy każdym zapisie.
+# Jedna instancja może być używana z wielu wątków (usługa i zadania w tle).
+
+# Zmienić przy każdej zmianie wyglądu faktury – unieważnia całą pamięć podręczną
+LAYOUT_VERSION = 5
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Część limitu, do której schodzi czyszczenie pamięci podręcznej
+EVICT_LOW_WATER = 0.9
+
+# Faktura (Invoice) jest zapisywana jako lista pól, a jej pozycje (widok
+# InvoiceLines) jako lista wierszy
+def _json_default(obj):
+    values = getattr(obj, "values", None)
+    return values() if values is not None else list(obj)
+
+def invoice_cache_key(inv, seller_name, seller_address, seller_nip, seller_bank_account, reproducible=False,
+                      backend="reportlab"):
+    payload = json.dumps([LAYOUT_VERSION, reproducible, backend, inv, seller_name, seller_address, seller_nip,
+                          seller_bank_account],
+                         sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=_json_default)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class InvoiceCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    # Pamięć podręczna jest przekazywana procesom roboczym puli (initargs), także
+    # przy metodzie startu spawn/forkserver – blokad nie da się zserializować,
+    # więc proces roboczy tworzy własne
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"], state["_evict_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".pdf")
+
+    # Wszystkie wpisy jako (ścieżka, czas użycia, rozmiar)
+    def _entries(self):
+        for root_dir, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".pdf"):
+                    continue
+                path = os.path.join(root_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.size += len(data)
+            over_limit = self.size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    # Po przekroczeniu limitu usuwanie najdawniej używanych wpisów aż do zejścia
+    # do EVICT_LOW_WATER limitu.
+    # Rozmiar jest liczony od nowa, bo z katalogu mogą korzystać inne procesy.
+    # Gdy czyszczenie już trwa w innym wątku, wywołanie od razu wraca.
+    def evict(self):
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            size = sum(size for _, _, size in entries)
+            target = int(self.max_bytes * EVICT_LOW_WATER) if size > self.max_bytes else size
+            evicted = 0
+            for path, _, entry_size in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
+                evicted += 1
+            with self._lock:
+                self.size = size
+                self.evictions += evicted
+        finally:
+            self._evict_lock.release()
+
+    # Zliczenie trafienia lub chybienia, które nastąpiło w innym procesie
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "bytes": self.size}
+
+# Manifest folderu wyników trybu przyrostowego: numer faktury -> (nazwa pliku PDF,
+# klucz invoice_cache_key faktury). Ponowne uruchomienie na poprawionym pliku JPK
+# renderuje tylko faktury, których klucz się zmienił.
+MANIFEST_NAME = ".jpkfatopdf-manifest.json"
+MANIFEST_VERSION = 1
+
+class OutputManifest:
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self.entries = self._load()
+
+    # Brak lub uszkodzenie manifestu oznacza pełne renderowanie
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                return {}
+            return {number: (filename, key) for number, (filename, key) in data["invoices"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "invoices": self.entries}, f, ensure_ascii=False, indent=0)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,964 @@
+import io
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from functools import lru_cache
+from datetime import datetime, timedelta
+
+from jpkfatopdfcache import invoice_cache_key
+from jpkfatopdfmodel import Invoice, LineStore, parse_grosze, format_grosze
+from jpkfatopdfmerge import PdfMerger
+
+# Wspólny kod parsowania i renderowania faktur JPK-29-AN używany przez CLI, GUI i usługę Flask.
+# reportlab i pula procesów są importowane dopiero przy pierwszym renderowaniu,
+# więc samo parsowanie, podgląd czy --help nie płacą kosztu ich ładowania.
+
+# Pliki TTF leżą w tym samym folderze co skrypty
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Rozmiar strony A4 w punktach (jak reportlab.lib.pagesizes.A4)
+A4 = (595.2755905511812, 841.8897637795277)
+
+NS = {
+    "jp": "http://jpk.mf.gov.pl/wzor/2022/02/17/02171/",
+    "etd": "http://crd.gov.pl/xml/schematy/dziedzinowe/mf/2018/08/24/eD/DefinicjeTypy/"
+}
+
+TAG_PODMIOT = "{%s}Podmiot1" % NS["jp"]
+TAG_FAKTURA = "{%s}Faktura" % NS["jp"]
+TAG_WIERSZ = "{%s}FakturaWiersz" % NS["jp"]
+
+# Pomiar czasu etapów przetwarzania: etap -> [sekundy, liczba wykonań].
+# Sumy dotyczą bieżącego procesu – praca procesów roboczych puli nie jest tu
+# widoczna, w procesie głównym jest to czas oczekiwania na ich wyniki.
+STAGE_LABELS = {
+    "parse": "parsowanie XML",
+    "index": "indeks pozycji w pliku",
+    "join": "łączenie pozycji z fakturami",
+    "draw": "rysowanie faktur (draw_invoice)",
+    "save": "zapis PDF (canvas.save)",
+    "merge": "scalanie części PDF",
+    "zip": "archiwum ZIP",
+}
+_stage_lock = threading.Lock()
+_stage_totals = {}
+
+def add_stage_time(stage, seconds, count=1):
+    with _stage_lock:
+        total = _stage_totals.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += count
+
+# Kopia bieżących sum – słownik etap -> (sekundy, liczba wykonań)
+def stage_times():
+    with _stage_lock:
+        return {stage: tuple(total) for stage, total in _stage_totals.items()}
+
+def reset_stage_times():
+    with _stage_lock:
+        _stage_totals.clear()
+
+# Menedżer kontekstu mierzący czas jednego wykonania etapu
+class timed_stage:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_stage_time(self.stage, time.perf_counter() - self.start)
+
+# Menedżer kontekstu zapisu pliku wynikowego: zapis idzie do pliku tymczasowego
+# (`path` + ".tmp"), który zastępuje `path` dopiero po udanym zakończeniu bloku.
+# Błąd lub anulowanie w trakcie zapisu usuwa plik tymczasowy i zostawia
+# poprzednią zawartość `path` nienaruszoną.
+class atomic_output:
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+
+    def __enter__(self):
+        self.file = open(self.tmp_path, "wb")
+        return self.file
+
+    def __exit__(self, exc_type, *exc):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+# Zestawienie czasów etapów (wiersze tekstu); `total` to czas całego przebiegu,
+# a jego część nieprzypisana do etapów jest pokazywana jako "pozostałe"
+def format_stage_report(times, total=None):
+    def line(label, seconds, suffix=""):
+        share = f" ({seconds / total:6.1%})" if total else ""
+        return f"  {label:<34} {seconds:9.3f} s{share}{suffix}"
+
+    lines = []
+    for stage, (seconds, count) in sorted(times.items(), key=lambda item: -item[1][0]):
+        lines.append(line(STAGE_LABELS.get(stage, stage), seconds, f"  x{count}"))
+    if total is not None:
+        lines.append(line("pozostałe", max(0.0, total - sum(seconds for seconds, _ in times.values()))))
+        lines.append(line("razem", total))
+    return lines
+
+# Ekstrakcja danych sprzedawcy z sekcji Podmiot1
+def parse_podmiot(podmiot):
+    seller_name = None
+    seller_address = None
+    seller_nip = None
+    nip_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:NIP", NS)
+    name_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:PelnaNazwa", NS)
+    addr_elem = podmiot.find("jp:AdresPodmiotu", NS)
+    if nip_elem is not None:
+        seller_nip = nip_elem.text
+    if name_elem is not None:
+        seller_name = name_elem.text
+    if addr_elem is not None:
+        country = addr_elem.find("etd:KodKraju", NS)
+        street = addr_elem.find("etd:Ulica", NS)
+        bld = addr_elem.find("etd:NrDomu", NS)
+        unit = addr_elem.find("etd:NrLokalu", NS)
+        city = addr_elem.find("etd:Miejscowosc", NS)
+        postcode = addr_elem.find("etd:KodPocztowy", NS)
+        addr_parts = []
+        if street is not None:
+            addr_parts.append(street.text + (" " + bld.text if bld is not None else "") + ("/" + unit.text if unit is not None else ""))
+        if postcode is not None and city is not None:
+            addr_parts.append(postcode.text + " " + city.text)
+        seller_address = ", ".join(addr_parts)
+        if country is not None and country.text and country.text.upper() != "PL":
+            seller_address += ", " + country.text
+    return seller_name, seller_address, seller_nip
+
+# Napisy powtarzające się w dokumencie (daty, nabywcy, jednostki, opisy) są
+# współdzielone: `strings` to słownik napis -> pierwsze wystąpienie napisu,
+# wspólny dla całego dokumentu (zwalniany razem z nim, w odróżnieniu od sys.intern)
+
+# Ekstrakcja nagłówka faktury z elementu Faktura (bez pozycji)
+def parse_faktura(faktura, strings=None):
+    share = _sharer(strings)
+    inv_number = faktura.find("jp:P_2A", NS).text
+    issue_date = share(faktura.find("jp:P_1", NS).text)
+    sell_date = share(faktura.find("jp:P_6", NS).text)
+    buyer_name = share(faktura.find("jp:P_3A", NS).text)
+    buyer_addr = share(faktura.find("jp:P_3B", NS).text)
+    buyer_nip_elem = faktura.find("jp:P_5B", NS)
+    buyer_nip = share(buyer_nip_elem.text) if buyer_nip_elem is not None else ""
+    net_total = parse_grosze(faktura.find("jp:P_13_1", NS).text)
+    vat_total = parse_grosze(faktura.find("jp:P_14_1", NS).text)
+    gross_total = parse_grosze(faktura.find("jp:P_15", NS).text)
+    try:
+        issue_dt = datetime.strptime(issue_date, "%Y-%m-%d")
+        due_date = share((issue_dt + timedelta(days=7)).strftime("%Y-%m-%d"))
+    except Exception:
+        due_date = ""
+
+    # Pozycje (InvoiceLines) przypisuje parse_jpk_xml
+    return Invoice(inv_number, issue_date, sell_date, due_date, buyer_name, buyer_addr, buyer_nip,
+                   net_total, vat_total, gross_total)
+
+def _same(text):
+    return text
+
+def _sharer(strings):
+    if strings is None:
+        return _same
+    setdefault = strings.setdefault
+    return lambda text: setdefault(text, text)
+
+# Ekstrakcja pozycji faktury – zwraca numer faktury i krotkę pól pozycji
+# (opis, ilość, jednostka, netto, brutto) z kwotami w groszach, jak dla LineStore.add
+def parse_wiersz(line, strings=None):
+    share = _sharer(strings)
+    inv_num = line.find("jp:P_2B", NS).text
+    desc = share(line.find("jp:P_7", NS).text)
+    unit = share(line.find("jp:P_8A", NS).text)
+    qty = share(line.find("jp:P_8B", NS).text)
+    net_line = parse_grosze(line.find("jp:P_11", NS).text)
+    gross_line = parse_grosze(line.find("jp:P_11A", NS).text)
+    return inv_num, (desc, qty, unit, net_line, gross_line)
+
+# Strumieniowe przejście po pliku (ścieżka lub obiekt plikowy) za pomocą iterparse.
+# Zwraca kolejno krotki (znacznik, element) dla Podmiot1, Faktura i FakturaWiersz.
+# Po obsłużeniu elementu przez wywołującego jest on usuwany z drzewa,
+# więc w pamięci nigdy nie ma więcej niż jeden rekord najwyższego poziomu.
+def iter_jpk_elements(source):
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag in (TAG_PODMIOT, TAG_FAKTURA, TAG_WIERSZ):
+            yield elem.tag, elem
+        # Elementy najwyższego poziomu są już obsłużone – zwalniamy je
+        root.clear()
+
+# Parsowanie całego pliku – zwraca nazwę, adres i NIP sprzedawcy oraz listę faktur
+# (z pozycjami). Plik jest czytany strumieniowo, ale pozycje (FakturaWiersz)
+# występują w JPK po wszystkich nagłówkach (Faktura), więc faktury są kompletne
+# dopiero po przeczytaniu całego pliku; w pamięci trzymane są jedynie rekordy
+# faktur (Invoice), nigdy drzewo XML. Pozycje są trzymane w kolumnowym magazynie (jpkfatopdfmodel.LineStore),
+# a inv.lines to widok pozycji danej faktury.
+# Problemy z powiązaniem pozycji z fakturami (pozycje bez nagłówka,
+# zduplikowane numery P_2A) oraz sumy pozycji niezgodne z P_13_1/P_14_1/P_15
+# są dopisywane do listy `issues`, jeśli ją podano.
+def parse_jpk_xml(source, issues=None):
+    seller_name = seller_address = seller_nip = None
+    invoices = []
+    strings = {}
+    store = LineStore()
+    # Indeks numer faktury -> numer kolejny faktury w magazynie pozycji
+    by_number = {}
+    duplicates = {}
+    orphans = {}
+    start = time.perf_counter()
+    join_time = 0.0
+    rows = 0
+    for tag, elem in iter_jpk_elements(source):
+        if tag == TAG_PODMIOT:
+            seller_name, seller_address, seller_nip = parse_podmiot(elem)
+        elif tag == TAG_FAKTURA:
+            # Jeśli Podmiot1 nie jest dostępny, pobieramy dane z pierwszej faktury
+            if seller_name is None:
+                seller_name = elem.find("jp:P_3C", NS).text
+            if seller_address is None:
+                seller_address = elem.find("jp:P_3D", NS).text
+            if seller_nip is None:
+                seller_nip = elem.find("jp:P_4B", NS).text
+            inv = parse_faktura(elem, strings)
+            invoices.append(inv)
+            owner = store.new_invoice()
+            # Przy powtórzonym numerze pozycje trafiają do pierwszej faktury o tym numerze
+            if inv.number in by_number:
+                duplicates[inv.number] = duplicates.get(inv.number, 1) + 1
+            else:
+                by_number[inv.number] = owner
+        else:
+            inv_num, item = parse_wiersz(elem, strings)
+            join_start = time.perf_counter()
+            owner = by_number.get(inv_num)
+            if owner is None:
+                orphans[inv_num] = orphans.get(inv_num, 0) + 1
+            else:
+                store.add(owner, *item)
+            join_time += time.perf_counter() - join_start
+            rows += 1
+
+    # Pozycje wszystkich faktur naraz: VAT pozycji i uzgodnienie sum z nagłówkami
+    join_start = time.perf_counter()
+    for inv, lines in zip(invoices, store.finish()):
+        inv.lines = lines
+    mismatches = store.reconcile([(inv.net_total, inv.vat_total, inv.gross_total) for inv in invoices])
+    join_time += time.perf_counter() - join_start
+    add_stage_time("parse", time.perf_counter() - start - join_time, len(invoices))
+    add_stage_time("join", join_time, rows)
+
+    if issues is not None:
+        for number, count in duplicates.items():
+            issues.append(f"Numer faktury {number} występuje {count} razy – pozycje przypisano do pierwszej z nich.")
+        for number, count in orphans.items():
+            issues.append(f"Pominięto {count} poz. odwołujących się do nieistniejącej faktury {number}.")
+        fields = {"net": "netto (P_13_1)", "vat": "VAT (P_14_1)", "gross": "brutto (P_15)"}
+        for owner, column, actual, total in mismatches:
+            issues.append(f"Faktura {invoices[owner].number}: suma pozycji {format_grosze(actual)} różni się od "
+                          f"sumy {fields[column]} {format_grosze(total)}.")
+
+    return seller_name, seller_address, seller_nip, invoices
+
+# Rozmiar bloku odczytu przy szybkim przeglądaniu pliku
+SCAN_BLOCK_SIZE = 1024 * 1024
+
+# Szybki przegląd pliku (ścieżka lub binarny obiekt plikowy) bez budowania faktur
+# i pozycji – zwraca (nazwa, adres, NIP sprzedawcy, liczba faktur).
+# Parser XML czyta tylko początek dokumentu (Podmiot1 i pierwszą fakturę),
+# a faktury w pozostałej części są liczone jako znaczniki otwierające <Faktura>
+# wyszukiwane bezpośrednio w bajtach pliku (z prefiksem przestrzeni nazw JPK
+# użytym w dokumencie). Zakomentowane faktury również zostaną policzone.
+# Zgłasza ET.ParseError, gdy początek dokumentu nie jest poprawnym XML.
+def scan_jpk_header(source):
+    close = False
+    if isinstance(source, (str, bytes, os.PathLike)):
+        source = open(source, "rb")
+        close = True
+    try:
+        return _scan_jpk(source)
+    finally:
+        if close:
+            source.close()
+
+def _scan_jpk(f):
+    parser = ET.XMLPullParser(events=("start-ns", "start", "end"))
+    seller = {"name": None, "address": None, "nip": None}
+    prefix = None
+    header_done = False
+    depth = 0
+    needle = None
+    count = 0
+    tail = b""
+    while True:
+        block = f.read(SCAN_BLOCK_SIZE)
+        if not header_done:
+            # Dane sprzedawcy z Podmiot1 (lub z pierwszej faktury) – zwykły parser XML
+            if block:
+                parser.feed(block)
+            else:
+                parser.close()
+            for event, data in parser.read_events():
+                if event == "start-ns":
+                    if data[1] == NS["jp"] and prefix is None:
+                        prefix = data[0]
+                elif event == "start":
+                    depth += 1
+                    continue
+                else:
+                    depth -= 1
+                    if depth != 1:
+                        continue
+                    if data.tag == TAG_PODMIOT:
+                        seller["name"], seller["address"], seller["nip"] = parse_podmiot(data)
+                    elif data.tag == TAG_FAKTURA:
+                        for key, field in (("name", "P_3C"), ("address", "P_3D"), ("nip", "P_4B")):
+                            if seller[key] is None:
+                                elem = data.find(f"jp:{field}", NS)
+                                seller[key] = elem.text if elem is not None else None
+                        header_done = True
+                        break
+        if not block:
+            break
+        if needle is None:
+            if prefix is None and depth == 0:
+                # Element główny jeszcze nieprzeczytany – blok sprawdzamy razem z następnym
+                tail += block
+                continue
+            # Bez przestrzeni nazw JPK w elemencie głównym plik nie zawiera faktur JPK-29-AN
+            needle = ("<" + (prefix + ":" if prefix else "") + "Faktura").encode("utf-8") if prefix is not None else b""
+            block = tail + block
+            tail = b""
+        if not needle:
+            continue
+        # Zliczanie znaczników w bloku; końcówka bloku, w której może zaczynać się
+        # znacznik przecięty granicą bloków, jest sprawdzana razem z następnym
+        data = tail + block
+        limit = len(data) - len(needle)
+        pos = data.find(needle)
+        while 0 <= pos < limit:
+            if data[pos + len(needle)] in b" \t\r\n/>":
+                count += 1
+            pos = data.find(needle, pos + len(needle))
+        tail = data[max(limit, 0):]
+    return seller["name"], seller["address"], seller["nip"], count
+
+# Rejestracja czcionek – wykonywana raz na proces (także w procesach roboczych),
+# automatycznie przy tworzeniu pierwszego dokumentu
+def register_fonts():
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    if "DejaVuSans" in pdfmetrics.getRegisteredFontNames():
+        return
+    pdfmetrics.registerFont(TTFont('DejaVuSans', os.path.join(FONT_DIR, 'DejaVuSans.ttf')))
+    pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', os.path.join(FONT_DIR, 'DejaVuSans-Bold.ttf')))
+
+# Stałe elementy strony: dane sprzedawcy z etykietą "Nabywca:", nagłówek tabeli
+# pozycji i etykiety sum. Nagłówek tabeli i etykiety sum są rysowane względem `y`.
+def _draw_seller(c, seller_name, seller_address, seller_nip, seller_bank_account):
+    width, height = A4
+    c.setFont("DejaVuSans", 10)
+    y_start = height - 50
+    c.drawString(50, y_start, "Sprzedawca:")
+    seller_info_lines = [
+        seller_name,
+        seller_address,
+        f"NIP: {seller_nip}",
+        "",
+        "Numer rachunku bankowego:",
+        seller_bank_account
+    ]
+    y = y_start - 15
+    for line in seller_info_lines:
+        c.drawString(60, y, line)
+        y -= 12
+    c.drawString(320, y_start, "Nabywca:")
+
+def _draw_table_header(c, y=0):
+    c.setFont("DejaVuSans-Bold", 10)
+    c.drawString(50, y, "Opis towaru/usługi")
+    c.drawString(250, y, "Ilość")
+    c.drawString(300, y, "Jedn.")
+    c.drawString(350, y, "Netto")
+    c.drawString(420, y, "VAT 23%")
+    c.drawString(480, y, "Brutto")
+
+def _draw_totals_labels(c, y=0):
+    c.setFont("DejaVuSans-Bold", 10)
+    c.drawString(300, y, "Suma netto PLN:")
+    c.drawString(300, y - 15, "Suma VAT 23% PLN:")
+    c.drawString(300, y - 30, "Suma brutto PLN:")
+
+# W dokumentach wielostronicowych (new_canvas z page_forms=True) stałe elementy
+# strony są rysowane raz na dokument jako obiekty XObject formularza (osobno dla
+# każdego zestawu danych sprzedawcy) i na kolejnych stronach jedynie wstawiane.
+# Zwraca przedrostek nazw formularzy albo None, gdy dokument z nich nie korzysta.
+def _page_forms(c, seller_name, seller_address, seller_nip, seller_bank_account):
+    forms = getattr(c, "_jpk_page_forms", None)
+    if forms is None:
+        return None
+    key = (seller_name, seller_address, seller_nip, seller_bank_account)
+    prefix = forms.get(key)
+    if prefix is None:
+        prefix = forms[key] = f"JpkPage{len(forms)}"
+        c.beginForm(prefix + "Seller")
+        _draw_seller(c, seller_name, seller_address, seller_nip, seller_bank_account)
+        c.endForm()
+        c.beginForm(prefix + "Table", lowery=-20, uppery=20)
+        _draw_table_header(c)
+        c.endForm()
+        c.beginForm(prefix + "Totals", lowery=-50, uppery=20)
+        _draw_totals_labels(c)
+        c.endForm()
+    return prefix
+
+# Wstawienie formularza przesuniętego w pionie o `y`
+def _stamp_form(c, name, y=0):
+    c.saveState()
+    c.translate(0, y)
+    c.doForm(name)
+    c.restoreState()
+
+# Układ tabeli pozycji: odstęp między wierszami tabeli, odstęp między wierszami
+# zawiniętego opisu, szerokość kolumny opisu i dolny margines strony (w punktach)
+ROW_HEIGHT = 15
+WRAP_LEADING = 12
+DESC_WIDTH = 195
+BOTTOM_MARGIN = 50
+
+# Szerokość kolumny danych nabywcy (od x=330 do prawej krawędzi tabeli)
+BUYER_WIDTH = 210
+
+# Liczba zapamiętanych wyników wrap_text (teksty, które powtarzają się na wielu
+# fakturach: nazwy i adresy stałych klientów, typowe opisy pozycji)
+WRAP_CACHE_SIZE = 65536
+
+# Szerokości znaków czcionki przy rozmiarze 1000 pt, liczone przy pierwszym użyciu znaku
+class _GlyphWidths(dict):
+    __slots__ = ("font",)
+
+    def __init__(self, font):
+        super().__init__()
+        self.font = font
+
+    def __missing__(self, char):
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        width = self[char] = stringWidth(char, self.font, 1000)
+        return width
+
+_glyph_widths = {}
+
+# Tablica szerokości znaków czcionki (wspólna dla procesu)
+def glyph_widths(font):
+    widths = _glyph_widths.get(font)
+    if widths is None:
+        widths = _glyph_widths[font] = _GlyphWidths(font)
+    return widths
+
+def _text_width(widths, text):
+    return sum(map(widths.__getitem__, text))
+
+# Znaki odstępu zamieniane na spacje (jak w textwrap)
+_WHITESPACE = str.maketrans("\t\n\r\v\f", "     ")
+
+# Podział tekstu na wiersze nie szersze niż `width` punktów – po słowach,
+# a słowa dłuższe niż cały wiersz między znakami. Zwraca krotkę wierszy;
+# wyniki są zapamiętywane (LRU), więc powtarzające się teksty dzielone są raz.
+@lru_cache(maxsize=WRAP_CACHE_SIZE)
+def wrap_text(text, font, size, width):
+    widths = glyph_widths(font)
+    text = text.translate(_WHITESPACE)
+    # Szerokości liczone w jednostkach czcionki 1000 pt
+    width = width * 1000 / size
+    if _text_width(widths, text) <= width:
+        return (text,)
+    space = widths[" "]
+    lines = []
+    line = ""
+    line_width = 0
+    for word in text.split():
+        word_width = _text_width(widths, word)
+        if line and line_width + space + word_width <= width:
+            line += " " + word
+            line_width += space + word_width
+            continue
+        if line:
+            lines.append(line)
+        line, line_width = word, word_width
+        if word_width <= width:
+            continue
+        line, line_width = "", 0
+        for char in word:
+            char_width = widths[char]
+            if line and line_width + char_width > width:
+                lines.append(line)
+                line, line_width = "", 0
+            line += char
+            line_width += char_width
+    if line:
+        lines.append(line)
+    return tuple(lines) or ("",)
+
+# Nowa strona z dalszym ciągiem faktury: numer faktury i powtórzony nagłówek
+# tabeli. Zwraca położenie pierwszego wiersza tabeli.
+def _continue_invoice(c, inv, forms):
+    width, height = A4
+    c.showPage()
+    y = height - 50
+    c.setFont("DejaVuSans-Bold", 12)
+    c.drawString(50, y, f"Faktura VAT {inv.number} – ciąg dalszy")
+    table_y = y - 30
+    if forms is not None:
+        _stamp_form(c, forms + "Table", table_y)
+    else:
+        _draw_table_header(c, table_y)
+    c.setFont("DejaVuSans", 10)
+    return table_y - ROW_HEIGHT
+
+# Funkcja rysująca fakturę na stronie PDF. Pozycje, które nie mieszczą się na
+# stronie, przechodzą na kolejne strony (draw_invoice sama wywołuje showPage
+# między nimi); ostatnia strona zostaje otwarta, jak przy fakturze jednostronicowej.
+# Canvas reportlab trzyma wszystkie te strony w pamięci do save() – dla faktur
+# z bardzo wieloma pozycjami mniej pamięci zużywa zapis bezpośredni (DirectCanvas).
+def draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account):
+    width, height = A4
+    forms = _page_forms(c, seller_name, seller_address, seller_nip, seller_bank_account)
+    # Dane sprzedawcy – blok ma stałą wysokość (6 wierszy po 12 pt)
+    y_start = height - 50
+    if forms is not None:
+        _stamp_form(c, forms + "Seller")
+        c.setFont("DejaVuSans", 10)
+    else:
+        _draw_seller(c, seller_name, seller_address, seller_nip, seller_bank_account)
+    y = y_start - 15 - 6 * 12
+
+    # Dane nabywcy (etykieta "Nabywca:" jest rysowana razem z danymi sprzedawcy)
+    buyer_name_lines = wrap_text(inv.buyer_name or "", "DejaVuSans", 10, BUYER_WIDTH)
+    buyer_addr_lines = wrap_text(inv.buyer_addr or "", "DejaVuSans", 10, BUYER_WIDTH)
+    buyer_info_lines = [*buyer_name_lines[:2], *[""] * (2 - len(buyer_name_lines)),
+                        *buyer_addr_lines[:2], *[""] * (2 - len(buyer_addr_lines))]
+    if inv.buyer_nip:
+        buyer_info_lines.append(f"NIP: {inv.buyer_nip}")
+    y_b = y_start - 15
+    for line in buyer_info_lines:
+        c.drawString(330, y_b, line)
+        y_b -= 12
+
+    # Nagłówek faktury (numer i daty)
+    header_y = min(y, y_b) - 20
+    c.setFont("DejaVuSans-Bold", 12)
+    c.drawString(50, header_y, f"Faktura VAT {inv.number}")
+    c.setFont("DejaVuSans", 10)
+    c.drawString(50, header_y - 15, f"Data wystawienia: {inv.date}")
+    c.drawString(50, header_y - 30, f"Data dostawy towarów/wykonania usługi: {inv.date_sell}")
+    if inv.due_date:
+        c.drawString(50, header_y - 45, f"Termin płatności: {inv.due_date}")
+        c.drawString(50, header_y - 60, "Forma płatności: przelew")
+
+    # Tabela pozycji faktury
+    table_y = header_y - 105
+    if forms is not None:
+        _stamp_form(c, forms + "Table", table_y)
+    else:
+        _draw_table_header(c, table_y)
+    c.setFont("DejaVuSans", 10)
+    line_y = table_y - ROW_HEIGHT
+    page_rows = 0
+    for desc, qty, unit, net_str, vat_str, gross_str in inv.lines.formatted():
+        desc_lines = wrap_text(desc, "DejaVuSans", 10, DESC_WIDTH)
+        # Wiersz jest przenoszony w całości; pierwszy wiersz strony jest rysowany zawsze,
+        # nawet gdy sam nie mieści się na stronie
+        if page_rows and line_y - WRAP_LEADING * (len(desc_lines) - 1) < BOTTOM_MARGIN:
+            line_y = _continue_invoice(c, inv, forms)
+            page_rows = 0
+        for i, text in enumerate(desc_lines):
+            c.drawString(50, line_y - i * WRAP_LEADING, text)
+        c.drawString(250, line_y, qty)
+        c.drawString(300, line_y, unit)
+        c.drawRightString(400, line_y, net_str)
+        c.drawRightString(450, line_y, vat_str)
+        c.drawRightString(540, line_y, gross_str)
+        line_y -= ROW_HEIGHT + WRAP_LEADING * (len(desc_lines) - 1)
+        page_rows += 1
+
+    totals_y = line_y - 10
+    if totals_y - 30 < BOTTOM_MARGIN:
+        totals_y = _continue_invoice(c, inv, forms) - 10
+    if forms is not None:
+        _stamp_form(c, forms + "Totals", totals_y)
+    else:
+        _draw_totals_labels(c, totals_y)
+    c.setFont("DejaVuSans", 10)
+    c.drawRightString(540, totals_y, format_grosze(inv.net_total))
+    c.drawRightString(540, totals_y - 15, format_grosze(inv.vat_total))
+    c.drawRightString(540, totals_y - 30, format_grosze(inv.gross_total))
+
+# Tryb powtarzalnego wyniku: reportlab nie zapisuje bieżącej daty ani losowego
+# identyfikatora dokumentu, więc te same dane dają identyczne bajty PDF
+_reproducible = False
+
+def set_reproducible(enabled):
+    global _reproducible
+    _reproducible = bool(enabled)
+
+def is_reproducible():
+    return _reproducible
+
+# Sposób zapisu PDF: "reportlab" (reportlab.pdfgen.canvas) albo "direct" –
+# bezpośredni zapis strumieni treści (jpkfatopdfemit.DirectCanvas), szybszy przy
+# dużej liczbie faktur
+BACKENDS = ("reportlab", "direct")
+_backend = "reportlab"
+
+def set_backend(name):
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f"Nieznany sposób zapisu PDF: {name}")
+    _backend = name
+
+def get_backend():
+    return _backend
+
+# page_forms=True – stałe elementy stron jako formularze (dokumenty z wieloma fakturami;
+# tylko reportlab – DirectCanvas ma stałe teksty zakodowane z góry)
+def new_canvas(target, page_forms=False):
+    if _backend == "direct":
+        from jpkfatopdfemit import DirectCanvas
+        return DirectCanvas(target, pagesize=A4, invariant=_reproducible)
+    from reportlab.pdfgen import canvas
+    register_fonts()
+    c = canvas.Canvas(target, pagesize=A4, invariant=int(_reproducible))
+    if page_forms:
+        c._jpk_page_forms = {}
+    return c
+
+# Nazwa pliku PDF dla pojedynczej faktury
+def invoice_filename(inv):
+    return f"Faktura_{inv.number.replace('/', '_')}.pdf"
+
+# Zapis jednej faktury do osobnego pliku PDF – zwraca ścieżkę pliku.
+# Z podaną pamięcią podręczną (InvoiceCache) plik jest kopiowany z niej, jeśli to możliwe.
+def render_invoice_file(inv, seller_name, seller_address, seller_nip, seller_bank_account, output_dir, cache=None):
+    pdf_path = os.path.join(output_dir, invoice_filename(inv))
+    if cache is not None:
+        data = render_invoice_bytes(inv, seller_name, seller_address, seller_nip, seller_bank_account, cache)
+        with atomic_output(pdf_path) as f:
+            f.write(data)
+        return pdf_path
+    with atomic_output(pdf_path) as f:
+        c = new_canvas(f)
+        with timed_stage("draw"):
+            draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
+            c.showPage()
+        with timed_stage("save"):
+            c.save()
+    return pdf_path
+
+# Renderowanie jednej faktury do pamięci – zwraca bajty pliku PDF
+def render_invoice_bytes(inv, seller_name, seller_address, seller_nip, seller_bank_account, cache=None):
+    if cache is not None:
+        key = invoice_cache_key(inv, seller_name, seller_address, seller_nip, seller_bank_account, _reproducible,
+                                _backend)
+        data = cache.get(key)
+        if data is not None:
+            return data
+    buffer = io.BytesIO()
+    c = new_canvas(buffer)
+    with timed_stage("draw"):
+        draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
+        c.showPage()
+    with timed_stage("save"):
+        c.save()
+    data = buffer.getvalue()
+    if cache is not None:
+        cache.put(key, data)
+    return data
+
+# Liczba faktur i pozycji w jednej części pliku zbiorczego renderowanej przez
+# reportlab (reportlab trzyma wszystkie strony dokumentu w pamięci aż do canvas.save)
+SINGLE_CHUNK_SIZE = 500
+SINGLE_CHUNK_ROWS = 10000
+
+# Podział faktur na części: najwyżej SINGLE_CHUNK_SIZE faktur i SINGLE_CHUNK_ROWS
+# pozycji w części. Faktura nie jest dzielona – ta o większej liczbie pozycji
+# tworzy osobną część, której strony reportlab trzyma w pamięci w całości.
+def _single_chunks(invoices):
+    chunk, rows = [], 0
+    for inv in invoices:
+        if chunk and (len(chunk) == SINGLE_CHUNK_SIZE or rows + len(inv.lines) > SINGLE_CHUNK_ROWS):
+            yield chunk
+            chunk, rows = [], 0
+        chunk.append(inv)
+        rows += len(inv.lines)
+    if chunk:
+        yield chunk
+
+# Zapis wszystkich faktur do jednego pliku PDF (każda faktura od nowej strony)
+# Opcjonalne progress(done, total) jest wywoływane po każdej fakturze.
+# Pamięć nie rośnie z liczbą faktur: DirectCanvas zapisuje gotowe strony od razu,
+# a przy reportlab faktury są renderowane częściami (_single_chunks), dopisywanymi
+# do pliku przez PdfMerger (ze wspólnym podzbiorem czcionek, jak w render_single_parallel).
+# Ograniczenie: przy reportlab wszystkie strony jednej faktury są w pamięci naraz,
+# więc pamięć rośnie z liczbą pozycji największej faktury (DirectCanvas tego nie ma).
+# Plik powstaje przez atomic_output – przerwany przebieg nie zostawia uciętego PDF.
+def render_single_file(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path, progress=None):
+    seller = (seller_name, seller_address, seller_nip, seller_bank_account)
+    chunks = [invoices] if _backend == "direct" else list(_single_chunks(invoices))
+    if len(chunks) <= 1:
+        with atomic_output(pdf_path) as f:
+            c = new_canvas(f, page_forms=True)
+            _draw_invoices(c, invoices, seller, progress)
+            with timed_stage("save"):
+                c.save()
+        return pdf_path
+    charset = collect_charset(invoices, *seller)
+    with atomic_output(pdf_path) as f:
+        merger = PdfMerger(f)
+        start = 0
+        for chunk in chunks:
+            data = render_chunk_bytes(chunk, seller, charset, None if progress is None else
+                                      lambda done, _: progress(start + done, len(invoices)))
+            with timed_stage("merge"):
+                merger.add_document(data)
+            start += len(chunk)
+        with timed_stage("merge"):
+            merger.close()
+    return pdf_path
+
+def _draw_invoices(c, invoices, seller, progress=None):
+    for done, inv in enumerate(invoices, 1):
+        with timed_stage("draw"):
+            draw_invoice(c, inv, *seller)
+            c.showPage()
+        if progress is not None:
+            progress(done, len(invoices))
+
+# Część pliku zbiorczego jako osobny dokument PDF (bajty) z czcionkami
+# zainicjowanymi zestawem znaków całego pliku
+def render_chunk_bytes(invoices, seller, charset, progress=None):
+    buffer = io.BytesIO()
+    c = new_canvas(buffer, page_forms=True)
+    seed_fonts(c, charset)
+    _draw_invoices(c, invoices, seller, progress)
+    with timed_stage("save"):
+        c.save()
+    return buffer.getvalue()
+
+# Stałe teksty układu faktury (wchodzą do zestawu znaków każdej części dokumentu)
+LAYOUT_TEXT = ("Sprzedawca: Nabywca: NIP: Numer rachunku bankowego: Faktura VAT Data wystawienia: "
+               "Data dostawy towarów/wykonania usługi: Termin płatności: Forma płatności: przelew "
+               "Opis towaru/usługi Ilość Jedn. Netto VAT 23% Brutto "
+               "Suma netto PLN: Suma VAT 23% PLN: Suma brutto PLN: – ciąg dalszy -.0123456789")
+
+# Zestaw wszystkich znaków, które pojawią się na stronach faktur (posortowany)
+def collect_charset(invoices, *texts):
+    chars = set(LAYOUT_TEXT)
+    for text in texts:
+        chars.update(text or "")
+    for inv in invoices:
+        for key in ("number", "date", "date_sell", "due_date", "buyer_name", "buyer_addr", "buyer_nip"):
+            chars.update(getattr(inv, key) or "")
+        for desc, qty, unit, *_ in inv.lines:
+            chars.update(desc or "")
+            chars.update(qty or "")
+            chars.update(unit or "")
+    return "".join(sorted(chars))
+
+# Wstępne przypisanie kodów znaków w podzbiorach czcionek DejaVu.
+# Części dokumentu renderowane niezależnie (w osobnych procesach) z tym samym
+# zestawem znaków dostają identyczne podzbiory czcionek i te same nazwy zasobów,
+# dzięki czemu po połączeniu plik zawiera jedną kopię każdego podzbioru.
+def seed_fonts(c, charset):
+    if _backend == "direct":
+        c.seed_charset(charset)
+        return
+    from reportlab.pdfbase import pdfmetrics
+    doc = c._doc
+    for name in ("DejaVuSans", "DejaVuSans-Bold"):
+        font = pdfmetrics.getFont(name)
+        font.splitString(charset, doc)
+        font.getSubsetInternalName(0, doc)
+
+# Kontekst procesu roboczego – dane wspólne dla wszystkich faktur w puli
+_worker_context = None
+
+def _init_worker(seller_name, seller_address, seller_nip, seller_bank_account, output_dir=None, charset=None,
+                 cache=None, reproducible=False, backend="reportlab"):
+    global _worker_context
+    register_fonts()
+    set_reproducible(reproducible)
+    set_backend(backend)
+    _worker_context = {
+        "seller": (seller_name, seller_address, seller_nip, seller_bank_account),
+        "output_dir": output_dir,
+        "charset": charset,
+        "cache": cache,
+    }
+
+# Wyniki procesów roboczych niosą informację o trafieniu w pamięć podręczną,
+# aby liczniki trafień/chybień zgadzały się w procesie głównym
+def _cache_hit(cache, hits_before):
+    return cache is not None and cache.hits > hits_before
+
+def _render_invoice_worker(inv):
+    cache = _worker_context["cache"]
+    hits_before = cache.hits if cache is not None else 0
+    path = render_invoice_file(inv, *_worker_context["seller"], _worker_context["output_dir"], cache)
+    return path, _cache_hit(cache, hits_before)
+
+def _render_bytes_worker(inv):
+    cache = _worker_context["cache"]
+    hits_before = cache.hits if cache is not None else 0
+    data = render_invoice_bytes(inv, *_worker_context["seller"], cache)
+    return data, _cache_hit(cache, hits_before)
+
+# Uwzględnienie w pamięci podręczne procesu głównego wyników z puli procesów
+def _count_cache_result(cache, hit):
+    if cache is not None:
+        cache.record(hit)
+
+def _render_chunk_worker(chunk):
+    return render_chunk_bytes(chunk, _worker_context["seller"], _worker_context["charset"])
+
+def _pool_size(jobs):
+    if jobs <= 0:
+        return os.cpu_count() or 1
+    return jobs
+
+# Równoległe generowanie osobnych plików PDF w puli procesów.
+# Każdy proces rejestruje czcionki raz, faktury są przekazywane paczkami.
+# Zwraca listę ścieżek w kolejności faktur.
+def render_separate_parallel(invoices, seller_name, seller_address, seller_nip, seller_bank_account, output_dir, jobs,
+                             cache=None):
+    jobs = _pool_size(jobs)
+    chunksize = max(1, len(invoices) // (jobs * 4))
+    paths = []
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(seller_name, seller_address, seller_nip, seller_bank_account, output_dir,
+                                       None, cache, _reproducible, _backend)) as executor:
+        for path, hit in executor.map(_render_invoice_worker, invoices, chunksize=chunksize):
+            _count_cache_result(cache, hit)
+            paths.append(path)
+    if cache is not None:
+        cache.evict()
+    return paths
+
+# Tryb przyrostowy osobnych plików PDF (manifest – jpkfatopdfcache.OutputManifest):
+# renderowane są tylko faktury nowe, zmienione lub bez pliku w `output_dir`,
+# a pliki faktur, których nie ma już w danych, są usuwane. Przy powtórzonym
+# numerze liczy się ostatnia faktura (jej plik zastępuje wcześniejsze).
+# Zwraca (liczba wyrenderowanych, bez zmian, usuniętych).
+def render_incremental(invoices, seller_name, seller_address, seller_nip, seller_bank_account, output_dir, manifest,
+                       jobs=1, cache=None):
+    current = {}
+    for inv in invoices:
+        key = invoice_cache_key(inv, seller_name, seller_address, seller_nip, seller_bank_account, _reproducible,
+                                _backend)
+        current[inv.number] = (inv, invoice_filename(inv), key)
+    changed = [inv for number, (inv, filename, key) in current.items()
+               if manifest.entries.get(number) != (filename, key)
+               or not os.path.exists(os.path.join(output_dir, filename))]
+    if jobs != 1 and changed:
+        render_separate_parallel(changed, seller_name, seller_address, seller_nip, seller_bank_account, output_dir,
+                                 jobs, cache)
+    else:
+        for inv in changed:
+            render_invoice_file(inv, seller_name, seller_address, seller_nip, seller_bank_account, output_dir, cache)
+
+    in_use = {filename for _, filename, _ in current.values()}
+    removed = 0
+    for number, (filename, _) in manifest.entries.items():
+        # Tylko pliki wprost w folderze wyników, nawet gdy manifest zmieniono ręcznie
+        if number in current or filename in in_use or filename != os.path.basename(filename):
+            continue
+        try:
+            os.remove(os.path.join(output_dir, filename))
+            removed += 1
+        except OSError:
+            pass
+    manifest.entries = {number: (filename, key) for number, (_, filename, key) in current.items()}
+    manifest.save()
+    return len(changed), len(current) - len(changed), removed
+
+# Kolejne faktury wyrenderowane do pamięci – zwraca pary (faktura, bajty PDF)
+# w kolejności faktur. Przy jobs różnym od 1 renderuje pula procesów, ale
+# w toku jest najwyżej 2 * jobs faktur, więc pamięć nie rośnie, gdy odbiorca
+# (np. klient HTTP) pobiera wyniki wolniej, niż są generowane.
+def iter_rendered_invoices(invoices, seller_name, seller_address, seller_nip, seller_bank_account, jobs=1, cache=None):
+    if jobs == 1:
+        for inv in invoices:
+            yield inv, render_invoice_bytes(inv, seller_name, seller_address, seller_nip, seller_bank_account, cache)
+        return
+    jobs = _pool_size(jobs)
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(seller_name, seller_address, seller_nip, seller_bank_account,
+                                       None, None, cache, _reproducible, _backend)) as executor:
+        pending = deque()
+        for inv in invoices:
+            pending.append((inv, executor.submit(_render_bytes_worker, inv)))
+            if len(pending) >= 2 * jobs:
+                done_inv, future = pending.popleft()
+                data, hit = future.result()
+                _count_cache_result(cache, hit)
+                yield done_inv, data
+        while pending:
+            done_inv, future = pending.popleft()
+            data, hit = future.result()
+            _count_cache_result(cache, hit)
+            yield done_inv, data
+    if cache is not None:
+        cache.evict()
+
+# Minimalna liczba faktur w jednej części dokumentu renderowanej przez proces roboczy
+MIN_CHUNK_SIZE = 50
+
+# Równoległe generowanie jednego pliku PDF: ciągłe fragmenty listy faktur są
+# renderowane w puli procesów, a gotowe części dopisywane do pliku w kolejności
+# faktur (PdfMerger), ze wspólnym podzbiorem czcionek. progress(done, total)
+# jest wywoływane po dopisaniu każdej części.
+def render_single_parallel(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path, jobs,
+                           progress=None):
+    if not invoices:
+        return render_single_file(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path)
+    jobs = _pool_size(jobs)
+    chunk_size = max(MIN_CHUNK_SIZE, -(-len(invoices) // (jobs * 4)))
+    chunks = [invoices[i:i + chunk_size] for i in range(0, len(invoices), chunk_size)]
+    charset = collect_charset(invoices, seller_name, seller_address, seller_nip, seller_bank_account)
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(seller_name, seller_address, seller_nip, seller_bank_account,
+                                       None, charset, None, _reproducible, _backend)) as executor:
+        with atomic_output(pdf_path) as f:
+            merger = PdfMerger(f)
+            done = 0
+            for chunk, data in zip(chunks, executor.map(_render_chunk_worker, chunks)):
+                with timed_stage("merge"):
+                    merger.add_document(data)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, len(invoices))
+            with timed_stage("merge"):
+                merger.close()
+    return pdf_path
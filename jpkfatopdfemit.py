@@ -0,0 +1,224 @@
+import zlib
+import hashlib
+import time
+from functools import lru_cache
+
+from jpkfatopdfcore import A4, register_fonts, glyph_widths
+from jpkfatopdfmerge import PdfObjectWriter
+
+# Bezpośredni zapis PDF dla stałego układu faktury (set_backend("direct") w jpkfatopdfcore).
+#
+# DirectCanvas ma tylko te metody reportlab.pdfgen.canvas.Canvas, których używa
+# draw_invoice (setFont, drawString, drawRightString, showPage, save), i zapisuje
+# strumienie treści stron wprost, bez obiektów pośrednich reportlab:
+# - tekst jest kodowany przez słownik znak -> kod w podzbiorze czcionki; znaki
+#   BASE_CHARSET mają kody przypisane raz na proces, wspólne dla wszystkich dokumentów,
+# - szerokości do wyrównania do prawej pochodzą z tablic szerokości glifów (glyph_widths),
+# - obiekty czcionek (podzbiór TTF, ToUnicode, szerokości) są budowane raz dla
+#   danego zestawu znaków i kopiowane do każdego dokumentu, który go używa.
+# Znaki spoza BASE_CHARSET dostają w dokumencie kolejne kody, więc te same dane
+# zawsze dają ten sam plik. Gotowe strony są od razu zapisywane do pliku wynikowego;
+# czcionki, drzewo stron i tablica xref trafiają na koniec pliku w save(), więc
+# pamięć nie rośnie z liczbą stron (poza 8 bajtami pozycji na obiekt). Zapis obiektów,
+# drzewa stron i xref jest wspólny z PdfMerger (jpkfatopdfmerge.PdfObjectWriter).
+# Z reportlab korzystamy tylko przy budowie podzbiorów czcionek
+# (TTFontFile.makeSubset, makeToUnicodeCMap).
+
+# Znaki z kodami przypisanymi z góry: ASCII, polskie litery i typowe symbole
+BASE_CHARSET = "".join(map(chr, range(32, 127))) + "ąćęłńóśźżĄĆĘŁŃÓŚŹŻ–—„”“’«»§°×€"
+
+# Znaków w jednym podzbiorze czcionki (kody jednobajtowe; kod 0 to brak glifu)
+SUBSET_SIZE = 256
+
+def _num(value):
+    if value == int(value):
+        return b"%d" % value
+    return (b"%.2f" % value).rstrip(b"0")
+
+# Kody znaków jednej czcionki: wspólne dla procesu (BASE_CHARSET) albo kopia
+# rozszerzona o znaki konkretnego dokumentu
+class _FontCodes:
+    __slots__ = ("font", "codes", "chars", "shared")
+
+    def __init__(self, font, codes, chars, shared):
+        self.font = font
+        self.codes = codes  # znak -> kod (numer podzbioru * 256 + bajt)
+        self.chars = chars  # kod -> punkt kodowy znaku (0 – brak glifu)
+        self.shared = shared
+
+    def add(self, char):
+        if self.shared:
+            self.codes = dict(self.codes)
+            self.chars = list(self.chars)
+            self.shared = False
+        if char == "\xa0":
+            code = self.codes.get(" ") or self.add(" ")
+        elif ord(char) not in self.font.face.charToGlyph:
+            code = 0
+        else:
+            code = len(self.chars)
+            if code % SUBSET_SIZE == 0:
+                self.chars.append(0)
+                code += 1
+            self.chars.append(ord(char))
+        self.codes[char] = code
+        return code
+
+_base_codes = {}
+
+def _font_codes(font_name):
+    base = _base_codes.get(font_name)
+    if base is None:
+        from reportlab.pdfbase import pdfmetrics
+        base = _FontCodes(pdfmetrics.getFont(font_name), {}, [0], False)
+        for char in BASE_CHARSET:
+            base.add(char)
+        base.chars = tuple(base.chars)
+        _base_codes[font_name] = base
+    return _FontCodes(base.font, base.codes, base.chars, True)
+
+# Obiekty PDF podzbioru czcionki dla danego zestawu znaków: szablony słowników
+# czcionki i deskryptora (z miejscami na numery obiektów) oraz gotowe strumienie
+# ToUnicode i pliku czcionki
+@lru_cache(maxsize=64)
+def _subset_objects(font_name, chars):
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import makeToUnicodeCMap
+    face = pdfmetrics.getFont(font_name).face
+    subset = list(chars)
+    tag = bytes(b"ABCDEFGHIJKLMNOP"[n >> 4] for n in hashlib.sha1(repr(chars).encode("ascii")).digest()[:6])
+    base_font = tag + b"+" + face.name + face.subfontNameX
+    widths = b" ".join(_num(face.getCharWidth(code)) for code in subset)
+    font = (b"<< /BaseFont /" + base_font + b" /FirstChar 0 /FontDescriptor %d 0 R /LastChar " +
+            b"%d" % (len(subset) - 1) + b" /Subtype /TrueType /ToUnicode %d 0 R /Type /Font /Widths [ " +
+            widths + b" ] >>")
+    cmap = zlib.compress(makeToUnicodeCMap(base_font.decode("latin-1"), subset).encode("latin-1"))
+    to_unicode = b"<< /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream" % (len(cmap), cmap)
+    flags = (face.flags & ~(1 << 5)) | (1 << 2)  # czcionka symboliczna, jak w reportlab
+    descriptor = (b"<< /Ascent %s /CapHeight %s /Descent %s /Flags %d /FontBBox [ %s ] /FontFile2 %%d 0 R "
+                  b"/FontName /%s /ItalicAngle %s /MissingWidth %s /StemV %s /Type /FontDescriptor >>" %
+                  (_num(face.ascent), _num(face.capHeight), _num(face.descent), flags,
+                   b" ".join(_num(v) for v in face.bbox), base_font, _num(face.italicAngle),
+                   _num(face.defaultWidth), _num(face.stemV)))
+    data = face.makeSubset(subset)
+    packed = zlib.compress(data)
+    font_file = b"<< /Filter /FlateDecode /Length %d /Length1 %d >>\nstream\n%s\nendstream" % (
+        len(packed), len(data), packed)
+    return font, to_unicode, descriptor, font_file
+
+class DirectCanvas(PdfObjectWriter):
+    def __init__(self, target, pagesize=A4, invariant=False):
+        register_fonts()
+        self._pagesize = pagesize
+        self._invariant = invariant
+        self._fonts = {}  # nazwa czcionki -> (numer czcionki w dokumencie, _FontCodes)
+        self._font = None
+        self._font_index = 0
+        self._widths = None
+        self._size = 0
+        self._active = None  # (czcionka, podzbiór, rozmiar) ustawione w bieżącym bloku tekstu
+        self._content = []
+        if hasattr(target, "write"):
+            out, self._close = target, False
+        else:
+            out, self._close = open(target, "wb"), True
+        super().__init__(out, 5)  # 1 – katalog, 2 – drzewo stron, 3 – informacje, 4 – zasoby
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    # Wstępne przypisanie kodów znakom spoza BASE_CHARSET (jak seed_fonts dla reportlab) –
+    # części dokumentu z tym samym zestawem znaków mają identyczne obiekty czcionek
+    def seed_charset(self, charset):
+        for name in ("DejaVuSans", "DejaVuSans-Bold"):
+            codes = self._font_entry(name)[1]
+            for char in charset:
+                if char not in codes.codes:
+                    codes.add(char)
+
+    def _font_entry(self, name):
+        entry = self._fonts.get(name)
+        if entry is None:
+            entry = self._fonts[name] = (len(self._fonts) + 1, _font_codes(name))
+        return entry
+
+    def setFont(self, name, size):
+        self._font_index, self._font = self._font_entry(name)
+        self._widths = glyph_widths(name)
+        self._size = size
+
+    def drawString(self, x, y, text):
+        self._text(x, y, text)
+
+    def drawRightString(self, x, y, text):
+        self._text(x - sum(map(self._widths.__getitem__, text)) * self._size / 1000, y, text)
+
+    def _text(self, x, y, text):
+        codes = self._font.codes
+        content = self._content
+        if not content:
+            content.append(b"BT\n")
+        content.append(b"1 0 0 1 " + _num(x) + b" " + _num(y) + b" Tm\n")
+        try:
+            runs = ((0, bytes(map(codes.__getitem__, text))),)
+        except (KeyError, ValueError):
+            runs = self._encode(text)
+        for subset, data in runs:
+            key = (self._font_index, subset, self._size)
+            if key != self._active:
+                content.append(b"/F%d+%d %s Tf\n" % (self._font_index, subset, _num(self._size)))
+                self._active = key
+            content.append(b"<" + data.hex().encode("ascii") + b"> Tj\n")
+
+    # Podział tekstu na fragmenty w kolejnych podzbiorach czcionki (z dopisaniem nowych znaków)
+    def _encode(self, text):
+        font = self._font
+        runs = []
+        for char in text:
+            code = font.codes.get(char)
+            if code is None:
+                code = font.add(char)
+            if runs and runs[-1][0] == code >> 8:
+                runs[-1][1].append(code & 0xFF)
+            else:
+                runs.append((code >> 8, bytearray([code & 0xFF])))
+        return [(subset, bytes(data)) for subset, data in runs]
+
+    def showPage(self):
+        content = self._content
+        if content:
+            content.append(b"ET\n")
+        stream = zlib.compress(b"".join(content))
+        contents_num = self._new_num()
+        self._write_object(contents_num, b"<< /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream" %
+                           (len(stream), stream))
+        width, height = self._pagesize
+        page_num = self._new_num()
+        self._write_object(page_num, b"<< /Contents %d 0 R /MediaBox [ 0 0 %s %s ] /Parent 2 0 R "
+                                     b"/Resources 4 0 R /Type /Page >>" % (contents_num, _num(width), _num(height)))
+        self.pages.append(page_num)
+        self._content = []
+        self._active = None
+
+    def save(self):
+        if self._content or not self.pages:
+            self.showPage()
+        resources = []
+        for name, (index, codes) in self._fonts.items():
+            chars = tuple(codes.chars)
+            for subset in range(0, len(chars), SUBSET_SIZE):
+                font, to_unicode, descriptor, font_file = _subset_objects(name, chars[subset:subset + SUBSET_SIZE])
+                font_num, to_unicode_num, descriptor_num, font_file_num = (self._new_num() for _ in range(4))
+                self._write_object(font_num, font % (descriptor_num, to_unicode_num))
+                self._write_object(to_unicode_num, to_unicode)
+                self._write_object(descriptor_num, descriptor % font_file_num)
+                self._write_object(font_file_num, font_file)
+                resources.append(b"/F%d+%d %d 0 R" % (index, subset // SUBSET_SIZE, font_num))
+        self._write_object(4, b"<< /Font << " + b" ".join(resources) + b" >> /ProcSet [ /PDF /Text ] >>")
+        self._write_page_tree(b"<< /Count %d /Kids [ ", b"] /Type /Pages >>")
+        self._write_object(1, b"<< /Pages 2 0 R /Type /Catalog >>")
+        info = b"<< /Producer (jpkfatopdf)"
+        if not self._invariant:
+            info += b" /CreationDate (D:" + time.strftime("%Y%m%d%H%M%S").encode("ascii") + b")"
+        self._write_object(3, info + b" >>")
+        self._write_xref(b"trailer\n<< /ID [<%s><%s>] /Info 3 0 R /Root 1 0 R /Size %d >>\n")
+        if self._close:
+            self.out.close()
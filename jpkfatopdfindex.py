@@ -0,0 +1,149 @@
+import io
+import re
+import html
+import mmap
+import time
+import xml.etree.ElementTree as ET
+
+from jpkfatopdfcore import add_stage_time, parse_jpk_xml
+from jpkfatopdfmodel import parse_grosze
+
+# Indeks pozycji bajtowych faktur w pliku JPK-29-AN.
+#
+# Plik jest przeglądany raz (mmap, wyrażenia regularne na bajtach, bez parsera XML)
+# i dla każdej faktury zapamiętywany jest zakres bajtów elementu Faktura oraz
+# zakresy jej elementów FakturaWiersz (według P_2A / P_2B). Pojedynczą fakturę
+# można potem wczytać, parsując tylko te fragmenty – złożone w mały dokument
+# z oryginalnym początkiem pliku (deklaracja XML, element główny z przestrzeniami
+# nazw) i sekcją Podmiot1 – zwykłym parserem z jpkfatopdfcore.
+#
+# Indeks zakłada kodowanie zgodne z ASCII (UTF-8, windows-1250, ISO-8859-2);
+# znaczniki w komentarzach i sekcjach CDATA nie są rozpoznawane jako takie.
+
+_ROOT_START = re.compile(rb"<([^\s?!/>]+)[^>]*>")
+_ENCODING = re.compile(rb"<\?xml[^>]*encoding\s*=\s*[\"']([A-Za-z0-9._-]+)[\"']")
+_JPK_NS = re.escape(b"http://jpk.mf.gov.pl/wzor/2022/02/17/02171/")
+_JPK_PREFIX = re.compile(rb"xmlns(?::([^\s=]+))?\s*=\s*[\"']" + _JPK_NS + rb"[\"']")
+
+class JpkIndex:
+    def __init__(self, path):
+        self.path = path
+        self.prolog = b""  # początek pliku do końca znacznika otwierającego element główny
+        self.epilog = b""  # znacznik zamykający element główny
+        self.encoding = "utf-8"
+        self.podmiot = None  # zakres (początek, koniec) sekcji Podmiot1
+        self.faktury = {}  # numer faktury -> zakres elementu Faktura (pierwszego o tym numerze)
+        self.wiersze = {}  # numer faktury -> lista zakresów elementów FakturaWiersz
+        self.duplicates = {}  # numer faktury -> liczba elementów Faktura o tym numerze (gdy więcej niż 1)
+        self.totals = None  # numer faktury -> (netto, VAT, brutto) w groszach, jeśli zbierano sumy
+
+    def __len__(self):
+        return len(self.faktury)
+
+    def __contains__(self, number):
+        return number in self.faktury
+
+    def numbers(self):
+        return list(self.faktury)
+
+    # Mały dokument JPK z sekcją Podmiot1, podanymi fakturami i ich pozycjami
+    def fragment(self, numbers):
+        ranges = [self.podmiot] if self.podmiot is not None else []
+        ranges += [self.faktury[number] for number in numbers]
+        for number in numbers:
+            ranges += self.wiersze.get(number, ())
+        with open(self.path, "rb") as f:
+            parts = [self.prolog]
+            for start, stop in ranges:
+                f.seek(start)
+                parts.append(f.read(stop - start))
+            parts.append(self.epilog)
+        return b"\n".join(parts)
+
+# Budowa indeksu pliku (jedno przejście przez plik zmapowany w pamięci). Z totals=True
+# zapamiętywane są też sumy z nagłówków faktur (P_13_1, P_14_1, P_15).
+# Zgłasza ET.ParseError, gdy w pliku nie ma elementu głównego.
+def build_index(path, totals=False):
+    start = time.perf_counter()
+    index = JpkIndex(path)
+    if totals:
+        index.totals = {}
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # pusty plik
+            raise ET.ParseError("brak elementu głównego w pliku XML")
+    with mm:
+        root = _ROOT_START.search(mm)
+        if root is None:
+            raise ET.ParseError("brak elementu głównego w pliku XML")
+        index.prolog = mm[:root.end()]
+        index.epilog = b"</" + root.group(1) + b">"
+        encoding = _ENCODING.search(index.prolog)
+        if encoding is not None:
+            index.encoding = encoding.group(1).decode("ascii")
+        namespace = _JPK_PREFIX.search(root.group(0))
+        if namespace is not None:
+            prefix = re.escape(namespace.group(1) + b":") if namespace.group(1) else b""
+            _scan(mm, root.end(), prefix, index)
+    add_stage_time("index", time.perf_counter() - start, len(index))
+    return index
+
+def _scan(mm, pos, prefix, index):
+    tags = re.compile(rb"<(/?)" + prefix + rb"(Podmiot1|FakturaWiersz|Faktura)(?=[\s/>])")
+    fields = {
+        b"Faktura": re.compile(rb"<" + prefix + rb"P_2A(?:\s[^>]*)?>([^<]*)<"),
+        b"FakturaWiersz": re.compile(rb"<" + prefix + rb"P_2B(?:\s[^>]*)?>([^<]*)<"),
+    }
+    sums = [re.compile(rb"<" + prefix + field + rb"(?:\s[^>]*)?>([^<]*)<") for field in (b"P_13_1", b"P_14_1", b"P_15")]
+    decode = index.encoding
+    open_tag = None
+    open_start = 0
+    for m in tags.finditer(mm, pos):
+        name = m.group(2)
+        if not m.group(1):
+            open_tag, open_start = name, m.start()
+            continue
+        if name != open_tag:
+            continue
+        stop = mm.find(b">", m.end()) + 1
+        open_tag = None
+        if name == b"Podmiot1":
+            if index.podmiot is None:
+                index.podmiot = (open_start, stop)
+            continue
+        field = fields[name].search(mm, open_start, stop)
+        if field is None:
+            continue
+        number = html.unescape(field.group(1).decode(decode))
+        if name == b"Faktura":
+            if number in index.faktury:
+                index.duplicates[number] = index.duplicates.get(number, 1) + 1
+            else:
+                index.faktury[number] = (open_start, stop)
+                if index.totals is not None:
+                    index.totals[number] = tuple(_amount(pattern.search(mm, open_start, stop)) for pattern in sums)
+        else:
+            index.wiersze.setdefault(number, []).append((open_start, stop))
+
+def _amount(match):
+    return parse_grosze(match.group(1).decode("ascii", "replace") if match is not None else "")
+
+# Wczytanie wybranych faktur z indeksu (bez parsowania reszty pliku) – zwraca dane
+# sprzedawcy i listę faktur w kolejności `numbers`. Zgłasza LookupError, gdy
+# którejś faktury nie ma w pliku. Problemy jak w parse_jpk_xml trafiają do `issues`.
+def read_invoices(index, numbers, issues=None):
+    numbers = list(dict.fromkeys(numbers))
+    missing = [number for number in numbers if number not in index]
+    if missing:
+        raise LookupError(f"Brak faktur w pliku: {', '.join(missing)}")
+    if issues is not None:
+        for number in numbers:
+            if number in index.duplicates:
+                issues.append(f"Numer faktury {number} występuje {index.duplicates[number]} razy – "
+                              f"użyto pierwszej z nich.")
+    return parse_jpk_xml(io.BytesIO(index.fragment(numbers)), issues)
+
+# Wczytanie wybranych faktur z pliku: budowa indeksu i parsowanie tylko ich fragmentów
+def parse_jpk_invoices(path, numbers, issues=None):
+    return read_invoices(build_index(path), numbers, issues)
@@ -0,0 +1,264 @@
+import os
+import json
+import hashlib
+import time
+import uuid
+import shutil
+import socket
+import threading
+
+# Kolejka zadań generowania PDF oparta na plikach (bez zewnętrznych usług).
+#
+# Każde zadanie to katalog <root>/<id> z plikiem job.json (stan, postęp, wynik)
+# oraz plikami wejściowymi/wynikowymi. Kolejność zadań wyznaczają puste pliki
+# znacznikowe w <root>/queue; proces roboczy przejmuje zadanie, przenosząc
+# znacznik (os.rename) do <root>/running, co jest atomowe również wtedy,
+# gdy z tej samej kolejki korzysta kilka procesów usługi. Znacznik w running
+# zawiera właściciela (host i PID) i jest regularnie odświeżany; zadania, których
+# proces zakończył pracę w trakcie wykonywania, są oznaczane jako nieudane.
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# Co ile sekund odświeżane są znaczniki wykonywanych zadań i usuwane przeterminowane zadania
+CLEANUP_INTERVAL = 60
+
+# Po ilu sekundach bez odświeżenia znacznika w running zadanie uznaje się za porzucone
+STALE_AFTER = 5 * CLEANUP_INTERVAL
+
+STALE_ERROR = "Przerwane – proces usługi zakończył pracę w trakcie wykonywania zadania."
+
+# Zapis pliku JSON w sposób atomowy (czytelnik nigdy nie widzi połowy pliku)
+def _write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# Właściciel przejętego zadania (PID sprawdzany przy każdym użyciu – proces mógł się rozwidlić)
+def _owner():
+    return f"{socket.gethostname()} {os.getpid()}"
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class JobQueue:
+    # handler(job_dir, params, progress) wykonuje zadanie i zwraca nazwę pliku
+    # wynikowego w job_dir; progress(done, total) raportuje postęp.
+    def __init__(self, root, handler, workers=2, ttl=3600, poll_interval=1.0):
+        self.root = os.path.abspath(root)
+        self.handler = handler
+        self.workers = workers
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.queue_dir = os.path.join(root, "queue")
+        self.running_dir = os.path.join(root, "running")
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.RLock()
+        self._active = set()  # znaczniki zadań wykonywanych przez ten proces
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    # Uruchomienie wątków roboczych i wątku porządkującego (jednokrotnie).
+    # Zadania pozostawione w running przez poprzednie uruchomienie tego procesu
+    # są od razu oznaczane jako nieudane.
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            os.makedirs(self.queue_dir, exist_ok=True)
+            os.makedirs(self.running_dir, exist_ok=True)
+            self._recover_stale(startup=True)
+            for target in [self._maintenance_loop] + [self._worker_loop] * self.workers:
+                thread = threading.Thread(target=target, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # Utworzenie zadania – save_input(job_dir) zapisuje dane wejściowe do katalogu zadania
+    def submit(self, params, save_input):
+        self.start()
+        job_id = uuid.uuid4().hex
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir)
+        save_input(job_dir)
+        now = time.time()
+        _write_json(os.path.join(job_dir, "job.json"), {
+            "id": job_id,
+            "status": STATUS_QUEUED,
+            "params": params,
+            "done": 0,
+            "total": None,
+            "created": now,
+            "finished": None,
+            "result": None,
+            "sha256": None,
+            "error": None,
+        })
+        # Nazwa znacznika zaczyna się od czasu utworzenia – sortowanie daje kolejność FIFO
+        open(os.path.join(self.queue_dir, f"{now:017.6f}_{job_id}"), "w").close()
+        self._wakeup.set()
+        return job_id
+
+    # Stan zadania (słownik z job.json) lub None, gdy zadanie nie istnieje
+    def status(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.job_dir(job_id), "job.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # Liczba zadań oczekujących i wykonywanych (także przez inne procesy usługi)
+    def counts(self):
+        def count(directory):
+            try:
+                return len(os.listdir(directory))
+            except OSError:
+                return 0
+        return count(self.queue_dir), count(self.running_dir)
+
+    def _update(self, job_dir, **changes):
+        path = os.path.join(job_dir, "job.json")
+        with open(path, encoding="utf-8") as f:
+            job = json.load(f)
+        job.update(changes)
+        _write_json(path, job)
+        return job
+
+    # Przejęcie najstarszego zadania z kolejki – zwraca nazwę znacznika lub None
+    def _claim(self):
+        for marker in sorted(os.listdir(self.queue_dir)):
+            path = os.path.join(self.running_dir, marker)
+            try:
+                os.rename(os.path.join(self.queue_dir, marker), path)
+            except OSError:
+                continue  # zadanie przejął inny wątek lub proces
+            with self._lock:
+                self._active.add(marker)
+            try:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(_owner())
+            except OSError:
+                pass
+            return marker
+        return None
+
+    # Odświeżanie znaczników wykonywanych zadań i okresowe porządki
+    def _maintenance_loop(self):
+        while True:
+            with self._lock:
+                active = list(self._active)
+            for marker in active:
+                try:
+                    os.utime(os.path.join(self.running_dir, marker))
+                except OSError:
+                    pass
+            self.cleanup()
+            time.sleep(CLEANUP_INTERVAL)
+
+    # Oznaczenie jako nieudanych zadań porzuconych przez proces, który zakończył
+    # pracę w ich trakcie: znacznik nieodświeżany dłużej niż STALE_AFTER, a przy
+    # starcie także znacznik z właścicielem równym bieżącemu procesowi (ten sam
+    # PID po ponownym uruchomieniu, np. w kontenerze). Zadanie nie wraca do
+    # kolejki, bo jego plik wejściowy mógł już zostać usunięty.
+    def _recover_stale(self, startup=False):
+        now = time.time()
+        try:
+            markers = os.listdir(self.running_dir)
+        except OSError:
+            return
+        for marker in markers:
+            with self._lock:
+                if marker in self._active:
+                    continue
+            path = os.path.join(self.running_dir, marker)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    owner = f.read()
+                stale = now - os.stat(path).st_mtime > STALE_AFTER or (startup and owner == _owner())
+            except OSError:
+                continue
+            if not stale:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # zadanie odzyskał inny proces
+            try:
+                self._update(self.job_dir(marker.split("_", 1)[1]), status=STATUS_FAILED, error=STALE_ERROR,
+                             finished=now)
+            except (OSError, ValueError):
+                pass
+
+    def _worker_loop(self):
+        while True:
+            marker = self._claim()
+            if marker is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(marker)
+
+    def _run(self, marker):
+        job_id = marker.split("_", 1)[1]
+        job_dir = self.job_dir(job_id)
+        try:
+            job = self._update(job_dir, status=STATUS_RUNNING)
+            last_update = [0.0]
+
+            def progress(done, total):
+                # Zapis postępu najwyżej kilka razy na sekundę
+                now = time.time()
+                if done == total or now - last_update[0] >= 0.2:
+                    last_update[0] = now
+                    self._update(job_dir, done=done, total=total)
+
+            result = self.handler(job_dir, job["params"], progress)
+            self._update(job_dir, status=STATUS_DONE, result=result, sha256=_file_sha256(os.path.join(job_dir, result)),
+                         finished=time.time())
+        except Exception as e:
+            try:
+                self._update(job_dir, status=STATUS_FAILED, error=str(e), finished=time.time())
+            except OSError:
+                pass
+        finally:
+            try:
+                os.remove(os.path.join(self.running_dir, marker))
+            except OSError:
+                pass
+            with self._lock:
+                self._active.discard(marker)
+
+    # Usunięcie zadań zakończonych dawniej niż ttl sekund temu (po oznaczeniu
+    # porzuconych jako nieudane) oraz niezakończonych zadań bez znacznika
+    # w queue ani running, utworzonych dawniej niż ttl sekund temu
+    def cleanup(self):
+        self._recover_stale()
+        now = time.time()
+        try:
+            entries = os.listdir(self.root)
+            markers = os.listdir(self.queue_dir) + os.listdir(self.running_dir)
+        except OSError:
+            return
+        pending = {marker.split("_", 1)[1] for marker in markers if "_" in marker}
+        for job_id in entries:
+            if job_id in ("queue", "running"):
+                continue
+            job = self.status(job_id)
+            if job is None:
+                continue
+            if job["finished"] is None:
+                expired = job_id not in pending and now - job["created"] > self.ttl
+            else:
+                expired = now - job["finished"] > self.ttl
+            if expired:
+                shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
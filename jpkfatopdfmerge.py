@@ -0,0 +1,173 @@
+import re
+import hashlib
+from array import array
+from itertools import chain
+
+# Łączenie dokumentów PDF wygenerowanych przez reportlab w jeden plik.
+# Strony kolejnych części są dopisywane do pliku wyjściowego od razu,
+# a obiekty wspólne (czcionki, ich podzbiory, słowniki zasobów) są zapisywane
+# tylko raz – identyczne obiekty z różnych części są rozpoznawane po treści.
+# Drzewo stron, katalog i tablica xref są zapisywane na końcu w close().
+
+_REF_RE = re.compile(rb"(\d+) 0 R")
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+_ROOT_RE = re.compile(rb"/Root (\d+) 0 R")
+_INFO_RE = re.compile(rb"/Info (\d+) 0 R")
+_PAGES_RE = re.compile(rb"/Pages (\d+) 0 R")
+_KIDS_RE = re.compile(rb"/Kids \[([^\]]*)\]")
+_CONTENTS_RE = re.compile(rb"/Contents (\d+) 0 R")
+
+# Wczytanie obiektów dokumentu – zwraca (nagłówek, {numer: treść}, trailer).
+# Treść obiektu to bajty pomiędzy "N 0 obj\n" a "endobj".
+def read_pdf_objects(data):
+    startxref = int(_STARTXREF_RE.findall(data)[-1])
+    xref_end = data.index(b"trailer", startxref)
+    entries = data[startxref:xref_end].split(b"\n")
+    # xref\n0 N\n0000000000 65535 f \n...
+    first = int(entries[1].split()[0])
+    offsets = {}
+    for num, entry in enumerate(entries[2:], first):
+        parts = entry.split()
+        if len(parts) == 3 and parts[2] == b"n":
+            offsets[num] = int(parts[0])
+    bounds = sorted(offsets.items(), key=lambda item: item[1])
+    objects = {}
+    for i, (num, start) in enumerate(bounds):
+        end = bounds[i + 1][1] if i + 1 < len(bounds) else startxref
+        chunk = data[start:end]
+        body_start = chunk.index(b"obj") + 3
+        body_end = chunk.rindex(b"endobj")
+        objects[num] = chunk[body_start:body_end].strip(b"\r\n")
+    header = data[:bounds[0][1]] if bounds else b"%PDF-1.3\n"
+    return header, objects, data[xref_end:data.rindex(b"startxref")]
+
+# Liczba wpisów drzewa stron i tablicy xref zapisywanych naraz – przy wielu
+# stronach obie struktury nie są budowane w pamięci w całości
+WRITE_BLOCK = 4096
+
+# Odwołania do stron dla /Kids drzewa stron (kolejne bloki bajtów)
+def iter_kids(pages):
+    for start in range(0, len(pages), WRITE_BLOCK):
+        yield b"".join(b"%d 0 R " % num for num in pages[start:start + WRITE_BLOCK])
+
+# Tablica xref dla obiektów 1..len(offsets)-1 (kolejne bloki bajtów)
+def iter_xref(offsets):
+    yield b"xref\n0 %d\n0000000000 65535 f \n" % len(offsets)
+    for start in range(1, len(offsets), WRITE_BLOCK):
+        yield b"".join(b"%010d 00000 n \n" % offset for offset in offsets[start:start + WRITE_BLOCK])
+
+def _split_stream(body):
+    idx = body.find(b"stream")
+    if idx < 0:
+        return body, b""
+    return body[:idx], body[idx:]
+
+# Zapis obiektów PDF do pliku wyjściowego w kolejności numerów, z pozycjami
+# obiektów dla tablicy xref i skrótem MD5 zapisanych bajtów (/ID dokumentu).
+# Obiekty 1..reserved-1 (katalog, drzewo stron, ...) są zapisywane na końcu.
+# Wspólna podstawa PdfMerger i jpkfatopdfemit.DirectCanvas.
+class PdfObjectWriter:
+    def __init__(self, out, reserved):
+        self.out = out
+        self.offsets = array("Q", bytes(8 * reserved))  # numer obiektu -> pozycja w pliku
+        self.position = 0
+        self.next_num = reserved
+        self.pages = array("Q")
+        self.digest = hashlib.md5()
+
+    def _write(self, data):
+        self.out.write(data)
+        self.digest.update(data)
+        self.position += len(data)
+
+    # Treść obiektu to bajty albo ciąg kolejnych fragmentów bajtów
+    def _write_object(self, num, body):
+        if num == len(self.offsets):
+            self.offsets.append(self.position)
+        else:
+            self.offsets[num] = self.position
+        if isinstance(body, bytes):
+            self._write(b"%d 0 obj\n" % num + body + b"\nendobj\n")
+            return
+        self._write(b"%d 0 obj\n" % num)
+        for part in body:
+            self._write(part)
+        self._write(b"\nendobj\n")
+
+    def _new_num(self):
+        num = self.next_num
+        self.next_num += 1
+        return num
+
+    # Drzewo stron (obiekt 2); `head` zawiera miejsce na liczbę stron
+    def _write_page_tree(self, head, tail):
+        self._write_object(2, chain((head % len(self.pages),), iter_kids(self.pages), (tail,)))
+
+    # Tablica xref, trailer (`trailer` z miejscami na /ID i /Size) i startxref
+    def _write_xref(self, trailer):
+        doc_id = self.digest.hexdigest().encode("ascii")
+        xref_pos = self.position
+        for block in iter_xref(self.offsets):
+            self._write(block)
+        self._write(trailer % (doc_id, doc_id, self.next_num))
+        self._write(b"startxref\n%d\n%%%%EOF\n" % xref_pos)
+
+class PdfMerger(PdfObjectWriter):
+    def __init__(self, out):
+        super().__init__(out, 4)  # 1 – katalog, 2 – drzewo stron, 3 – informacje o dokumencie
+        self.shared = {}
+        self.info = None
+        self.header_written = False
+
+    # Przepisanie obiektu wspólnego (i wszystkich obiektów, do których się odwołuje).
+    # Identyczne obiekty z różnych części dostają ten sam numer.
+    def _copy_shared(self, num, objects, mapping):
+        if num in mapping:
+            return mapping[num]
+        dict_part, stream_part = _split_stream(objects[num])
+        dict_part = _REF_RE.sub(lambda m: b"%d 0 R" % self._copy_shared(int(m.group(1)), objects, mapping), dict_part)
+        body = dict_part + stream_part
+        key = hashlib.sha1(body).digest()
+        new_num = self.shared.get(key)
+        if new_num is None:
+            new_num = self.shared[key] = self._new_num()
+            self._write_object(new_num, body)
+        mapping[num] = new_num
+        return new_num
+
+    # Dopisanie wszystkich stron dokumentu `data` (bajty PDF z reportlab)
+    def add_document(self, data):
+        header, objects, trailer = read_pdf_objects(data)
+        if not self.header_written:
+            self._write(header)
+            self.header_written = True
+        root = int(_ROOT_RE.search(trailer).group(1))
+        info = _INFO_RE.search(trailer)
+        if self.info is None and info is not None:
+            self.info = objects[int(info.group(1))]
+        pages = int(_PAGES_RE.search(objects[root]).group(1))
+        kids = [int(n) for n in _REF_RE.findall(_KIDS_RE.search(objects[pages]).group(1))]
+        mapping = {}
+        for page in kids:
+            body = objects[page]
+            # Strumień treści strony jest unikalny – zapisujemy go bez sprawdzania duplikatów
+            contents = _CONTENTS_RE.search(body)
+            if contents is not None:
+                contents_num = self._new_num()
+                self._write_object(contents_num, objects[int(contents.group(1))])
+                mapping[int(contents.group(1))] = contents_num
+            # Odwołanie /Parent wskazuje od teraz na wspólne drzewo stron (obiekt 2)
+            body = _REF_RE.sub(lambda m: b"%d 0 R" % (2 if int(m.group(1)) == pages else
+                                                      self._copy_shared(int(m.group(1)), objects, mapping)), body)
+            page_num = self._new_num()
+            self._write_object(page_num, body)
+            self.pages.append(page_num)
+
+    # Zapis drzewa stron, katalogu, informacji o dokumencie i tablicy xref
+    def close(self):
+        if not self.header_written:
+            raise ValueError("Brak stron do zapisania")
+        self._write_page_tree(b"<<\n/Count %d /Kids [ ", b"] /Type /Pages\n>>")
+        self._write_object(1, b"<<\n/PageMode /UseNone /Pages 2 0 R /Type /Catalog\n>>")
+        self._write_object(3, self.info or b"<<\n>>")
+        self._write_xref(b"trailer\n<<\n/ID \n[<%s><%s>]\n/Info 3 0 R\n/Root 1 0 R\n/Size %d\n>>\n")
@@ -0,0 +1,102 @@
+import threading
+
+# Metryki usługi w formacie tekstowym Prometheus (bez zewnętrznych bibliotek).
+#
+# Liczniki są wspólne dla wszystkich wątków jednego procesu usługi; przy kilku
+# procesach (np. gunicorn) każdy z nich udostępnia własne wartości.
+
+# Granice przedziałów histogramu czasu odpowiedzi (sekundy)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+class ServiceMetrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.requests = {}  # (endpoint, metoda, kod) -> liczba żądań
+        self.latency = {}  # (endpoint, metoda) -> [liczniki przedziałów, suma, liczba]
+        self.invoices_rendered = 0
+        self.bytes_out = 0
+
+    def observe_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[(endpoint, method)] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def add_invoices(self, count):
+        with self._lock:
+            self.invoices_rendered += count
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.bytes_out += count
+
+    # Przekazanie fragmentów odpowiedzi strumieniowej z jednoczesnym zliczaniem bajtów
+    def count_bytes(self, chunks):
+        try:
+            for chunk in chunks:
+                self.add_bytes(len(chunk))
+                yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    # Tekst dla Prometheusa; gauges to słownik nazwa -> (opis, wartość),
+    # stages to czasy etapów przetwarzania (etap -> (sekundy, liczba wykonań))
+    def render(self, gauges=None, stages=None):
+        out = []
+        with self._lock:
+            out.append("# HELP jpkfatopdf_requests_total Liczba obsłużonych żądań HTTP.")
+            out.append("# TYPE jpkfatopdf_requests_total counter")
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                out.append(f"jpkfatopdf_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}")
+
+            out.append("# HELP jpkfatopdf_request_duration_seconds Czas obsługi żądania (łącznie z wysłaniem odpowiedzi).")
+            out.append("# TYPE jpkfatopdf_request_duration_seconds histogram")
+            for (endpoint, method), (counts, total, count) in sorted(self.latency.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _labels(endpoint=endpoint, method=method, le=repr(float(bound)))
+                    out.append(f"jpkfatopdf_request_duration_seconds_bucket{labels} {bucket_count}")
+                labels = _labels(endpoint=endpoint, method=method, le="+Inf")
+                out.append(f"jpkfatopdf_request_duration_seconds_bucket{labels} {count}")
+                labels = _labels(endpoint=endpoint, method=method)
+                out.append(f"jpkfatopdf_request_duration_seconds_sum{labels} {total}")
+                out.append(f"jpkfatopdf_request_duration_seconds_count{labels} {count}")
+
+            out.append("# HELP jpkfatopdf_invoices_rendered_total Liczba wygenerowanych faktur.")
+            out.append("# TYPE jpkfatopdf_invoices_rendered_total counter")
+            out.append(f"jpkfatopdf_invoices_rendered_total {self.invoices_rendered}")
+
+            out.append("# HELP jpkfatopdf_response_bytes_total Liczba bajtów wysłanych w odpowiedziach.")
+            out.append("# TYPE jpkfatopdf_response_bytes_total counter")
+            out.append(f"jpkfatopdf_response_bytes_total {self.bytes_out}")
+
+        for name, (description, value) in (gauges or {}).items():
+            out.append(f"# HELP {name} {description}")
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value}")
+
+        if stages is not None:
+            out.append("# HELP jpkfatopdf_stage_seconds_total Łączny czas etapów przetwarzania.")
+            out.append("# TYPE jpkfatopdf_stage_seconds_total counter")
+            for stage, (seconds, _) in sorted(stages.items()):
+                out.append(f"jpkfatopdf_stage_seconds_total{_labels(stage=stage)} {seconds}")
+            out.append("# HELP jpkfatopdf_stage_runs_total Liczba wykonań etapów przetwarzania.")
+            out.append("# TYPE jpkfatopdf_stage_runs_total counter")
+            for stage, (_, count) in sorted(stages.items()):
+                out.append(f"jpkfatopdf_stage_runs_total{_labels(stage=stage)} {count}")
+        return "\n".join(out) + "\n"
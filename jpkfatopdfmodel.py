@@ -0,0 +1,193 @@
+from array import array
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from itertools import accumulate, starmap
+
+# Model danych faktur wspólny dla CLI, GUI i usługi.
+#
+# Faktura to obiekt Invoice ze stałym zestawem pól (__slots__, bez słownika
+# dla każdego obiektu), z sumami w groszach. Pozycje nie są osobnymi obiektami:
+# pozycje całego dokumentu są trzymane w kolumnach (LineStore) – opis, ilość
+# i jednostka jako listy napisów, a kwoty netto, VAT i brutto jako tablice
+# liczb całkowitych w groszach (array 'q'). Kwoty są liczone dokładnie (bez
+# float), VAT pozycji jest wyliczany dla całej kolumny naraz w finish(),
+# a faktura odwołuje się do swoich pozycji przez widok InvoiceLines (zakres
+# wierszy w magazynie), który przy odczycie zwraca obiekty InvoiceLine.
+
+# Wartość oznaczająca brak kwoty lub kwotę, której nie da się odczytać
+MISSING = -(2 ** 63)
+
+_HUNDRED = Decimal(100)
+_ONE = Decimal(1)
+
+# Kwota z pliku JPK ("123.45") jako liczba groszy; więcej niż dwa miejsca po przecinku
+# są zaokrąglane do grosza (połówki w górę). Zwraca MISSING dla pustej lub błędnej kwoty.
+def parse_grosze(text):
+    if not text:
+        return MISSING
+    text = text.strip()
+    whole, _, frac = text.partition(".")
+    digits = whole[1:] if whole[:1] == "-" else whole
+    if digits.isdigit() and len(frac) <= 2 and (not frac or frac.isdigit()):
+        value = int(digits) * 100 + int(frac.ljust(2, "0"))
+        return -value if whole[:1] == "-" else value
+    try:
+        return int((Decimal(text) * _HUNDRED).quantize(_ONE, rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return MISSING
+
+# Liczba groszy jako kwota z dwoma miejscami po przecinku (pusty napis dla MISSING)
+def format_grosze(value):
+    if value == MISSING:
+        return ""
+    if value < 0:
+        return f"-{-value // 100}.{-value % 100:02d}"
+    return f"{value // 100}.{value % 100:02d}"
+
+# Pojedyncza pozycja faktury – tworzona dopiero przy odczycie z magazynu kolumnowego
+InvoiceLine = namedtuple("InvoiceLine", "desc qty unit net vat gross")
+
+def _vat_column(net, gross):
+    if MISSING not in net and MISSING not in gross:
+        return array("q", map(int.__sub__, gross, net))
+    return array("q", (MISSING if n == MISSING or g == MISSING else g - n for n, g in zip(net, gross)))
+
+# Sumy narastające kolumny kwot (brakujące kwoty liczone jako 0)
+def _prefix_sums(column):
+    if MISSING in column:
+        column = (0 if value == MISSING else value for value in column)
+    return array("q", accumulate(column, initial=0))
+
+class LineStore:
+    def __init__(self):
+        self.desc = []
+        self.qty = []
+        self.unit = []
+        self.net = array("q")
+        self.gross = array("q")
+        self.vat = array("q")
+        self.owner = array("q")  # numer kolejny faktury, do której należy pozycja
+        self.counts = []  # liczba pozycji każdej faktury
+        self.starts = []  # początek pozycji faktury (po finish)
+        self._grouped = True
+
+    # Rejestracja kolejnej faktury – zwraca jej numer kolejny w magazynie
+    def new_invoice(self):
+        self.counts.append(0)
+        return len(self.counts) - 1
+
+    # Dopisanie pozycji faktury `owner` (kwoty w groszach, patrz parse_grosze)
+    def add(self, owner, desc, qty, unit, net, gross):
+        if self.owner and owner < self.owner[-1]:
+            self._grouped = False
+        self.owner.append(owner)
+        self.counts[owner] += 1
+        self.desc.append(desc)
+        self.qty.append(qty)
+        self.unit.append(unit)
+        self.net.append(net)
+        self.gross.append(gross)
+
+    # Zakończenie wczytywania: pozycje każdej faktury są układane w ciągły zakres
+    # (z zachowaniem kolejności z pliku), a kolumna VAT jest wyliczana dla wszystkich
+    # pozycji naraz. Zwraca listę widoków InvoiceLines w kolejności faktur.
+    def finish(self):
+        if not self._grouped:
+            order = sorted(range(len(self.owner)), key=self.owner.__getitem__)
+            self.desc = [self.desc[i] for i in order]
+            self.qty = [self.qty[i] for i in order]
+            self.unit = [self.unit[i] for i in order]
+            self.net = array("q", (self.net[i] for i in order))
+            self.gross = array("q", (self.gross[i] for i in order))
+            self._grouped = True
+        self.owner = array("q")
+        self.vat = _vat_column(self.net, self.gross)
+        self.starts = list(accumulate(self.counts, initial=0))[:-1]
+        return [InvoiceLines(self, start, start + count) for start, count in zip(self.starts, self.counts)]
+
+    # Uzgodnienie sum pozycji z sumami z nagłówków faktur. `expected` to lista
+    # krotek (netto, VAT, brutto) w groszach dla kolejnych faktur. Różnica do
+    # jednego grosza na pozycję jest dopuszczalna (zaokrąglenia VAT).
+    # Zwraca listę (numer kolejny faktury, kolumna, suma pozycji, suma z nagłówka).
+    def reconcile(self, expected):
+        mismatches = []
+        sums = [_prefix_sums(self.net), _prefix_sums(self.vat), _prefix_sums(self.gross)]
+        for owner, (start, count, totals) in enumerate(zip(self.starts, self.counts, expected)):
+            if not count:
+                continue
+            stop = start + count
+            for column, prefix, total in zip(("net", "vat", "gross"), sums, totals):
+                if total == MISSING:
+                    continue
+                actual = prefix[stop] - prefix[start]
+                if abs(actual - total) > count:
+                    mismatches.append((owner, column, actual, total))
+        return mismatches
+
+# Pozycje jednej faktury – widok zakresu wierszy magazynu. Iteracja zwraca krotki
+# InvoiceLine (opis, ilość, jednostka, netto, VAT, brutto) z kwotami w groszach.
+class InvoiceLines:
+    __slots__ = ("store", "start", "stop")
+
+    def __init__(self, store, start, stop):
+        self.store = store
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        store, start, stop = self.store, self.start, self.stop
+        return starmap(InvoiceLine, zip(store.desc[start:stop], store.qty[start:stop], store.unit[start:stop],
+                                        store.net[start:stop], store.vat[start:stop], store.gross[start:stop]))
+
+    # Wiersze do wydruku ze sformatowanymi kwotami – zwracane leniwie, więc faktura
+    # z bardzo wieloma pozycjami nie tworzy naraz wszystkich wierszy tekstu
+    def formatted(self):
+        store, start, stop = self.store, self.start, self.stop
+        return zip(store.desc[start:stop], store.qty[start:stop], store.unit[start:stop],
+                   map(format_grosze, store.net[start:stop]), map(format_grosze, store.vat[start:stop]),
+                   map(format_grosze, store.gross[start:stop]))
+
+    # Przy przekazywaniu do procesu roboczego serializowane są tylko pozycje tej faktury
+    def __reduce__(self):
+        return lines_from_rows, (list(self),)
+
+# Widok pozycji utworzony z gotowych wierszy (opis, ilość, jednostka, netto, VAT, brutto)
+def lines_from_rows(rows):
+    store = LineStore()
+    owner = store.new_invoice()
+    for desc, qty, unit, net, _, gross in rows:
+        store.add(owner, desc, qty, unit, net, gross)
+    return store.finish()[0]
+
+# Wspólny pusty widok dla faktur bez pozycji (tylko do odczytu)
+NO_LINES = lines_from_rows([])
+
+# Nagłówek faktury: numer, daty, dane nabywcy, sumy netto/VAT/brutto w groszach
+# (MISSING, gdy brak kwoty) i pozycje (InvoiceLines)
+class Invoice:
+    __slots__ = ("number", "date", "date_sell", "due_date", "buyer_name", "buyer_addr", "buyer_nip",
+                 "net_total", "vat_total", "gross_total", "lines")
+
+    def __init__(self, number, date, date_sell, due_date, buyer_name, buyer_addr, buyer_nip, net_total, vat_total,
+                 gross_total, lines=NO_LINES):
+        self.number = number
+        self.date = date
+        self.date_sell = date_sell
+        self.due_date = due_date
+        self.buyer_name = buyer_name
+        self.buyer_addr = buyer_addr
+        self.buyer_nip = buyer_nip
+        self.net_total = net_total
+        self.vat_total = vat_total
+        self.gross_total = gross_total
+        self.lines = lines
+
+    # Wartości wszystkich pól w kolejności __slots__ (np. do klucza pamięci podręcznej)
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"Invoice({self.number!r}, lines={len(self.lines)})"
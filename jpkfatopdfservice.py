@@ -3,28 +3,74 @@ import io
 import shutil
 import zipfile
 import configparser
-import textwrap
-from datetime import datetime, timedelta
+import hashlib
+import json
+import time
+import tempfile
+from datetime import datetime
 import xml.etree.ElementTree as ET
 
-from flask import Flask, request, render_template_string, send_file, flash, redirect, url_for, after_this_request
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from flask import Flask, Response, g, jsonify, request, render_template_string, send_file, flash, redirect, url_for, after_this_request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, Data, Epilogue, Field, File
+
+import jpkfatopdfcore
+from jpkfatopdfjobs import JobQueue, STATUS_DONE
+from jpkfatopdfcache import InvoiceCache, DEFAULT_MAX_BYTES, LAYOUT_VERSION
+from jpkfatopdfmetrics import ServiceMetrics
+from jpkfatopdfindex import parse_jpk_invoices, read_invoices
+from jpkfatopdfuploads import UploadStore
+from jpkfatopdfmodel import format_grosze
+from jpkfatopdfcore import (set_reproducible, is_reproducible, timed_stage, scan_jpk_header, invoice_filename, render_invoice_file, render_single_file,
+                            render_invoice_bytes, render_separate_parallel, render_single_parallel, iter_rendered_invoices)
 
 # Konfiguracja
 CONFIG_FILE = "config.ini"
 DEFAULT_BANK_ACCOUNT = "Santander (SWIFT: WBKPPLPP), 84 1090 1098 0000 0001 5295 9691"
 DEFAULT_OUTPUT_DIR = "faktury"
-
-# Rejestracja czcionek – upewnij się, że pliki TTF są w tym samym folderze
-pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
-pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', 'DejaVuSans-Bold.ttf'))
+DEFAULT_RENDER_JOBS = 1  # liczba procesów renderujących (0 - wszystkie rdzenie)
+DEFAULT_STREAM_ZIP = True  # tryb 'separate': archiwum ZIP wysyłane strumieniowo w trakcie renderowania
+DEFAULT_ZIP_LEVEL = 0  # 0 - bez kompresji (PDF są już skompresowane), 1-9 - poziom kompresji deflate
+DEFAULT_JOBS_DIR = os.path.join(DEFAULT_OUTPUT_DIR, "jobs")  # kolejka zadań asynchronicznych
+DEFAULT_JOB_WORKERS = 2  # maksymalna liczba zadań wykonywanych jednocześnie
+DEFAULT_JOB_TTL = 3600  # czas (s) przechowywania wyników zakończonych zadań
+DEFAULT_REPRODUCIBLE = True  # powtarzalne bajty PDF/ZIP – wymagane do nagłówków ETag
+DEFAULT_CACHE_DIR = ""  # katalog pamięci podręcznej faktur (pusty - wyłączona)
+DEFAULT_CACHE_SIZE_MB = DEFAULT_MAX_BYTES // (1024 * 1024)
+DEFAULT_UPLOADS_DIR = os.path.join(DEFAULT_OUTPUT_DIR, "uploads")  # pliki do pobierania pojedynczych faktur
+DEFAULT_UPLOAD_TTL = 3600  # czas (s) przechowywania przesłanych plików
+DEFAULT_MAX_UPLOAD_MB = 512  # największy rozmiar żądania z plikiem XML (wszystkie trasy)
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"  # wymagane do obsługi flash messages
 
+# Metryki usługi udostępniane pod /metrics
+metrics = ServiceMetrics()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+# Czas żądania jest liczony do zakończenia wysyłania odpowiedzi (także strumieniowej)
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or "unknown"
+    method = request.method
+    start = g.get("request_start", time.perf_counter())
+    if response.direct_passthrough:
+        # Plik (send_file) przekazywany wprost serwerowi – funkcje call_on_close nie są wtedy wywoływane
+        metrics.add_bytes(response.content_length or 0)
+        metrics.observe_request(endpoint, method, response.status_code, time.perf_counter() - start)
+        return response
+    if response.content_length is not None:
+        metrics.add_bytes(response.content_length)
+    else:
+        response.response = metrics.count_bytes(response.response)
+    response.call_on_close(lambda: metrics.observe_request(endpoint, method, response.status_code,
+                                                           time.perf_counter() - start))
+    return response
+
 # Funkcje konfiguracji
 def load_config():
     config = configparser.ConfigParser()
@@ -35,225 +81,121 @@ def load_config():
         bank_account = DEFAULT_BANK_ACCOUNT
     return bank_account
 
+def load_render_jobs():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    return config.getint("Settings", "render_jobs", fallback=DEFAULT_RENDER_JOBS)
+
+def load_zip_settings():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    stream = config.getboolean("Settings", "stream_zip", fallback=DEFAULT_STREAM_ZIP)
+    level = config.getint("Settings", "zip_level", fallback=DEFAULT_ZIP_LEVEL)
+    return stream, level
+
+def load_job_settings():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    jobs_dir = config.get("Settings", "jobs_dir", fallback=DEFAULT_JOBS_DIR)
+    workers = config.getint("Settings", "job_workers", fallback=DEFAULT_JOB_WORKERS)
+    ttl = config.getint("Settings", "job_ttl", fallback=DEFAULT_JOB_TTL)
+    return jobs_dir, workers, ttl
+
+def load_upload_settings():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    uploads_dir = config.get("Settings", "uploads_dir", fallback=DEFAULT_UPLOADS_DIR)
+    ttl = config.getint("Settings", "upload_ttl", fallback=DEFAULT_UPLOAD_TTL)
+    return uploads_dir, ttl
+
+def load_max_upload_bytes():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    return config.getint("Settings", "max_upload_mb", fallback=DEFAULT_MAX_UPLOAD_MB) * 1024 * 1024
+
+# Limit rozmiaru żądania jest odczytywany raz, przy starcie usługi, i obowiązuje
+# wszystkie trasy: te korzystające z request.files (/invoice, /uploads, /jobs)
+# odrzucają żądanie z większym Content-Length przed odczytem i zapisem treści,
+# a bez Content-Length – po przekroczeniu limitu w trakcie odbierania; formularz
+# główny (/) sprawdza ten sam limit w UploadStream
+app.config["MAX_CONTENT_LENGTH"] = load_max_upload_bytes()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    return jsonify({"error": f"Plik jest za duży (limit {limit_mb} MB)."}), 413
+
+def load_reproducible():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    return config.getboolean("Settings", "reproducible", fallback=DEFAULT_REPRODUCIBLE)
+
+invoice_cache = None
+
+# Pamięć podręczna wyrenderowanych faktur (None, gdy nie skonfigurowano cache_dir)
+def get_invoice_cache():
+    global invoice_cache
+    if invoice_cache is None:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        cache_dir = config.get("Settings", "cache_dir", fallback=DEFAULT_CACHE_DIR)
+        if not cache_dir:
+            return None
+        size_mb = config.getint("Settings", "cache_size_mb", fallback=DEFAULT_CACHE_SIZE_MB)
+        invoice_cache = InvoiceCache(cache_dir, size_mb * 1024 * 1024)
+    return invoice_cache
+
 def save_config(bank_account):
     config = configparser.ConfigParser()
-    config["Settings"] = {"bank_account": bank_account}
+    config.read(CONFIG_FILE)  # zachowujemy pozostałe ustawienia
+    if not config.has_section("Settings"):
+        config.add_section("Settings")
+    config.set("Settings", "bank_account", bank_account)
     with open(CONFIG_FILE, "w") as configfile:
         config.write(configfile)
 
-# Funkcja rysująca fakturę na stronie PDF
-def draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account):
-    width, height = A4
-    c.setFont("DejaVuSans", 10)
-    # Dane sprzedawcy
-    y_start = height - 50
-    c.drawString(50, y_start, "Sprzedawca:")
-    seller_info_lines = [
-        seller_name,
-        seller_address,
-        f"NIP: {seller_nip}",
-        "",
-        "Numer rachunku bankowego:",
-        seller_bank_account
-    ]
-    y = y_start - 15
-    for line in seller_info_lines:
-        c.drawString(60, y, line)
-        y -= 12
-
-    # Dane nabywcy
-    c.drawString(320, y_start, "Nabywca:")
-    buyer_name_lines = textwrap.wrap(inv["buyer_name"], width=36) if inv["buyer_name"] else [""]
-    if len(buyer_name_lines) < 2:
-        buyer_name_lines.append("")
-    buyer_addr_lines = textwrap.wrap(inv["buyer_addr"], width=36) if inv["buyer_addr"] else [""]
-    if len(buyer_addr_lines) < 2:
-        buyer_addr_lines.append("")
-    buyer_info_lines = buyer_name_lines[:2] + buyer_addr_lines[:2]
-    if inv["buyer_nip"]:
-        buyer_info_lines.append(f"NIP: {inv['buyer_nip']}")
-    y_b = y_start - 15
-    for line in buyer_info_lines:
-        c.drawString(330, y_b, line)
-        y_b -= 12
-
-    # Nagłówek faktury (numer i daty)
-    header_y = min(y, y_b) - 20
-    c.setFont("DejaVuSans-Bold", 12)
-    c.drawString(50, header_y, f"Faktura VAT {inv['number']}")
-    c.setFont("DejaVuSans", 10)
-    c.drawString(50, header_y - 15, f"Data wystawienia: {inv['date']}")
-    c.drawString(50, header_y - 30, f"Data dostawy towarów/wykonania usługi: {inv['date_sell']}")
-    if inv["due_date"]:
-        c.drawString(50, header_y - 45, f"Termin płatności: {inv['due_date']}")
-        c.drawString(50, header_y - 60, "Forma płatności: przelew")
-
-    # Tabela pozycji faktury
-    table_y = header_y - 105
-    c.setFont("DejaVuSans-Bold", 10)
-    c.drawString(50, table_y, "Opis towaru/usługi")
-    c.drawString(250, table_y, "Ilość")
-    c.drawString(300, table_y, "Jedn.")
-    c.drawString(350, table_y, "Netto")
-    c.drawString(420, table_y, "VAT 23%")
-    c.drawString(480, table_y, "Brutto")
-    c.setFont("DejaVuSans", 10)
-    line_y = table_y - 15
-    for item in inv["lines"]:
-        c.drawString(50, line_y, item["desc"])
-        c.drawString(250, line_y, item["qty"])
-        c.drawString(300, line_y, item["unit"])
-        net_str = f"{float(item['net_line']):.2f}"
-        vat_str = f"{float(item['vat_line']):.2f}" if item["vat_line"] else ""
-        gross_str = f"{float(item['gross_line']):.2f}"
-        c.drawRightString(400, line_y, net_str)
-        c.drawRightString(450, line_y, vat_str)
-        c.drawRightString(540, line_y, gross_str)
-        line_y -= 15
-
-    totals_y = line_y - 10
-    c.setFont("DejaVuSans-Bold", 10)
-    c.drawString(300, totals_y, "Suma netto PLN:")
-    c.drawString(300, totals_y - 15, "Suma VAT 23% PLN:")
-    c.drawString(300, totals_y - 30, "Suma brutto PLN:")
-    c.setFont("DejaVuSans", 10)
-    c.drawRightString(540, totals_y, f"{float(inv['net_total']):.2f}")
-    c.drawRightString(540, totals_y - 15, f"{float(inv['vat_total']):.2f}")
-    c.drawRightString(540, totals_y - 30, f"{float(inv['gross_total']):.2f}")
-
-# Funkcja parsująca plik XML JPK-29-AN
-def parse_jpk_xml(xml_path):
+# Funkcja parsująca plik XML JPK-29-AN (strumieniowo, patrz jpkfatopdfcore)
+def parse_jpk_xml(xml_path, issues=None):
     try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-    except Exception as e:
+        return jpkfatopdfcore.parse_jpk_xml(xml_path, issues)
+    except (ET.ParseError, OSError) as e:
         raise Exception(f"Nie można wczytać pliku XML: {e}")
 
-    ns = {
-        "jp": "http://jpk.mf.gov.pl/wzor/2022/02/17/02171/",
-        "etd": "http://crd.gov.pl/xml/schematy/dziedzinowe/mf/2018/08/24/eD/DefinicjeTypy/"
-    }
-
-    # Dane sprzedawcy
-    seller_name = None
-    seller_address = None
-    seller_nip = None
-
-    podmiot = root.find("jp:Podmiot1", ns)
-    if podmiot is not None:
-        nip_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:NIP", ns)
-        name_elem = podmiot.find("jp:IdentyfikatorPodmiotu/jp:PelnaNazwa", ns)
-        addr_elem = podmiot.find("jp:AdresPodmiotu", ns)
-        if nip_elem is not None:
-            seller_nip = nip_elem.text
-        if name_elem is not None:
-            seller_name = name_elem.text
-        if addr_elem is not None:
-            country = addr_elem.find("etd:KodKraju", ns)
-            street = addr_elem.find("etd:Ulica", ns)
-            bld = addr_elem.find("etd:NrDomu", ns)
-            unit = addr_elem.find("etd:NrLokalu", ns)
-            city = addr_elem.find("etd:Miejscowosc", ns)
-            postcode = addr_elem.find("etd:KodPocztowy", ns)
-            addr_parts = []
-            if street is not None:
-                addr_parts.append(street.text + (" " + bld.text if bld is not None else "") + ("/" + unit.text if unit is not None else ""))
-            if postcode is not None and city is not None:
-                addr_parts.append(postcode.text + " " + city.text)
-            seller_address = ", ".join(addr_parts)
-            if country is not None and country.text and country.text.upper() != "PL":
-                seller_address += ", " + country.text
-
-    invoices = []
-    for faktura in root.findall("jp:Faktura", ns):
-        inv_number = faktura.find("jp:P_2A", ns).text
-        issue_date = faktura.find("jp:P_1", ns).text
-        sell_date = faktura.find("jp:P_6", ns).text
-        buyer_name = faktura.find("jp:P_3A", ns).text
-        buyer_addr = faktura.find("jp:P_3B", ns).text
-        if seller_name is None:
-            seller_name = faktura.find("jp:P_3C", ns).text
-        if seller_address is None:
-            seller_address = faktura.find("jp:P_3D", ns).text
-        if seller_nip is None:
-            seller_nip = faktura.find("jp:P_4B", ns).text
-        buyer_nip_elem = faktura.find("jp:P_5B", ns)
-        buyer_nip = buyer_nip_elem.text if buyer_nip_elem is not None else ""
-        net_total = faktura.find("jp:P_13_1", ns).text
-        vat_total = faktura.find("jp:P_14_1", ns).text
-        gross_total = faktura.find("jp:P_15", ns).text
-        try:
-            issue_dt = datetime.strptime(issue_date, "%Y-%m-%d")
-            due_date = (issue_dt + timedelta(days=7)).strftime("%Y-%m-%d")
-        except Exception:
-            due_date = ""
-
-        invoices.append({
-            "number": inv_number,
-            "date": issue_date,
-            "date_sell": sell_date,
-            "due_date": due_date,
-            "buyer_name": buyer_name,
-            "buyer_addr": buyer_addr,
-            "buyer_nip": buyer_nip,
-            "net_total": net_total,
-            "vat_total": vat_total,
-            "gross_total": gross_total,
-            "lines": []
-        })
-
-    for line in root.findall("jp:FakturaWiersz", ns):
-        inv_num = line.find("jp:P_2B", ns).text
-        desc = line.find("jp:P_7", ns).text
-        unit = line.find("jp:P_8A", ns).text
-        qty = line.find("jp:P_8B", ns).text
-        net_line = line.find("jp:P_11", ns).text
-        gross_line = line.find("jp:P_11A", ns).text
-        try:
-            vat_line = f"{(float(gross_line) - float(net_line)):.2f}"
-        except:
-            vat_line = ""
-        for inv in invoices:
-            if inv["number"] == inv_num:
-                inv["lines"].append({
-                    "desc": desc,
-                    "qty": qty,
-                    "unit": unit,
-                    "net_line": net_line,
-                    "vat_line": vat_line,
-                    "gross_line": gross_line
-                })
-                break
-
-    return seller_name, seller_address, seller_nip, invoices
+# Szybka kontrola przesłanego pliku przed przyjęciem (początek dokumentu XML i liczba
+# faktur, bez parsowania pozycji) – zwraca komunikat błędu lub None
+def validate_upload(source):
+    try:
+        _, _, _, invoice_count = scan_jpk_header(source)
+    except (ET.ParseError, OSError) as e:
+        return f"Nie można wczytać pliku XML: {e}"
+    if invoice_count == 0:
+        return "Plik nie zawiera faktur JPK-29-AN (elementów Faktura)."
+    return None
 
 # Funkcja generująca PDF – zapisuje pliki w podanym folderze tymczasowym
 # Dla trybu 'single' zwraca ścieżkę do jednego pliku, dla 'separate' generuje wiele plików.
-def generate_pdf(seller_name, seller_address, seller_nip, invoices, seller_bank_account, output_mode, output_dir):
+# Przy jobs różnym od 1 renderowanie odbywa się w puli procesów. Pamięć podręczna
+# (InvoiceCache) jest wykorzystywana dla osobnych plików.
+def generate_pdf(seller_name, seller_address, seller_nip, invoices, seller_bank_account, output_mode, output_dir, jobs=1,
+                 cache=None):
     if output_mode == 'separate':
-        for inv in invoices:
-            inv_num = inv["number"]
-            pdf_filename = f"Faktura_{inv_num.replace('/', '_')}.pdf"
-            pdf_path = os.path.join(output_dir, pdf_filename)
-            c = canvas.Canvas(pdf_path, pagesize=A4)
-            draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
-            c.showPage()
-            c.save()
+        if jobs != 1:
+            render_separate_parallel(invoices, seller_name, seller_address, seller_nip, seller_bank_account, output_dir,
+                                     jobs, cache)
+        else:
+            for inv in invoices:
+                render_invoice_file(inv, seller_name, seller_address, seller_nip, seller_bank_account, output_dir, cache)
         return None  # w tym przypadku będziemy zipować cały folder
     else:
-        pdf_filename = "Faktury.pdf"
-        pdf_path = os.path.join(output_dir, pdf_filename)
-        c = canvas.Canvas(pdf_path, pagesize=A4)
-        for inv in invoices:
-            draw_invoice(c, inv, seller_name, seller_address, seller_nip, seller_bank_account)
-            c.showPage()
-        c.save()
-        return pdf_path
+        pdf_path = os.path.join(output_dir, "Faktury.pdf")
+        if jobs != 1:
+            return render_single_parallel(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path, jobs)
+        return render_single_file(invoices, seller_name, seller_address, seller_nip, seller_bank_account, pdf_path)
 
 # Funkcja zipująca zawartość katalogu (wszystkie wygenerowane pliki PDF) do archiwum ZIP w pamięci
 def zip_directory(directory):
     memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+    with timed_stage("zip"), zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
         for root_dir, _, files in os.walk(directory):
             for file in files:
                 file_path = os.path.join(root_dir, file)
@@ -262,6 +204,155 @@ def zip_directory(directory):
     memory_file.seek(0)
     return memory_file
 
+# Bufor zapisu dla zipfile bez możliwości przewijania – zipfile dopisuje wtedy
+# rozmiary plików w deskryptorach danych, a zapisane bajty można od razu wysłać
+class ZipStreamBuffer(io.RawIOBase):
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+# Stała data wpisów ZIP w trybie powtarzalnym (najwcześniejsza możliwa w formacie ZIP)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Generator archiwum ZIP z fakturami renderowanymi kolejno w pamięci.
+# Każdy plik PDF trafia do archiwum zaraz po wyrenderowaniu i jest od razu
+# zwracany jako fragment odpowiedzi, bez zapisu na dysk.
+def stream_invoices_zip(invoices, seller_name, seller_address, seller_nip, seller_bank_account, zip_level=0, jobs=1,
+                        progress=None, cache=None):
+    buffer = ZipStreamBuffer()
+    if zip_level:
+        zf = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=zip_level)
+    else:
+        zf = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED)
+    with zf:
+        rendered = iter_rendered_invoices(invoices, seller_name, seller_address, seller_nip, seller_bank_account, jobs,
+                                          cache)
+        for done, (inv, pdf_bytes) in enumerate(rendered, 1):
+            date_time = ZIP_DATE_TIME if is_reproducible() else time.localtime(time.time())[:6]
+            info = zipfile.ZipInfo(invoice_filename(inv), date_time=date_time)
+            info.compress_type = zf.compression
+            info.external_attr = 0o600 << 16
+            with timed_stage("zip"):
+                zf.writestr(info, pdf_bytes)
+            metrics.add_invoices(1)
+            if progress is not None:
+                progress(done, len(invoices))
+            yield buffer.take()
+    yield buffer.take()
+
+# Silny ETag odpowiedzi wyliczany ze skrótu przesłanego pliku (SHA-256, patrz
+# UploadStream) i ustawień wpływających na wynik. W trybie powtarzalnym te same
+# dane dają identyczne bajty, więc skrót wejścia identyfikuje odpowiedź jeszcze
+# przed renderowaniem.
+def upload_etag(file_sha256, *settings):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([LAYOUT_VERSION, settings, file_sha256], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+# Rozmiar porcji odczytu strumienia żądania
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Największy dopuszczalny rozmiar zwykłego pola formularza (numer rachunku, tryb itp.)
+MAX_FIELD_BYTES = 64 * 1024
+
+# Plik XML odczytywany wprost ze strumienia żądania multipart/form-data – bez
+# zapisu na dysk ani w pamięci. Obiekt plikowy dla parsera: read() zwraca kolejne
+# bajty części `file_field`, zaś pozostałe pola formularza trafiają do `form`
+# (pola wysłane po pliku są doczytywane przez finish()). Po przekroczeniu
+# max_bytes odczyt zgłasza RequestEntityTooLarge, więc zbyt duży lub błędny plik
+# jest odrzucany, zanim zostanie odebrany w całości.
+class UploadStream(io.RawIOBase):
+    def __init__(self, stream, boundary, file_field, max_bytes):
+        super().__init__()
+        self.stream = stream
+        self.decoder = MultipartDecoder(boundary)
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.form = {}
+        self.filename = None
+        self.size = 0  # odebrane bajty żądania
+        self.digest = hashlib.sha256()  # skrót zawartości pliku
+        self._buffer = bytearray()
+        self._part = None  # bieżąca część: nazwa pola, self.file_field dla pliku albo None (pomijana)
+        self._in_file = False
+        self._file_done = False
+        self._stream_done = False
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    # Odczyt do początku pliku – zwraca nazwę przesłanego pliku lub None, gdy go brak
+    def open(self):
+        while self.filename is None and not self._eof:
+            self._next()
+        return self.filename
+
+    def readinto(self, b):
+        while not self._buffer and not self._file_done and not self._eof:
+            self._next()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        del self._buffer[:n]
+        return n
+
+    # Doczytanie reszty żądania – zwraca pola formularza (napisy)
+    def finish(self):
+        while not self._eof:
+            self._next()
+            self._buffer.clear()
+        return {name: bytes(value).decode("utf-8", "replace") for name, value in self.form.items()}
+
+    def _next(self):
+        event = self.decoder.next_event()
+        if event is NEED_DATA:
+            if self._stream_done:
+                self._eof = True
+                return
+            chunk = self.stream.read(UPLOAD_CHUNK_SIZE)
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                raise RequestEntityTooLarge()
+            if chunk:
+                self.decoder.receive_data(chunk)
+            else:
+                self._stream_done = True
+                self.decoder.receive_data(None)
+        elif isinstance(event, File):
+            self._in_file = event.name == self.file_field and self.filename is None
+            self._part = None
+            if self._in_file:
+                self.filename = event.filename or ""
+        elif isinstance(event, Field):
+            self._in_file = False
+            self._part = event.name
+            self.form[event.name] = bytearray()
+        elif isinstance(event, Data):
+            if self._in_file:
+                self.digest.update(event.data)
+                self._buffer += event.data
+                if not event.more_data:
+                    self._in_file = False
+                    self._file_done = True
+            elif self._part is not None:
+                self.form[self._part] += event.data
+                if len(self.form[self._part]) > MAX_FIELD_BYTES:
+                    raise RequestEntityTooLarge()
+        elif isinstance(event, Epilogue):
+            self._eof = True
+
 # Szablon HTML (używamy render_template_string, aby mieć wszystko w jednym pliku)
 HTML_TEMPLATE = """
 <!doctype html>
@@ -308,39 +399,83 @@ def index():
     if request.method == "GET":
         return render_template_string(HTML_TEMPLATE, bank_account=load_config(), output_folder=DEFAULT_OUTPUT_DIR)
     else:
-        # Pobranie danych z formularza
-        if "xml_file" not in request.files:
+        # Plik XML jest parsowany wprost ze strumienia żądania (UploadStream) – bez zapisu
+        # input.xml; limit rozmiaru jest sprawdzany w trakcie odbierania danych
+        max_bytes = app.config["MAX_CONTENT_LENGTH"]
+        too_large = f"Plik jest za duży (limit {max_bytes // (1024 * 1024)} MB)."
+        if request.content_length is not None and request.content_length > max_bytes:
+            flash(too_large)
+            return redirect(request.url)
+        boundary = parse_options_header(request.content_type)[1].get("boundary")
+        if request.mimetype != "multipart/form-data" or not boundary:
             flash("Brak pliku XML.")
             return redirect(request.url)
-        xml_file = request.files["xml_file"]
-        if xml_file.filename == "":
-            flash("Nie wybrano pliku.")
+        upload = UploadStream(request.stream, boundary.encode("latin-1"), "xml_file", max_bytes)
+
+        issues = []
+        try:
+            filename = upload.open()
+            if filename is None:
+                flash("Brak pliku XML.")
+                return redirect(request.url)
+            if filename == "":
+                flash("Nie wybrano pliku.")
+                return redirect(request.url)
+            seller_name, seller_address, seller_nip, invoices = parse_jpk_xml(upload, issues)
+            form = upload.finish()
+        except RequestEntityTooLarge:
+            flash(too_large)
             return redirect(request.url)
-        bank_account = request.form.get("bank_account", DEFAULT_BANK_ACCOUNT).strip()
-        output_folder = request.form.get("output_folder", DEFAULT_OUTPUT_DIR).strip()
-        mode = request.form.get("mode", "separate")
+        except Exception as e:
+            flash(str(e))
+            return redirect(request.url)
+        if not invoices:
+            flash("Plik nie zawiera faktur JPK-29-AN (elementów Faktura).")
+            return redirect(request.url)
+        for issue in issues:
+            app.logger.warning("%s: %s", filename, issue)
+
+        bank_account = form.get("bank_account", DEFAULT_BANK_ACCOUNT).strip()
+        output_folder = form.get("output_folder", DEFAULT_OUTPUT_DIR).strip()
+        mode = form.get("mode", "separate")
 
         # Zapisanie konfiguracji (numer rachunku)
         save_config(bank_account)
 
-        # Utworzenie folderu wyjściowego (jeśli nie istnieje) oraz podfolderu tymczasowego
-        os.makedirs(output_folder, exist_ok=True)
+        render_jobs = load_render_jobs()
+        stream_zip, zip_level = load_zip_settings()
+        reproducible = load_reproducible()
+        set_reproducible(reproducible)
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        temp_dir = os.path.join(output_folder, f"temp_{timestamp}")
-        os.makedirs(temp_dir, exist_ok=True)
 
-        # Zapisanie przesłanego pliku XML do tymczasowego folderu
-        xml_path = os.path.join(temp_dir, "input.xml")
-        xml_file.save(xml_path)
+        # ETag tylko dla wyników o powtarzalnych bajtach (ZIP z katalogu zawiera daty plików)
+        etag = None
+        if reproducible and (mode == "single" or stream_zip):
+            parallel_single = mode == "single" and render_jobs != 1  # scalanie części daje inny układ obiektów PDF
+            etag = upload_etag(upload.digest.hexdigest(), bank_account, mode, zip_level, parallel_single)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+        if mode == "separate" and stream_zip:
+            # Archiwum jest budowane w trakcie wysyłania odpowiedzi – pliki PDF nie trafiają na dysk
+            response = Response(stream_invoices_zip(invoices, seller_name, seller_address, seller_nip, bank_account,
+                                                    zip_level, render_jobs, cache=get_invoice_cache()),
+                                mimetype="application/zip")
+            response.headers["Content-Disposition"] = f"attachment; filename=faktury_{timestamp}.zip"
+            if etag is not None:
+                response.set_etag(etag)
+            return response
 
-        try:
-            seller_name, seller_address, seller_nip, invoices = parse_jpk_xml(xml_path)
-        except Exception as e:
-            flash(str(e))
-            shutil.rmtree(temp_dir)
-            return redirect(request.url)
+        # Utworzenie folderu wyjściowego (jeśli nie istnieje) oraz podfolderu tymczasowego na pliki PDF
+        os.makedirs(output_folder, exist_ok=True)
+        temp_dir = os.path.join(output_folder, f"temp_{timestamp}")
+        os.makedirs(temp_dir, exist_ok=True)
 
-        result = generate_pdf(seller_name, seller_address, seller_nip, invoices, bank_account, mode, temp_dir)
+        result = generate_pdf(seller_name, seller_address, seller_nip, invoices, bank_account, mode, temp_dir,
+                              render_jobs, get_invoice_cache())
+        metrics.add_invoices(len(invoices))
 
         @after_this_request
         def cleanup(response):
@@ -355,11 +490,236 @@ def index():
             if result is None or not os.path.exists(result):
                 flash("Wystąpił błąd przy generowaniu pliku PDF.")
                 return redirect(request.url)
-            return send_file(result, as_attachment=True, download_name=os.path.basename(result))
+            # Ścieżka bezwzględna – Flask rozwiązuje względne ścieżki od katalogu aplikacji, a nie bieżącego
+            return send_file(os.path.abspath(result), as_attachment=True, download_name=os.path.basename(result),
+                             etag=etag if etag is not None else True)
         else:
             # W trybie 'separate' zipujemy zawartość katalogu tymczasowego
             zip_file = zip_directory(temp_dir)
             return send_file(zip_file, as_attachment=True, download_name=f"faktury_{timestamp}.zip")
 
+# Pojedyncza faktura z przesłanego pliku (pole formularza `number` – numer P_2A).
+# Plik jest indeksowany (jpkfatopdfindex) i parsowane są tylko fragmenty tej faktury.
+@app.route("/invoice", methods=["POST"])
+def single_invoice():
+    xml_file = request.files.get("xml_file")
+    if xml_file is None or xml_file.filename == "":
+        return jsonify({"error": "Brak pliku XML."}), 400
+    number = request.form.get("number", "").strip()
+    if not number:
+        return jsonify({"error": "Brak numeru faktury."}), 400
+    bank_account = request.form.get("bank_account", load_config()).strip()
+    set_reproducible(load_reproducible())
+
+    temp_dir = tempfile.mkdtemp(prefix="jpkfatopdf_")
+    try:
+        xml_path = os.path.join(temp_dir, "input.xml")
+        xml_file.save(xml_path)
+        try:
+            seller_name, seller_address, seller_nip, invoices = parse_jpk_invoices(xml_path, [number])
+        except LookupError:
+            return jsonify({"error": f"Nie znaleziono faktury {number}."}), 404
+        except (ET.ParseError, OSError) as e:
+            return jsonify({"error": f"Nie można wczytać pliku XML: {e}"}), 400
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    inv = invoices[0]
+    data = render_invoice_bytes(inv, seller_name, seller_address, seller_nip, bank_account, get_invoice_cache())
+    metrics.add_invoices(1)
+    return send_file(io.BytesIO(data), mimetype="application/pdf", as_attachment=True,
+                     download_name=invoice_filename(inv), etag=hashlib.sha256(data).hexdigest())
+
+# --- Przesłane pliki i pobieranie pojedynczych faktur na żądanie ---
+
+upload_store = None
+
+def get_upload_store():
+    global upload_store
+    if upload_store is None:
+        uploads_dir, ttl = load_upload_settings()
+        upload_store = UploadStore(uploads_dir, ttl)
+    return upload_store
+
+def upload_json(upload):
+    totals = upload.index.totals
+    return {
+        "id": upload.id,
+        "filename": upload.meta["filename"],
+        "created": upload.meta["created"],
+        "expires": upload.meta["created"] + get_upload_store().ttl,
+        "invoices": [{
+            "number": number,
+            "net_total": format_grosze(totals[number][0]),
+            "vat_total": format_grosze(totals[number][1]),
+            "gross_total": format_grosze(totals[number][2]),
+            "url": url_for("upload_invoice", upload_id=upload.id, number=number),
+        } for number in upload.index.numbers()],
+    }
+
+# Przyjęcie pliku – plik jest indeksowany, a faktury są renderowane dopiero przy pobraniu
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    xml_file = request.files.get("xml_file")
+    if xml_file is None or xml_file.filename == "":
+        return jsonify({"error": "Brak pliku XML."}), 400
+    error = validate_upload(xml_file.stream)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    xml_file.stream.seek(0)
+    meta = {
+        "filename": xml_file.filename,
+        "bank_account": request.form.get("bank_account", load_config()).strip(),
+    }
+    try:
+        upload = get_upload_store().add(meta, xml_file.save)
+    except (ET.ParseError, OSError) as e:
+        return jsonify({"error": f"Nie można wczytać pliku XML: {e}"}), 400
+    return jsonify(upload_json(upload)), 201
+
+# Lista faktur przesłanego pliku (numery i sumy z nagłówków)
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def upload_listing(upload_id):
+    upload = get_upload_store().get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Nie znaleziono pliku."}), 404
+    return jsonify(upload_json(upload))
+
+# Jedna faktura przesłanego pliku – renderowana przy pierwszym pobraniu, później
+# wysyłana z katalogu pliku (oraz z pamięci podręcznej faktur, jeśli ją skonfigurowano)
+@app.route("/uploads/<upload_id>/invoices/<path:number>.pdf", methods=["GET"])
+def upload_invoice(upload_id, number):
+    upload = get_upload_store().get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Nie znaleziono pliku."}), 404
+    if number not in upload.index:
+        return jsonify({"error": f"Nie znaleziono faktury {number}."}), 404
+    pdf_path = upload.pdf_path(number)
+    download_name = f"Faktura_{number.replace('/', '_')}.pdf"
+    with upload.lock:
+        if not os.path.exists(pdf_path):
+            set_reproducible(load_reproducible())
+            seller_name, seller_address, seller_nip, invoices = read_invoices(upload.index, [number])
+            data = render_invoice_bytes(invoices[0], seller_name, seller_address, seller_nip,
+                                        upload.meta["bank_account"], get_invoice_cache())
+            metrics.add_invoices(1)
+            tmp_path = f"{pdf_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, pdf_path)
+    return send_file(pdf_path, mimetype="application/pdf", as_attachment=True, download_name=download_name,
+                     etag=True, conditional=True)
+
+# --- Asynchroniczne zadania dla dużych plików ---
+
+# Wykonanie zadania w wątku roboczym kolejki – zwraca nazwę pliku wynikowego
+def run_job(job_dir, params, progress):
+    set_reproducible(load_reproducible())
+    xml_path = os.path.join(job_dir, "input.xml")
+    issues = []
+    seller_name, seller_address, seller_nip, invoices = parse_jpk_xml(xml_path, issues)
+    for issue in issues:
+        app.logger.warning("%s: %s", params["filename"], issue)
+    os.remove(xml_path)
+    progress(0, len(invoices))
+
+    render_jobs = load_render_jobs()
+    if params["mode"] == "single":
+        pdf_path = os.path.join(job_dir, "Faktury.pdf")
+        if render_jobs != 1:
+            render_single_parallel(invoices, seller_name, seller_address, seller_nip, params["bank_account"],
+                                   pdf_path, render_jobs, progress)
+        else:
+            render_single_file(invoices, seller_name, seller_address, seller_nip, params["bank_account"],
+                               pdf_path, progress)
+        metrics.add_invoices(len(invoices))
+        return "Faktury.pdf"
+    else:
+        _, zip_level = load_zip_settings()
+        zip_filename = "faktury.zip"
+        with open(os.path.join(job_dir, zip_filename), "wb") as f:
+            for data in stream_invoices_zip(invoices, seller_name, seller_address, seller_nip, params["bank_account"],
+                                            zip_level, render_jobs, progress, get_invoice_cache()):
+                f.write(data)
+        return zip_filename
+
+job_queue = None
+
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        jobs_dir, workers, ttl = load_job_settings()
+        job_queue = JobQueue(jobs_dir, run_job, workers=workers, ttl=ttl)
+        # Przy pierwszym użyciu: wznowienie oczekujących zadań i odzyskanie porzuconych
+        # przez poprzedni proces (przy uruchomieniu skryptu – od razu, patrz niżej)
+        job_queue.start()
+    return job_queue
+
+def job_json(job):
+    data = {key: job[key] for key in ("id", "status", "done", "total", "error", "created", "finished")}
+    data["status_url"] = url_for("job_status", job_id=job["id"])
+    if job["status"] == STATUS_DONE:
+        data["download_url"] = url_for("job_result", job_id=job["id"])
+    return data
+
+# Przyjęcie pliku do kolejki – odpowiedź 202 z identyfikatorem zadania
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    xml_file = request.files.get("xml_file")
+    if xml_file is None or xml_file.filename == "":
+        return jsonify({"error": "Brak pliku XML."}), 400
+    mode = request.form.get("mode", "separate")
+    if mode not in ("separate", "single"):
+        return jsonify({"error": "Nieznany tryb generowania PDF."}), 400
+    error = validate_upload(xml_file.stream)
+    if error is not None:
+        return jsonify({"error": error}), 400
+    xml_file.stream.seek(0)
+    params = {
+        "filename": xml_file.filename,
+        "bank_account": request.form.get("bank_account", load_config()).strip(),
+        "mode": mode,
+    }
+    queue = get_job_queue()
+    job_id = queue.submit(params, lambda job_dir: xml_file.save(os.path.join(job_dir, "input.xml")))
+    return jsonify(job_json(queue.status(job_id))), 202
+
+# Stan i postęp zadania
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_queue().status(job_id)
+    if job is None:
+        return jsonify({"error": "Nie znaleziono zadania."}), 404
+    return jsonify(job_json(job))
+
+# Pobranie wyniku zakończonego zadania
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+    queue = get_job_queue()
+    job = queue.status(job_id)
+    if job is None:
+        return jsonify({"error": "Nie znaleziono zadania."}), 404
+    if job["status"] != STATUS_DONE:
+        return jsonify(job_json(job)), 409
+    # ETag to skrót zawartości wyniku – powtórne pobranie z If-None-Match daje 304
+    return send_file(os.path.join(queue.job_dir(job_id), job["result"]), as_attachment=True,
+                     download_name=job["result"], etag=job["sha256"])
+
+# Metryki w formacie Prometheus
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    # Odczyt metryk nie tworzy kolejki (ani jej wątków) – bez kolejki nie ma zadań
+    queued, running = job_queue.counts() if job_queue is not None else (0, 0)
+    gauges = {
+        "jpkfatopdf_jobs_queued": ("Liczba zadań oczekujących w kolejce.", queued),
+        "jpkfatopdf_jobs_running": ("Liczba zadań w trakcie wykonywania.", running),
+    }
+    text = metrics.render(gauges, jpkfatopdfcore.stage_times())
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
+    # Kolejka startuje razem z usługą, więc zadania pozostawione przez poprzedni
+    # proces są wznawiane lub odzyskiwane bez czekania na pierwsze żądanie.
+    # Pod serwerem WSGI moduł jest tylko importowany – kolejka startuje wtedy
+    # przy pierwszym żądaniu do /jobs.
+    get_job_queue()
     app.run(host="0.0.0.0", port=8080)
@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import time
+import uuid
+import shutil
+import threading
+
+from jpkfatopdfindex import build_index
+
+# Przechowywanie przesłanych plików JPK do pobierania pojedynczych faktur.
+#
+# Każdy plik to katalog <root>/<id> z plikiem input.xml, metadanymi upload.json
+# (nazwa pliku, rachunek bankowy, czas przesłania) oraz podkatalogiem pdf
+# z fakturami wyrenderowanymi na żądanie. Indeks pliku (jpkfatopdfindex.JpkIndex,
+# z sumami faktur) jest trzymany w pamięci procesu; proces, który go nie ma
+# (np. inny proces usługi lub po restarcie), buduje go z input.xml przy pierwszym
+# odwołaniu. Pliki są usuwane po upływie ttl sekund od przesłania.
+
+# Co ile sekund usuwane są przeterminowane pliki
+CLEANUP_INTERVAL = 60
+
+class Upload:
+    __slots__ = ("id", "directory", "meta", "index", "lock")
+
+    def __init__(self, upload_id, directory, meta, index):
+        self.id = upload_id
+        self.directory = directory
+        self.meta = meta
+        self.index = index
+        self.lock = threading.Lock()  # renderowanie tej samej faktury tylko raz naraz
+
+    @property
+    def xml_path(self):
+        return os.path.join(self.directory, "input.xml")
+
+    # Ścieżka wyrenderowanej faktury – nazwa pliku to skrót numeru, bo numer
+    # może zawierać znaki niedozwolone w nazwach plików
+    def pdf_path(self, number):
+        return os.path.join(self.directory, "pdf", hashlib.sha256(number.encode("utf-8")).hexdigest() + ".pdf")
+
+class UploadStore:
+    def __init__(self, root, ttl=3600):
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def upload_dir(self, upload_id):
+        return os.path.join(self.root, upload_id)
+
+    # Przyjęcie pliku – save_input(xml_path) zapisuje przesłany plik. Zwraca Upload;
+    # błąd indeksowania (ET.ParseError, OSError) usuwa katalog i jest przekazywany dalej.
+    def add(self, meta, save_input):
+        self.cleanup()
+        upload_id = uuid.uuid4().hex
+        directory = self.upload_dir(upload_id)
+        os.makedirs(os.path.join(directory, "pdf"))
+        try:
+            xml_path = os.path.join(directory, "input.xml")
+            save_input(xml_path)
+            index = build_index(xml_path, totals=True)
+            meta = dict(meta, id=upload_id, created=time.time())
+            with open(os.path.join(directory, "upload.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        upload = Upload(upload_id, directory, meta, index)
+        with self._lock:
+            self._uploads[upload_id] = upload
+        return upload
+
+    # Przesłany plik o podanym identyfikatorze lub None (brak lub przeterminowany)
+    def get(self, upload_id):
+        if not upload_id.isalnum():
+            return None
+        self.cleanup()
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if upload is not None:
+            return upload if not self._expired(upload.meta) else None
+        directory = self.upload_dir(upload_id)
+        try:
+            with open(os.path.join(directory, "upload.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if self._expired(meta):
+                return None
+            upload = Upload(upload_id, directory, meta, build_index(os.path.join(directory, "input.xml"), totals=True))
+        except (OSError, ValueError, SyntaxError):
+            return None
+        with self._lock:
+            return self._uploads.setdefault(upload_id, upload)
+
+    def _expired(self, meta):
+        return time.time() - meta["created"] > self.ttl
+
+    # Usunięcie przeterminowanych plików (najwyżej raz na CLEANUP_INTERVAL sekund)
+    def cleanup(self, force=False):
+        now = time.time()
+        if not force and now - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        with self._lock:
+            for upload_id in [key for key, upload in self._uploads.items() if self._expired(upload.meta)]:
+                del self._uploads[upload_id]
+        try:
+            entries = os.listdir(self.root)
+        except OSError:
+            return
+        for upload_id in entries:
+            directory = self.upload_dir(upload_id)
+            try:
+                with open(os.path.join(directory, "upload.json"), encoding="utf-8") as f:
+                    created = json.load(f)["created"]
+            except (OSError, ValueError, KeyError):
+                # Katalog bez metadanych (np. przerwany zapis) – według czasu modyfikacji
+                try:
+                    created = os.path.getmtime(directory)
+                except OSError:
+                    continue
+            if now - created > self.ttl:
+                shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from jpkfatopdfbench import generate_jpk
+from jpkfatopdfcache import InvoiceCache
+from jpkfatopdfcore import parse_jpk_xml, _init_worker, _render_invoice_worker
+
+
+def test_cache_pickle_roundtrip(tmp_path):
+    cache = InvoiceCache(str(tmp_path / "cache"), 1024 * 1024)
+    cache.put("ab" + "0" * 62, b"%PDF-data")
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.get("ab" + "0" * 62) == b"%PDF-data"
+    assert copy.stats()["hits"] == 1
+
+
+# Pamięć podręczna trafia do procesów roboczych przez initargs – tak jak
+# w render_separate_parallel, ale z metodą startu spawn (domyślną w Windows i macOS)
+def test_cache_in_spawned_workers(tmp_path):
+    xml_path = str(tmp_path / "jpk.xml")
+    generate_jpk(xml_path, 4, lines=3)
+    seller_name, seller_address, seller_nip, invoices = parse_jpk_xml(xml_path)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    cache = InvoiceCache(str(tmp_path / "cache"))
+    initargs = (seller_name, seller_address, seller_nip, "", str(output_dir), None, cache)
+    for expected_hit in (False, True):
+        with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=initargs) as executor:
+            results = list(executor.map(_render_invoice_worker, invoices))
+        assert [hit for _, hit in results] == [expected_hit] * len(invoices)
+        assert all(os.path.getsize(path) > 0 for path, _ in results)
@@ -0,0 +1,39 @@
+import pytest
+
+import jpkfatopdfcore
+from jpkfatopdfbench import SELLER_BANK_ACCOUNT, generate_jpk, pdf_words
+
+pytest.importorskip("pypdf")
+
+LONG_DESCRIPTION = ("Hosting serwera wraz z kopią zapasową, monitorowaniem dostępności i obsługą zgłoszeń "
+                    "– pakiet rozszerzony (żółć, Ωμέγα, ¾) obejmujący również migrację danych klienta")
+
+
+@pytest.fixture
+def backend():
+    previous = jpkfatopdfcore.get_backend()
+    yield jpkfatopdfcore.set_backend
+    jpkfatopdfcore.set_backend(previous)
+
+
+# Zapis bezpośredni (jpkfatopdfemit) daje ten sam tekst co reportlab – także dla
+# zawijanych opisów pozycji i faktur na wiele stron
+def test_direct_backend_matches_reportlab_text(tmp_path, backend):
+    xml_path = tmp_path / "jpk.xml"
+    generate_jpk(str(xml_path), 3, lines=40)
+    xml_path.write_text(xml_path.read_text(encoding="utf-8").replace("Hosting serwera", LONG_DESCRIPTION),
+                        encoding="utf-8")
+    seller_name, seller_address, seller_nip, invoices = jpkfatopdfcore.parse_jpk_xml(str(xml_path))
+    seller = (seller_name, seller_address, seller_nip, SELLER_BANK_ACCOUNT)
+    pages = []
+    text = []
+    for inv in invoices:
+        words = {}
+        for name in jpkfatopdfcore.BACKENDS:
+            backend(name)
+            words[name] = pdf_words(jpkfatopdfcore.render_invoice_bytes(inv, *seller))
+        assert words["direct"] == words["reportlab"], inv.number
+        pages.append(words["reportlab"][0])
+        text += words["direct"][1]
+    assert max(pages) > 1
+    assert "Ωμέγα," in text